@@ -611,9 +611,22 @@ class BaseExp(object):
         for self.this_block in self.block_queue:
             self.this_block.experiment = self
             logger.info("Beginning block #%d" % self.this_block.index)
+            self.preload_block(self.this_block)
             for trial in self.this_block:
                 yield trial
 
+    def preload_block(self, block):
+        """ Decodes the block's stimuli before its first trial, if the panel's
+        speaker supports preloading.
+        """
+
+        speaker = getattr(self.panel, "speaker", None)
+        if speaker is None or not hasattr(speaker, "preload"):
+            return
+        files = block.stimulus_files()
+        if speaker.preload(files):
+            logger.debug("Preloaded %d stimuli for block #%d" % (len(files), block.index))
+
     def session_main(self):
         """ Runs the session by looping over the block queue and then running
         each trial in each block.
@@ -95,6 +95,7 @@ class GoNoGoInterrupt(base.BaseExp):
                       'response',
                       'correct',
                       'rt',
+                      'stimulus_time',
                       'reward',
                       'max_wait',
                       ]
@@ -135,13 +136,22 @@ class GoNoGoInterrupt(base.BaseExp):
                                      self.this_trial.condition.name,
                                      self.this_trial.stimulus.name))
         self.panel.speaker.queue(self.this_trial.stimulus.file_origin)
-        self.this_trial.annotate(stimulus_time=dt.datetime.now())
+        play_time = dt.datetime.now()
         self.panel.speaker.play()
+        # response_main replaces this with the onset once it has polled
+        self.this_trial.annotate(stimulus_time=play_time,
+                                 stimulus_play_time=play_time)
 
     def response_main(self):
         """ Poll for an interruption for the duration of the stimulus. """
         # Would be better to just pol till stimulus is actually done
         self.this_trial.response_time = self.panel.response_port.poll(self.this_trial.stimulus.duration)
+        # Reaction times are measured from when the sound reached the speaker,
+        # if the output can tell. It is looked up only now so that waiting for
+        # it does not eat into the response window.
+        onset = self.panel.speaker.wait_onset()
+        if onset is not None:
+            self.this_trial.annotate(stimulus_time=onset)
         logger.debug("Received peck or timeout. Stopping playback")
 
         # Its janky, but allow the stimulus to finish...
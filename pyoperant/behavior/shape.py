@@ -520,7 +520,11 @@ class Shaper3ACMatching(Shaper3AC):
         def temp():
             trial_stim, trial_motifs = self.get_stimuli(trial_class)
             self.log.debug("presenting stimulus %s" % trial_stim.name)
-            self.panel.speaker.queue(trial_stim.file_origin)
+            sequence = trial_stim.annotations.get('sequence')
+            if sequence:
+                self.panel.speaker.queue_sequence(sequence)
+            else:
+                self.panel.speaker.queue(trial_stim.file_origin)
             self.panel.speaker.play()
             return next_state
         return temp
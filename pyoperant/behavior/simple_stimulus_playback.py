@@ -1,4 +1,5 @@
 import logging
+import time
 import datetime as dt
 import numpy as np
 from pyoperant.behavior import base
@@ -15,7 +16,7 @@ class SimpleStimulusPlayback(base.BaseExp):
     Additional Parameters
     ---------------------
     intertrial_interval: float or 2-element list
-        If the value is a float, then the intertrial interval is fixed. If it is a list, then the interval is taken as from a uniform random distribution between the first and second elements.
+        If the value is a float, then the intertrial interval is fixed. If it is a list, then the interval is taken as from a uniform random distribution between the first and second elements. The interval is measured from the end of one stimulus to the start of the next, and the start is scheduled on the output if it supports it.
     stimulus_directory: string or list
         Full path to the stimulus directory. If given, a stimulus condition will be created and passed in to BaseExp. Can also be a list of dictionaries with name and directory keys.
 
@@ -89,6 +90,8 @@ class SimpleStimulusPlayback(base.BaseExp):
                 blocks.append(block)
 
         self.intertrial_interval = intertrial_interval
+        self.start_at = None
+        self._stimulus_end = None
 
         super(SimpleStimulusPlayback, self).__init__(blocks=blocks,
                                                      *args, **kwargs)
@@ -104,8 +107,14 @@ class SimpleStimulusPlayback(base.BaseExp):
                 else:
                     self.iti = self.intertrial_interval
 
-                logger.debug("Waiting for %1.3f seconds" % self.iti)
-                utils.wait(self.iti)
+                # Count the interval from the end of the last stimulus, unless
+                # that would already have passed
+                now = time.monotonic()
+                if (self._stimulus_end is None) or (self._stimulus_end + self.iti < now):
+                    self.start_at = now + self.iti
+                else:
+                    self.start_at = self._stimulus_end + self.iti
+                logger.debug("Starting next stimulus in %1.3f seconds" % (self.start_at - now))
                 yield trial
 
     def trial_pre(self):
@@ -125,10 +134,11 @@ class SimpleStimulusPlayback(base.BaseExp):
                                      ))
 
         self.panel.speaker.queue(self.this_trial.stimulus.file_origin)
-        self.panel.speaker.play()
+        self.panel.speaker.play_at(self.start_at)
 
         # Wait for stimulus to finish
-        utils.wait(self.this_trial.stimulus.duration)
+        self._stimulus_end = self.start_at + self.this_trial.stimulus.duration
+        utils.wait_until(self._stimulus_end)
 
         # Stop the sound
         self.panel.speaker.stop()
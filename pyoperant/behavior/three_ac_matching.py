@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import random, os
+import random
 from pyoperant import utils, components
 from pyoperant.behavior import two_alt_choice, shape
 
@@ -38,8 +38,7 @@ class ThreeACMatchingExp(two_alt_choice.TwoAltChoiceExp):
         motif_isi[-1] = 0.0
 
         input_files = zip(motif_files, motif_isi)
-        filename = os.path.join(self.parameters['stim_path'], ''.join(motif_names) + '.wav')
-        stim, epochs = utils.concat_wav(input_files, filename)
+        stim, epochs = utils.sequence_stimulus(input_files, ''.join(motif_names))
 
         for ep in epochs:
             for stim_name, f_name in self.parameters['stims'].items():
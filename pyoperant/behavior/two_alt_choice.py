@@ -367,8 +367,13 @@ class TwoAltChoiceExp(base.BaseExp):
     def stimulus_pre(self):
         # wait for bird to peck
         self.log.debug("presenting stimulus %s" % self.this_trial.stimulus)
-        self.log.debug("from file %s" % self.this_trial.stimulus_event.file_origin)
-        self.panel.speaker.queue(self.this_trial.stimulus_event.file_origin)
+        sequence = self.this_trial.stimulus_event.annotations.get('sequence')
+        if sequence:
+            self.log.debug("from sequence %s" % str(sequence))
+            self.panel.speaker.queue_sequence(sequence)
+        else:
+            self.log.debug("from file %s" % self.this_trial.stimulus_event.file_origin)
+            self.panel.speaker.queue(self.this_trial.stimulus_event.file_origin)
         self.log.debug('waiting for peck...')
         self.panel.center.on()
         trial_time = None
@@ -86,6 +86,18 @@ class Block(queues.BaseHandler):
     def check_completion(self):
         return self.consumed
 
+    def stimulus_files(self):
+        """ All of the stimulus files currently found by this block's
+        conditions, without duplicates """
+
+        files = list()
+        for condition in self.conditions:
+            for filename in getattr(condition, "files", None) or []:
+                if filename not in files:
+                    files.append(filename)
+
+        return files
+
     def next_trial(self):
         return next(self)
 
@@ -93,6 +93,11 @@ class Hopper(BaseComponent):
         else:
             raise ValueError('%s is not an output channel' % solenoid)
 
+        # Read the IR beam and solenoid together so that check() costs a
+        # single request on interfaces that support multi-channel reads
+        if self.IR is not None:
+            self._status = hwio.BooleanInputGroup([self.IR, self.solenoid])
+
     def check(self):
         """ Reads the status of solenoid & IR beam, then throws an error if they
         don't match. If IR is None, then trust the solenoid's status.
@@ -115,8 +120,7 @@ class Hopper(BaseComponent):
         if self.IR is None:
             return self.solenoid.read() is True
 
-        IR_status = self.IR.read()
-        solenoid_status = self.solenoid.read()
+        IR_status, solenoid_status = self._status.read()
         if IR_status != solenoid_status:
             if IR_status:
                 raise HopperActiveError
@@ -127,9 +131,15 @@ class Hopper(BaseComponent):
         else:
             return IR_status
 
-    def up(self):
+    def up(self, duration=None):
         """ Raises the hopper up.
 
+        Parameters
+        ----------
+        duration : float, optional
+            If given and the solenoid's interface can time pulses, the
+            interface drops the hopper again after duration seconds.
+
         Returns
         -------
         datetime
@@ -142,7 +152,10 @@ class Hopper(BaseComponent):
         """
 
         self.event["action"] = "up"
-        self.solenoid.write(True, event=self.event)
+        if (duration is not None) and self.solenoid.can_pulse:
+            self.solenoid.pulse(duration, event=self.event)
+        else:
+            self.solenoid.write(True, event=self.event)
         if self.IR is None:
             return datetime.datetime.now()
 
@@ -178,7 +191,8 @@ class Hopper(BaseComponent):
         return time_down
 
     def feed(self, dur=2.0, error_check=True):
-        """ Performs a feed
+        """ Performs a feed. If the solenoid's interface can time pulses, this
+        returns as soon as the hopper is up and the interface drops it.
 
         Parameters
         ----------
@@ -198,7 +212,8 @@ class Hopper(BaseComponent):
         HopperWontComeUpError
             The Hopper did not raise for the feed.
         HopperWontDropError
-            The Hopper did not drop fater the feed.
+            The Hopper did not drop fater the feed. Only checked when the feed
+            is timed here rather than by the interface.
 
         """
         assert self.max_lag < dur, "max_lag (%ss) must be shorter than duration (%ss)" % (self.max_lag, dur)
@@ -207,7 +222,13 @@ class Hopper(BaseComponent):
         except HopperActiveError as e:
             self.solenoid.write(False)
             raise HopperAlreadyUpError(e)
-        feed_time = self.up()
+        feed_time = self.up(duration=dur)
+        if self.solenoid.can_pulse:
+            # The interface drops the hopper after dur seconds, so there is
+            # nothing to wait for. A hopper that stays up is caught by
+            # check() at the start of the next feed.
+            return (feed_time, datetime.timedelta(seconds=dur))
+
         utils.wait(dur)
         feed_over = self.down()
         feed_duration = feed_over - feed_time
@@ -336,7 +357,7 @@ class PeckPort(BaseComponent):
         self.LED.write(True, event=self.event)
         return True
 
-    def flash(self, dur=1.0, isi=0.1):
+    def flash(self, dur=1.0, isi=0.1, block=True):
         """ Flashes the LED on and off with *isi* seconds high and low for *dur*
         seconds, then revert LED to prior state.
 
@@ -346,12 +367,23 @@ class PeckPort(BaseComponent):
             Duration of the light flash in seconds.
         isi : float,optional
             Time interval between toggles. (0.5 * period)
+        block : bool, optional
+            Whether to wait for the flash to finish. Only interfaces that can
+            time patterns on their own can flash without blocking.
 
         Returns
         -------
         (datetime, float)
             Timestamp of the flash and the flash duration
         """
+        if self.LED.can_pulse:
+            self.event["action"] = "flash"
+            flash_time = datetime.datetime.now()
+            self.LED.pattern(isi, isi, duration=dur, event=self.event)
+            if block:
+                utils.wait(dur)
+            return (flash_time, datetime.timedelta(seconds=dur))
+
         LED_state = self.LED.read()
         flash_time = datetime.datetime.now()
         flash_duration = datetime.datetime.now() - flash_time
@@ -574,24 +606,92 @@ class Speaker(BaseComponent):
     def set_gain(self, gain):
         self.gain = gain
 
+    def preload(self, wav_filenames):
+        """ Decodes the given wave files ahead of time, if the output supports
+        it, so that queueing one of them does no file I/O.
+
+        Returns
+        -------
+        bool
+            True if the files were preloaded
+        """
+
+        if not self.output.can_preload:
+            return False
+        return self.output.preload(wav_filenames)
+
     def queue(self, wav_filename, metadata=None):
 
         self.event["action"] = "queue"
         self.event["metadata"] = metadata
         return self.output.queue(wav_filename, event=self.event)
 
+    def queue_sequence(self, sequence, metadata=None):
+        """ Queues wave files to play back to back in one stream, each
+        followed by a silent gap
+
+        Parameters
+        ----------
+        sequence: list
+            (wav_filename, isi) pairs, where isi is the silence in seconds
+            after the file
+        """
+
+        self.event["action"] = "queue"
+        self.event["metadata"] = metadata
+        return self.output.queue_sequence(sequence, event=self.event)
+
     def play(self):
 
         self.event["action"] = "play"
         return self.output.play(event=self.event, gain=self.gain)
 
+    def play_at(self, monotonic_time):
+        """ Plays the queued sound so that it starts at monotonic_time (a
+        time.monotonic() time). Outputs that cannot schedule playback are
+        started by waiting on the host until then. """
+
+        self.event["action"] = "play"
+        if self.output.can_play_at:
+            return self.output.play_at(monotonic_time, event=self.event, gain=self.gain)
+
+        utils.wait_until(monotonic_time)
+        return self.output.play(event=self.event, gain=self.gain)
+
     def stop(self):
 
         self.event["action"] = "stop"
         return self.output.stop(event=self.event)
 
+    def wait_onset(self, timeout=1.0):
+        """ Waits for the sound just played to start and returns the time (a
+        datetime) its first sample reached the DAC, which is also written to
+        the events. Returns None if the output cannot tell or the sound did
+        not start within timeout. """
+
+        if not self.output.can_report_onset:
+            return None
+        self.event["action"] = "onset"
+        return self.output.get_onset(event=self.event, timeout=timeout)
+
+    def wait_onsets(self, timeout=1.0):
+        """ Like wait_onset, but returns the onset of each file of a queued
+        sequence, each of which is written to the events """
+
+        if not self.output.can_report_onset:
+            return None
+        self.event["action"] = "onset"
+        return self.output.get_onsets(event=self.event, timeout=timeout)
+
     def let_finish(self):
-        while self.output.interface.play_thread.is_alive():
+        if self.output.can_report_playing:
+            while self.output.is_playing():
+                utils.wait(0.01)
+            return
+
+        # Otherwise wait on the interface's playback thread, if it has one
+        play_thread = getattr(self.output.interface, "play_thread", None)
+        while (play_thread is not None) and play_thread.is_alive():
             utils.wait(0.01)
 
 
@@ -616,6 +716,12 @@ class Microphone(BaseComponent):
     def record_last(self, duration):
         return self.input.get_recorded_data(duration)
 
+    def record_range(self, start_time, stop_time):
+        """ Returns what was recorded between two times (seconds since the
+        epoch or datetimes) as (data, rate). With a recorder writing to disk,
+        this can reach back to the start of the session. """
+        return self.input.get_recorded_range(start_time, stop_time)
+
 # ## Perch ##
 
 # class Perch(BaseComponent):
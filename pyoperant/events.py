@@ -47,7 +47,7 @@ class Events(object):
         for handler in self.handlers:
             handler.close()
 
-    def write(self, event):
+    def write(self, event, time=None, uncertainty=None):
         """ Places the event in the queue for each handler to write.
 
         Parameters
@@ -56,11 +56,23 @@ class Events(object):
             A dictionary describing the current component event. It should have
             3 keys: name, action, and metadata. A time key will be added
             containing the datetime of the event.
+        time: datetime
+            The time of the event, if it is known more precisely than the time
+            of this call (e.g. from a hardware timestamp). Defaults to now.
+        uncertainty: float
+            The error bound of time, in seconds. If given, it is added to the
+            event under the uncertainty key.
         """
         if event is None:
             return
 
-        event["time"] = dt.datetime.now()
+        if time is None:
+            time = dt.datetime.now()
+        event["time"] = time
+        if uncertainty is not None:
+            event["uncertainty"] = uncertainty
+        else:
+            event.pop("uncertainty", None)
         for handler in self.handlers:
             logger.debug("Adding to handler %s" % str(handler))
             handler.queue.put(event)
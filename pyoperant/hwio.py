@@ -1,5 +1,5 @@
 import logging
-from pyoperant.errors import WriteCannotBeReadError
+from pyoperant.errors import WriteCannotBeReadError, InterfaceError
 
 logger = logging.getLogger(__name__)
 
@@ -211,6 +211,10 @@ class BooleanOutput(BaseIO):
         returns the last passed by write(value)
     toggle()
         Flips the value from the current value
+    pulse(duration)
+        Sets the output True for a fixed duration, timed by the interface
+    pattern(on_duration, off_duration)
+        Blinks the output, timed by the interface
     """
     def __init__(self, interface=None, params={}, *args, **kwargs):
         super(BooleanOutput, self).__init__(interface=interface,
@@ -298,6 +302,155 @@ class BooleanOutput(BaseIO):
         value = not self.read()
         return self.write(value=value, event=event)
 
+    @property
+    def can_pulse(self):
+        """ Whether the interface can time pulses and patterns on its own """
+
+        return self.interface.can_pulse_bool
+
+    def pulse(self, duration, event=None):
+        """ Sets the output True for duration seconds. The timing is done by
+        the interface, so this returns right away.
+
+        Parameters
+        ----------
+        duration: float
+            Time, in seconds, the output stays True
+        event: dictionary
+            Dictionary containing event details that are passed along to the
+            interface.
+
+        Returns
+        -------
+        bool
+            True if the interface accepted the pulse
+
+        Raises
+        ------
+        InterfaceError
+            The interface cannot time pulses
+        """
+
+        if not self.can_pulse:
+            raise InterfaceError("Interface %s cannot time pulses" % self.interface)
+
+        logger.debug("Pulsing output for %s seconds" % duration)
+        # The output is high until the interface reports the end of the pulse
+        self.last_value = True
+        return self.interface._pulse_bool(duration=duration,
+                                          event=event,
+                                          on_done=self._pulse_done,
+                                          **self.params)
+
+    def _pulse_done(self, value):
+        """ Called by the interface with the output's value when a pulse ends """
+
+        self.last_value = value
+
+    def pattern(self, on_duration, off_duration, duration=None, event=None):
+        """ Blinks the output, starting True, and restores its prior value at
+        the end. The timing is done by the interface, so this returns right
+        away. A pattern without a duration runs until the output is written.
+
+        Parameters
+        ----------
+        on_duration: float
+            Time, in seconds, the output is True in each cycle
+        off_duration: float
+            Time, in seconds, the output is False in each cycle
+        duration: float
+            Total time, in seconds, of the pattern (default until cancelled)
+        event: dictionary
+            Dictionary containing event details that are passed along to the
+            interface.
+
+        Returns
+        -------
+        bool
+            True if the interface accepted the pattern
+
+        Raises
+        ------
+        InterfaceError
+            The interface cannot time patterns
+        """
+
+        if not self.can_pulse:
+            raise InterfaceError("Interface %s cannot time patterns" % self.interface)
+
+        logger.debug("Starting output pattern")
+        return self.interface._pattern_bool(on_duration=on_duration,
+                                            off_duration=off_duration,
+                                            duration=duration,
+                                            event=event,
+                                            **self.params)
+
+
+class BooleanInputGroup(object):
+    """ Reads the values of several boolean inputs (or readable boolean
+    outputs) together. Members that share an interface with a
+    '_read_bool_many' method are sampled in a single request to the hardware.
+    All other members are read one at a time.
+
+    Parameters
+    ----------
+    ios: list
+        BooleanInput or BooleanOutput instances. Their params must contain a
+        'channel' key if their interface supports '_read_bool_many'.
+
+    Attributes
+    ----------
+    ios: list
+        The grouped inputs and outputs
+    last_values: list
+        Most recently returned values, in the order of ios
+
+    Methods
+    -------
+    read()
+        Reads the value of every member. Returns a list of booleans
+    """
+
+    def __init__(self, ios):
+
+        self.ios = list(ios)
+        self.last_values = [None] * len(self.ios)
+
+    def read(self):
+        """ Read the status of every member of the group
+
+        Returns
+        -------
+        list
+            The current status of each member, in the order of ios
+        """
+
+        # Group members by interface while keeping track of their position
+        by_interface = list()
+        for ii, io in enumerate(self.ios):
+            for interface, indices in by_interface:
+                if interface is io.interface:
+                    indices.append(ii)
+                    break
+            else:
+                by_interface.append((io.interface, [ii]))
+
+        values = [None] * len(self.ios)
+        for interface, indices in by_interface:
+            if interface.can_read_bool_many:
+                channels = [self.ios[ii].params["channel"] for ii in indices]
+                group_values = interface._read_bool_many(channels)
+            else:
+                group_values = [self.ios[ii].read() for ii in indices]
+
+            for ii, value in zip(indices, group_values):
+                values[ii] = value
+                if isinstance(self.ios[ii], BooleanInput):
+                    self.ios[ii].last_value = value
+
+        self.last_values = values
+        return values
+
 
 class AnalogInput(BaseIO):
     """ Class which holds information about analog inputs and abstracts the
@@ -378,6 +531,12 @@ class AnalogOutput(BaseIO):
         Configures the analog output
     write(values)
         Writes an array of values to the output. Returns True if successful.
+    prepare(values)
+        Loads an array of values onto the interface without starting output
+    trigger()
+        Starts output of the prepared values
+    stream(data)
+        Writes an array or generator of values to the output in chunks
     """
     def __init__(self, interface=None, params={}, *args, **kwargs):
         super(AnalogOutput, self).__init__(interface=interface,
@@ -420,7 +579,113 @@ class AnalogOutput(BaseIO):
             True if the write succeeded
         """
 
-        return self.interface._write_analog(values=values, event=event)
+        return self.interface._write_analog(values=values, event=event,
+                                            **self.params)
+
+    @property
+    def can_prepare(self):
+        """ Whether the interface can load values ahead of starting output """
+
+        return self.interface.can_prepare_analog
+
+    def prepare(self, values, event=None):
+        """ Loads values onto the interface without starting output. Call
+        this before the time-critical part of a trial and trigger() when the
+        output should begin.
+
+        Parameters
+        ----------
+        values: numpy array
+            Array of float values to be written to the output
+        event: dictionary
+            Dictionary containing event details that are encoded with the
+            output by the interface.
+
+        Returns
+        -------
+        bool
+            True if the values were loaded
+
+        Raises
+        ------
+        InterfaceError
+            The interface cannot prepare outputs
+        """
+
+        if not self.can_prepare:
+            raise InterfaceError("Interface %s cannot prepare analog outputs" % self.interface)
+
+        return self.interface._prepare_analog(values=values, event=event,
+                                              **self.params)
+
+    def trigger(self, is_blocking=False, event=None):
+        """ Starts output of the values loaded by prepare()
+
+        Parameters
+        ----------
+        is_blocking: bool
+            Whether or not to wait until the output is finished
+        event: dictionary
+            Dictionary containing event details that are passed along to the
+            interface.
+
+        Returns
+        -------
+        bool
+            True if the output started
+        """
+
+        if not self.can_prepare:
+            raise InterfaceError("Interface %s cannot prepare analog outputs" % self.interface)
+
+        return self.interface._trigger_analog(is_blocking=is_blocking,
+                                              event=event, **self.params)
+
+    @property
+    def can_stream(self):
+        """ Whether the interface can stream values in chunks """
+
+        return self.interface.can_stream_analog
+
+    def stream(self, data, chunk_size=None, buffer_size=None,
+               is_blocking=False, event=None):
+        """ Streams values to the output in chunks, so that long or generated
+        signals only need a fixed amount of memory.
+
+        Parameters
+        ----------
+        data: numpy array or iterable
+            Array (e.g. a np.memmap) of values, or an iterable of arrays
+            (e.g. a generator)
+        chunk_size: int
+            Number of samples per write (default set by the interface)
+        buffer_size: int
+            Number of samples to buffer ahead of the output (default set by
+            the interface)
+        is_blocking: bool
+            Whether or not to wait until the stream has finished
+        event: dictionary
+            Dictionary containing event details that are passed along to the
+            interface.
+
+        Returns
+        -------
+        interfaces.utils.AnalogOutputStream
+            The running stream, which counts underruns
+
+        Raises
+        ------
+        InterfaceError
+            The interface cannot stream analog outputs
+        """
+
+        if not self.can_stream:
+            raise InterfaceError("Interface %s cannot stream analog outputs" % self.interface)
+
+        return self.interface._stream_analog(data=data, chunk_size=chunk_size,
+                                             buffer_size=buffer_size,
+                                             is_blocking=is_blocking,
+                                             event=event, **self.params)
 
 
 class AudioOutput(BaseIO):
@@ -438,6 +703,8 @@ class AudioOutput(BaseIO):
     Methods:
     config()
         Configures the audio interface
+    preload(wav_filenames)
+        Decodes .wav files ahead of time, if the interface supports it
     queue(wav_filename)
         Queues a .wav file for playback
     play()
@@ -472,15 +739,153 @@ class AudioOutput(BaseIO):
         logger.debug("Configuring AudioOutput to write on interface % s" % self.interface)
         return self.interface._config_write_analog(**self.params)
 
+    @property
+    def can_preload(self):
+        """ Whether the interface can decode wave files ahead of time """
+
+        return self.interface.can_preload_wav
+
+    def preload(self, wav_filenames):
+        """ Decodes wave files so that queueing them later is fast
+
+        Parameters
+        ----------
+        wav_filenames: list
+            Paths to the wave files that may be queued
+
+        Returns
+        -------
+        bool
+            True if the files were loaded
+
+        Raises
+        ------
+        InterfaceError
+            The interface cannot preload wave files
+        """
+
+        if not self.can_preload:
+            raise InterfaceError("Interface %s cannot preload wave files" % self.interface)
+
+        return self.interface._preload_wav(wav_filenames, **self.params)
+
     def queue(self, wav_filename, event=None):
         return self.interface._queue_wav(wav_filename, event=event, **self.params)
 
+    @property
+    def can_queue_sequence(self):
+        """ Whether the interface can queue sequences of wave files """
+
+        return self.interface.can_queue_sequence
+
+    def queue_sequence(self, sequence, event=None):
+        """ Queues wave files to play back to back without gaps
+
+        Parameters
+        ----------
+        sequence: list
+            (wav_filename, isi) pairs, where isi is the silence in seconds
+            after the file
+        event: dict
+            The event to write
+
+        Returns
+        -------
+        Whatever the interface returns
+        """
+
+        if not self.can_queue_sequence:
+            raise InterfaceError("Interface %s cannot queue sequences" % self.interface)
+
+        return self.interface._queue_sequence(sequence, event=event, **self.params)
+
     def play(self, event=None, gain=None):
         return self.interface._play_wav(event=event, gain=gain, **self.params)
 
+    @property
+    def can_play_at(self):
+        """ Whether the interface can start playback at a given time """
+
+        return self.interface.can_schedule_wav
+
+    def play_at(self, monotonic_time, event=None, gain=None):
+        """ Plays the queued audio file so that it starts at a given time
+
+        Parameters
+        ----------
+        monotonic_time: float
+            The time.monotonic() time at which the sound should start
+        event: dict
+            The event to write, with the scheduled time
+        gain: float
+            Gain in dB
+
+        Returns
+        -------
+        Whatever the interface returns
+        """
+
+        if not self.can_play_at:
+            raise InterfaceError("Interface %s cannot schedule playback" % self.interface)
+
+        return self.interface._play_wav_at(monotonic_time, event=event,
+                                           gain=gain, **self.params)
+
     def stop(self, event=None):
         return self.interface._stop_wav(event=event, **self.params)
 
+    @property
+    def can_report_playing(self):
+        """ Whether the interface can report if a sound is still playing """
+
+        return self.interface.can_report_playing
+
+    def is_playing(self):
+        """ Whether the interface is still playing the last sound """
+
+        if not self.can_report_playing:
+            raise InterfaceError("Interface %s cannot report whether it is playing" % self.interface)
+
+        return self.interface.is_playing(**self.params)
+
+    @property
+    def can_report_onset(self):
+        """ Whether the interface can report when a sound started playing """
+
+        return self.interface.can_report_onset
+
+    def get_onset(self, event=None, timeout=1.0):
+        """ Waits for the sound just played to start and returns the time its
+        first sample reaches the DAC
+
+        Parameters
+        ----------
+        event: dict
+            The event to write with the onset time
+        timeout: float
+            Maximum time in seconds to wait for the sound to start
+
+        Returns
+        -------
+        datetime
+            The onset, or None if the sound did not start within timeout
+        """
+
+        if not self.can_report_onset:
+            raise InterfaceError("Interface %s cannot report onsets" % self.interface)
+
+        return self.interface._get_onset(event=event, timeout=timeout, **self.params)
+
+    def get_onsets(self, event=None, timeout=1.0):
+        """ Like get_onset, but returns a list with the onset of each file of
+        a queued sequence, and writes an event for each with the file as
+        metadata """
+
+        if not self.can_report_onset:
+            raise InterfaceError("Interface %s cannot report onsets" % self.interface)
+
+        return self.interface._get_onsets(event=event, timeout=timeout, **self.params)
+
 
 class AudioInput(BaseIO):
     """
@@ -514,4 +919,31 @@ class AudioInput(BaseIO):
         return self.interface._config_read_analog(**self.params)
 
     def get_recorded_data(self, duration):
-        return self.interface._get_last_recorded_data(duration)
+        return self.interface._get_last_recorded_data(duration, **self.params)
+
+    @property
+    def can_record_range(self):
+        """ Whether the interface can return recordings for a range of times """
+
+        return self.interface.can_record_range
+
+    def get_recorded_range(self, start_time, stop_time):
+        """ Returns what was recorded between two times
+
+        Parameters
+        ----------
+        start_time: float or datetime
+            Start of the range, in seconds since the epoch
+        stop_time: float or datetime
+            End of the range, in seconds since the epoch
+
+        Returns
+        -------
+        tuple
+            (data, rate) of the recording
+        """
+
+        if not self.can_record_range:
+            raise InterfaceError("Interface %s cannot record ranges of time" % self.interface)
+
+        return self.interface._get_recorded_range(start_time, stop_time, **self.params)
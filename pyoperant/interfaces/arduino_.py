@@ -2,22 +2,239 @@ import sys
 import time
 import datetime
 import serial
+import struct
 import logging
 import random
+import queue
+import threading
+import collections
 from unittest import mock
 
+import numpy as np
+
 from pyoperant.interfaces import base_
 from pyoperant import utils, InterfaceError
 from pyoperant.events import events
 
 logger = logging.getLogger(__name__)
 
+# First byte of an edge packet pushed by the device while streaming
+EDGE_MARKER = 0xFE
+
+# Framed protocol (version 2). A frame is FRAME_SYNC, length, sequence,
+# command, payload (length bytes) and a crc8 over everything after the sync
+# byte. Replies carry the request's sequence number and its command with
+# REPLY_FLAG set. See src/operant_serial/operant_serial.ino.
+PROTOCOL_VERSION = 2
+FRAME_SYNC = 0xA5
+REPLY_FLAG = 0x80
+CMD_EDGE = 8
+CMD_HELLO = 9
+CMD_PULSE = 10
+CMD_PATTERN = 11
+CMD_OUTPUT_DONE = 12
+CMD_CONFIG_INPUT = 13
+CMD_PING = 14
+CMD_POLL_INPUT = 15
+CMD_NAK = 0x7F
+FRAME_ERRORS = {1: "bad crc",
+                2: "unknown command",
+                3: "bad payload length",
+                4: "no free output timer",
+                5: "no free input filter"}
+# Flags for CMD_CONFIG_INPUT
+FILTER_SUPPRESS_LONGPRESS = 1
+FILTER_ACTIVE_LOW = 2
+
+
+def crc8(data, crc=0):
+    """ CRC-8 with polynomial 0x07, matching crc8() in the arduino sketch """
+
+    for byte in bytearray(data):
+        crc ^= byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def make_frame(seq, cmd, payload=b""):
+    """ Packs a command and its payload into a version 2 frame """
+
+    body = bytes(bytearray([len(payload), seq, cmd])) + bytes(payload)
+    return bytes(bytearray([FRAME_SYNC])) + body + bytes(bytearray([crc8(body)]))
+
+
+class PendingReply(object):
+    """ A request sent with the framed protocol that is waiting for its reply.
+    Several of these can be outstanding at once.
+
+    Attributes
+    ----------
+    seq: int
+        The sequence number of the request
+    cmd: int
+        The command of the request
+    payload: bytes
+        The payload of the reply, once it has arrived
+    """
+
+    def __init__(self, seq, cmd):
+
+        self.seq = seq
+        self.cmd = cmd
+        self.payload = None
+        self.error = None
+        self.sent = None
+        self.received = None
+        self._done = threading.Event()
+
+    def set(self, payload=None, error=None):
+
+        self.received = time.time()
+        self.payload = payload
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """ Block until the reply arrives and return its payload
+
+        Raises
+        ------
+        ArduinoException
+            The reply did not arrive in time or the device rejected the request
+        """
+
+        if not self._done.wait(timeout):
+            raise ArduinoException("Timed out waiting for a reply to command %d (sequence %d)" % (self.cmd, self.seq))
+        if self.error is not None:
+            raise ArduinoException("Device rejected command %d (sequence %d): %s" % (self.cmd, self.seq, self.error))
+        return self.payload
+
+
+# A transition on an input channel. level is the raw pin level (before any
+# inversion) and device_time is the device's micros() counter at the
+# transition. time is the host datetime of the transition, converted from
+# device_time when the clocks are synchronized and otherwise the time the edge
+# was received. uncertainty is the error bound of time in seconds, or None
+# when it is unknown.
+Edge = collections.namedtuple("Edge", ["channel", "level", "device_time", "time",
+                                       "uncertainty"])
+Edge.__new__.__defaults__ = (None,)
+
+
+class ClockSync(object):
+    """ Estimates the mapping from the device's micros() counter to host time
+    from ping exchanges, NTP style. Each exchange gives an offset between the
+    clocks, assuming the reply took as long to arrive as the request, with an
+    error bound of half the round trip time. Queueing delays only ever make
+    round trips longer, so only the exchange with the shortest round trip of
+    each burst is kept. A line fit over the kept exchanges gives the offset
+    and the drift between the clocks.
+
+    Parameters
+    ----------
+    history: int
+        The number of bursts the fit is made over (default 16)
+
+    Attributes
+    ----------
+    offset: float
+        Host time minus device time, in seconds, at the latest burst
+    drift: float
+        Rate at which the offset changes, in seconds per second of device time
+    uncertainty: float
+        Estimated error bound of converted times, in seconds
+    """
+
+    # micros() wraps around after 2 ** 32 microseconds (about 71 minutes)
+    _wrap = 2 ** 32
+
+    def __init__(self, history=16):
+
+        self.history = history
+        self._samples = collections.deque(maxlen=history)
+        self._last_device_time = None
+        self._lock = threading.Lock()
+        self.offset = None
+        self.drift = 0.0
+        self.uncertainty = None
+
+    @property
+    def synchronized(self):
+
+        return self.offset is not None
+
+    def unwrap(self, device_time):
+        """ Convert a 32 bit micros() value to seconds, choosing the wrap that
+        puts it closest to the latest ping
+        """
+
+        if self._last_device_time is None:
+            return device_time / 1e6
+        reference = self._last_device_time * 1e6
+        wraps = round((reference - device_time) / self._wrap)
+        return (device_time + wraps * self._wrap) / 1e6
+
+    def add_burst(self, exchanges, asymmetry=0.0):
+        """ Update the estimate from a burst of ping exchanges
+
+        Parameters
+        ----------
+        exchanges: list
+            (sent, device_time, received) tuples, where sent and received are
+            host times in seconds and device_time is the raw micros() value
+        asymmetry: float
+            How much longer, in seconds, the reply takes to arrive than the
+            request (default 0)
+        """
+
+        if len(exchanges) == 0:
+            return
+        sent, device_time, received = min(exchanges, key=lambda ex: ex[2] - ex[0])
+        with self._lock:
+            device_time = self.unwrap(device_time)
+            self._last_device_time = device_time
+            offset = (sent + received - asymmetry) / 2.0 - device_time
+            self._samples.append((device_time, offset, received - sent))
+            self._fit()
+
+    def _fit(self):
+
+        device_times, offsets, rtts = [np.array(ss) for ss in zip(*self._samples)]
+        self._reference = device_times[-1]
+        if len(self._samples) > 1:
+            self.drift, self.offset = np.polyfit(device_times - self._reference, offsets, 1)
+            residuals = offsets - (self.offset + self.drift * (device_times - self._reference))
+            spread = np.sqrt(np.mean(residuals ** 2))
+        else:
+            self.drift, self.offset = 0.0, offsets[0]
+            spread = 0.0
+        self.drift, self.offset = float(self.drift), float(self.offset)
+        self.uncertainty = float(rtts.min() / 2.0 + spread)
+
+    def to_host(self, device_time):
+        """ Convert a raw micros() value to host time
+
+        Returns
+        -------
+        (float, float):
+            host time in seconds since the epoch, and its uncertainty in
+            seconds. (None, None) if no burst has been recorded yet.
+        """
+
+        with self._lock:
+            if not self.synchronized:
+                return None, None
+            device_time = self.unwrap(device_time)
+            offset = self.offset + self.drift * (device_time - self._reference)
+            return device_time + offset, self.uncertainty
+
 # TODO: Smart find arduinos using something like this: http://stackoverflow.com/questions/19809867/how-to-check-if-serial-port-is-already-open-by-another-process-in-linux-using
 # TODO: Attempt to reconnect device if it can't be reached
 # TODO: Allow device to be connected to through multiple python instances. This kind of works but needs to be tested thoroughly.
 
 class ArduinoInterface(base_.BaseInterface):
-    """ Creates a pyserial interface to communicate with an Arduino via the serial connection. Communication is through two byte messages where the first byte specifies the channel and the second byte specifies the action.
+    """ Creates a pyserial interface to communicate with an Arduino via the serial connection. With the legacy protocol, communication is through two byte messages where the first byte specifies the channel and the second byte specifies the action.
     Valid actions are:
     0. Read input value
     1. Set output to ON
@@ -25,6 +242,19 @@ class ArduinoInterface(base_.BaseInterface):
     3. Sets channel as an output
     4. Sets channel as an input
     5. Sets channel as an input with a pullup resistor (basically inverts the input values)
+    6. Read all configured channels at once. The reply is a length byte followed by a bitmask of channel values
+    7. Enable (channel byte 1) or disable (channel byte 0) edge streaming
+    9. Switch to the framed protocol
+
+    In streaming mode the device pushes a 7 byte packet for every transition on an input channel: a marker byte (0xFE), the channel, the new level and the device's micros() timestamp as 4 little-endian bytes. A background thread decodes these into a queue of edges per channel. Reads are then served from the latest reported levels and polling blocks on the edge queue instead of querying the device in a loop.
+
+    When the firmware supports it, open() switches the device to the framed protocol (version 2). Each frame carries a length, a sequence number and a crc8, so several requests can be in flight at once (see _send) and replies are matched to their requests by a background thread. The framed commands use the same numbers as the legacy actions. Older firmware does not answer the switch request, in which case the legacy protocol is used.
+
+    The framed protocol adds firmware-timed outputs: pulses (command 10) and blink patterns (command 11) run on the device's clock, so their timing does not depend on the host. Writing to a channel cancels any pulse or pattern on it.
+
+    Inputs can also be debounced and have long presses suppressed by the firmware (command 13), configured through _config_read. With the legacy protocol both are handled on the host instead, which needs the host to keep reading the channel.
+
+    With the framed protocol, a background thread also pings the device every sync_interval seconds (command 14) to keep a ClockSync estimate of how the device's micros() counter maps to host time. Streamed edges are then stamped with the time of the transition on the device, and its uncertainty, instead of the time they reached the host.
 
     Parameters
     ----------
@@ -32,6 +262,12 @@ class ArduinoInterface(base_.BaseInterface):
         The address of the device on the local system (e.g. /dev/tty.usbserial)
     baud_rate: int
         The baud (bits/second) rate for serial communication. If this is changed, then it also needs to be changed in the arduino project code.
+    stream: bool
+        Whether to start edge streaming as soon as the device is opened (default False)
+    protocol: int
+        Protocol version to use. 1 forces the legacy protocol, 2 requires the framed protocol and None (default) uses the framed protocol if the firmware supports it.
+    sync_interval: float
+        Time, in seconds, between clock synchronizations. None disables clock synchronization (default 10).
 
     Attributes
     ----------
@@ -41,6 +277,12 @@ class ArduinoInterface(base_.BaseInterface):
         The baud (bits/second) rate for serial communication. If this is changed, then it also needs to be changed in the arduino project code.
     device: serial device
 
+    protocol: int
+        The protocol version in use after opening the device
+    streaming: bool
+        Whether the device is currently pushing edges to the host
+    clock: ClockSync
+        The current estimate of the device clock
     inputs: list
 
     output: list
@@ -62,25 +304,70 @@ class ArduinoInterface(base_.BaseInterface):
     dev._config_read(channel=4)
     # Read from that input
     dev._read_bool(channel=4)
+
+    # Read several configured channels in a single round trip
+    dev._read_bool_many([4, 8])
+
+    # Have the device push input transitions instead of polling for them
+    dev.start_streaming()
+    dev._poll(channel=4, timeout=10)
+
+    # Set channel 8 True for 2 seconds, timed by the firmware
+    dev._pulse_bool(channel=8, duration=2.0)
+    # Blink channel 8 every 100 ms for 1 second
+    dev._pattern_bool(channel=8, on_duration=0.1, off_duration=0.1, duration=1.0)
     """
 
     _default_state = dict(invert=False,
                           held=False,
+                          level=0,
+                          debounce=0,
+                          filtered=False,
+                          suppress=False,
+                          on_done=None,
                           )
 
-    def __init__(self, device_name, baud_rate=19200, *args, **kwargs):
+    # Serial read timeout used by the reader thread so that it can notice
+    # when it should stop
+    _reader_timeout = 0.1
+    # Time to wait for the firmware to answer a request to switch protocols
+    _negotiate_timeout = 0.5
+    # Time to wait for the reply to a framed request
+    _reply_timeout = 1.0
+    # Number of pings in each clock synchronization burst
+    _sync_pings = 8
+
+    def __init__(self, device_name, baud_rate=19200, stream=False,
+                 protocol=None, sync_interval=10.0, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.device_name = device_name
         self.baud_rate = baud_rate
         self.device = None
+        self._requested_protocol = protocol
+        self.protocol = None
 
         self.read_params = ('channel', 'invert')
         self._state = dict()
+        self._edges = dict()
         self.inputs = []
         self.outputs = []
 
+        self.streaming = False
+        self._reader_thread = None
+        self._reader_stop = None
+        self._send_lock = threading.Lock()
+        self._pending = dict()
+        self._seq = 0
+
+        self.sync_interval = sync_interval
+        self.clock = ClockSync()
+        self._sync_thread = None
+        self._sync_stop = None
+
         self.open()
+        if stream:
+            self.start_streaming()
 
     def __str__(self):
 
@@ -104,15 +391,350 @@ class ArduinoInterface(base_.BaseInterface):
         logger.debug("Waiting for device to open")
         self.device.readline()
         self.device.flushInput()
-        logger.info("Successfully opened device %s" % self)
+
+        self.protocol = self._negotiate(self._requested_protocol)
+        if self.protocol >= 2:
+            self._start_reader(self._run_frame_reader)
+            if self.sync_interval is not None:
+                self.sync_clock()
+                self._start_clock_sync()
+        logger.info("Successfully opened device %s using protocol version %d" % (self, self.protocol))
 
     def close(self):
         ''' Close a serial connection for the device '''
         if not sys.is_finalizing():
             logger.debug("Closing %s" % self)
+        if self.streaming:
+            self.stop_streaming()
+        self._stop_clock_sync()
+        self._stop_reader()
         self.device.close()
 
-    def _config_read(self, channel, invert=False, **kwargs):
+    def _negotiate(self, protocol=None):
+        ''' Ask the firmware to switch to the framed protocol. Returns the
+        protocol version in use.
+
+        Parameters
+        ----------
+        protocol: int
+            1 skips negotiation, 2 raises an ArduinoException if the firmware
+            does not answer and None falls back to the legacy protocol.
+        '''
+
+        if protocol == 1:
+            return 1
+
+        self.device.timeout = self._negotiate_timeout
+        self.device.write(self._make_arg(PROTOCOL_VERSION, CMD_HELLO))
+        frame = self._read_frame()
+        self.device.timeout = 5
+        if frame is not None and frame[1] == CMD_HELLO | REPLY_FLAG:
+            return bytearray(frame[2])[0]
+
+        if protocol is not None:
+            raise ArduinoException("Device %s does not support protocol version %d" % (self.device_name, protocol))
+        logger.debug("Device %s did not answer protocol negotiation. Using the legacy protocol" % self.device_name)
+        self.device.flushInput()
+        return 1
+
+    def _start_reader(self, target):
+        ''' Start a background thread that reads everything the device sends '''
+
+        self.device.timeout = self._reader_timeout
+        self._reader_stop = threading.Event()
+        self._reader_thread = threading.Thread(target=target,
+                                               args=(self._reader_stop,),
+                                               name="ArduinoReader(%s)" % self.device_name)
+        self._reader_thread.daemon = True
+        self._reader_thread.start()
+
+    def _stop_reader(self):
+        ''' Stop and join the background reader thread, if it is running '''
+
+        if self._reader_thread is None:
+            return
+        self._reader_stop.set()
+        self._reader_thread.join()
+        self._reader_thread = None
+        self.device.timeout = 5
+
+    def _start_clock_sync(self):
+        ''' Start a background thread that synchronizes the clocks every
+        sync_interval seconds
+        '''
+
+        self._sync_stop = threading.Event()
+        self._sync_thread = threading.Thread(target=self._run_clock_sync,
+                                             args=(self._sync_stop,),
+                                             name="ArduinoClockSync(%s)" % self.device_name)
+        self._sync_thread.daemon = True
+        self._sync_thread.start()
+
+    def _stop_clock_sync(self):
+        ''' Stop and join the clock synchronization thread, if it is running '''
+
+        if self._sync_thread is None:
+            return
+        self._sync_stop.set()
+        self._sync_thread.join()
+        self._sync_thread = None
+
+    def _run_clock_sync(self, stop_signal):
+        ''' Runs in a separate thread, synchronizing the clocks until
+        stop_signal is set
+        '''
+
+        while not stop_signal.wait(self.sync_interval):
+            try:
+                self.sync_clock()
+            except ArduinoException as e:
+                logger.warning("Clock synchronization with %s failed: %s" % (self, e))
+
+    def sync_clock(self, n_pings=None):
+        ''' Ping the device n_pings times in a row and update the clock
+        estimate from the exchange with the shortest round trip
+
+        Returns
+        -------
+        ClockSync:
+            the updated clock estimate
+        '''
+
+        if self.protocol < 2:
+            raise ArduinoException("Device %s must use the framed protocol to synchronize clocks" % self)
+
+        if n_pings is None:
+            n_pings = self._sync_pings
+        # The device stamps the ping once the whole request has arrived, and
+        # the reply is longer than the request, so the reply takes longer to
+        # arrive by its extra bytes (10 bits each on the wire)
+        extra_bytes = len(make_frame(0, CMD_PING, b"\x00" * 4)) - len(make_frame(0, CMD_PING))
+        exchanges = list()
+        for ii in range(n_pings):
+            pending = self._send(CMD_PING)
+            device_time = struct.unpack("<I", pending.wait(self._reply_timeout))[0]
+            exchanges.append((pending.sent, device_time, pending.received))
+        self.clock.add_burst(exchanges, asymmetry=extra_bytes * 10.0 / self.baud_rate)
+        logger.debug("Synchronized clock of %s: offset %.6f s, drift %.2e, uncertainty %.6f s" % (self, self.clock.offset, self.clock.drift, self.clock.uncertainty))
+
+        return self.clock
+
+    def device_to_host(self, device_time):
+        ''' Convert a device micros() value to a host datetime
+
+        Returns
+        -------
+        (datetime, float):
+            the host time and its uncertainty in seconds. Without a clock
+            estimate this is the current time and None.
+        '''
+
+        host_time, uncertainty = self.clock.to_host(device_time)
+        if host_time is None:
+            return datetime.datetime.now(), None
+        return datetime.datetime.fromtimestamp(host_time), uncertainty
+
+    def _read_frame(self):
+        ''' Read a single frame from the device
+
+        Returns
+        -------
+        (seq, cmd, payload) or None if nothing complete and valid arrived
+        before the serial timeout
+        '''
+
+        while True:
+            sync = self.device.read(1)
+            if len(sync) == 0:
+                return None
+            if ord(sync) == FRAME_SYNC:
+                break
+
+        header = self.device.read(3)
+        if len(header) != 3:
+            logger.warning("Incomplete frame received from %s" % self)
+            return None
+        length, seq, cmd = bytearray(header)
+        rest = self.device.read(length + 1)
+        if len(rest) != length + 1:
+            logger.warning("Incomplete frame received from %s" % self)
+            return None
+        payload, crc = rest[:-1], bytearray(rest[-1:])[0]
+        if crc8(header + payload) != crc:
+            logger.warning("Dropping frame with a bad crc from %s" % self)
+            return None
+
+        return seq, cmd, payload
+
+    def _run_frame_reader(self, stop_signal):
+        ''' Runs in a separate thread, matching framed replies to pending
+        requests and decoding pushed edges until stop_signal is set
+        '''
+
+        while not stop_signal.is_set():
+            try:
+                frame = self._read_frame()
+            except serial.SerialException:
+                continue
+            if frame is not None:
+                self._dispatch_frame(*frame)
+
+    def _dispatch_frame(self, seq, cmd, payload):
+        ''' Route a frame received from the device '''
+
+        if cmd == CMD_EDGE:
+            channel, level, device_time = struct.unpack("<BBI", payload)
+            edge_time, uncertainty = self.device_to_host(device_time)
+            self._handle_edge(Edge(channel=channel,
+                                   level=level,
+                                   device_time=device_time,
+                                   time=edge_time,
+                                   uncertainty=uncertainty))
+            return
+        if cmd == CMD_OUTPUT_DONE:
+            channel, level = bytearray(payload)
+            if channel in self._state:
+                state = self._state[channel]
+                state["level"] = level
+                on_done, state["on_done"] = state["on_done"], None
+                if on_done is not None:
+                    on_done(level == 1)
+            return
+
+        with self._send_lock:
+            pending = self._pending.pop(seq, None)
+
+        if cmd == CMD_NAK:
+            error = FRAME_ERRORS.get(bytearray(payload)[0], "unknown error")
+            logger.warning("Device %s rejected sequence %d: %s" % (self, seq, error))
+            if pending is not None:
+                pending.set(error=error)
+        elif pending is None:
+            logger.debug("Dropping unexpected reply to sequence %d from %s" % (seq, self))
+        else:
+            pending.set(payload)
+
+    def _send(self, cmd, payload=b""):
+        ''' Send a framed request without waiting for its reply
+
+        Parameters
+        ----------
+        cmd: int
+            the command to send
+        payload: bytes
+            the command's payload
+
+        Returns
+        -------
+        PendingReply:
+            call its wait() method to block until the reply arrives
+        '''
+
+        with self._send_lock:
+            # Sequence number 0 is reserved for frames pushed by the device
+            self._seq = self._seq % 255 + 1
+            pending = PendingReply(self._seq, cmd)
+            self._pending[self._seq] = pending
+            pending.sent = time.time()
+            self.device.write(make_frame(self._seq, cmd, payload))
+
+        return pending
+
+    def _request(self, cmd, payload=b""):
+        ''' Send a framed request and block until its reply arrives '''
+
+        return self._send(cmd, payload).wait(self._reply_timeout)
+
+    def _command(self, channel, action):
+        ''' Send an action for a channel without waiting for a reply. Returns
+        something truthy if the message was sent.
+        '''
+
+        if self.protocol >= 2:
+            return self._send(action, bytes(bytearray([channel])))
+        else:
+            return self.device.write(self._make_arg(channel, action))
+
+    def start_streaming(self):
+        ''' Ask the device to push input transitions and start a thread that
+        decodes them into per-channel edge queues
+        '''
+
+        if self.streaming:
+            return
+
+        logger.debug("Starting edge streaming on %s" % self)
+        # The device only reports the inputs that are HIGH on its next loop,
+        # so seed the cached levels from a read. Otherwise an inverted input
+        # at rest would read as pressed until that report arrives.
+        if len(self.inputs) > 0:
+            levels = self._request_bool_many(self.inputs)
+            for channel, level in zip(self.inputs, levels):
+                self._state[channel]["level"] = level
+
+        if self.protocol >= 2:
+            self._request(7, b"\x01")
+            self.streaming = True
+        else:
+            self.device.flushInput()
+            self.device.write(self._make_arg(1, 7))
+            self.streaming = True
+            self._start_reader(self._run_reader)
+
+    def stop_streaming(self):
+        ''' Stop the device pushing input transitions and join the reader
+        thread
+        '''
+
+        if not self.streaming:
+            return
+
+        logger.debug("Stopping edge streaming on %s" % self)
+        if self.protocol >= 2:
+            self._request(7, b"\x00")
+        else:
+            self.device.write(self._make_arg(0, 7))
+            self._stop_reader()
+            self.device.flushInput()
+        self.streaming = False
+
+    def _run_reader(self, stop_signal):
+        ''' Runs in a separate thread, decoding legacy edge packets from the
+        device until stop_signal is set
+        '''
+
+        while not stop_signal.is_set():
+            try:
+                marker = self.device.read(1)
+            except serial.SerialException:
+                continue
+            if len(marker) == 0:
+                continue
+            if ord(marker) != EDGE_MARKER:
+                logger.debug("Skipping unexpected byte %d from %s" % (ord(marker), self))
+                continue
+
+            packet = self.device.read(6)
+            if len(packet) != 6:
+                logger.warning("Incomplete edge packet received from %s" % self)
+                continue
+            channel, level, device_time = struct.unpack("<BBI", packet)
+            self._handle_edge(Edge(channel=channel,
+                                   level=level,
+                                   device_time=device_time,
+                                   time=datetime.datetime.now()))
+
+    def _handle_edge(self, edge):
+        ''' Updates the cached level of the channel and queues the edge '''
+
+        if edge.channel not in self._edges:
+            return
+
+        self._state[edge.channel]["level"] = edge.level
+        self._edges[edge.channel].put(edge)
+
+    def _config_read(self, channel, invert=False, debounce_ms=0,
+                     suppress_longpress=False, **kwargs):
         ''' Configure the channel to act as a boolean input
 
         Parameters
@@ -121,6 +743,10 @@ class ArduinoInterface(base_.BaseInterface):
             the channel number to configure
         invert: bool
             the channel should be configured in pullup mode. On the arduino this has the effect of returning HIGH when unpressed and LOW when pressed. The returned value will have to be inverted.
+        debounce_ms: int
+            the time, in milliseconds, a new level has to hold before it is reported (default 0)
+        suppress_longpress: bool
+            if True, the firmware reports each press to polling only once, so _poll does not have to watch for the release. Reads, multi-channel reads and streamed edges still return the held level. The legacy protocol leaves this to _poll.
 
         Returns
         -------
@@ -129,9 +755,9 @@ class ArduinoInterface(base_.BaseInterface):
 
         logger.debug("Configuring %s, channel %d as input" % (self.device_name, channel))
         if invert is False:
-            self.device.write(self._make_arg(channel, 4))
+            self._command(channel, 4)
         else:
-            self.device.write(self._make_arg(channel, 5))
+            self._command(channel, 5)
 
         if channel in self.outputs:
             self.outputs.remove(channel)
@@ -140,6 +766,22 @@ class ArduinoInterface(base_.BaseInterface):
 
         self._state.setdefault(channel, self._default_state.copy())
         self._state[channel]["invert"] = invert
+        self._state[channel]["debounce"] = debounce_ms / 1000.0
+        self._edges.setdefault(channel, queue.Queue())
+
+        if self.protocol >= 2:
+            if debounce_ms or suppress_longpress or self._state[channel]["filtered"]:
+                flags = 0
+                if suppress_longpress:
+                    flags |= FILTER_SUPPRESS_LONGPRESS
+                if invert:
+                    flags |= FILTER_ACTIVE_LOW
+                self._request(CMD_CONFIG_INPUT,
+                              struct.pack("<BHB", channel, debounce_ms, flags))
+                self._state[channel]["filtered"] = bool(debounce_ms or suppress_longpress)
+                self._state[channel]["suppress"] = bool(suppress_longpress)
+        elif debounce_ms:
+            logger.debug("Debouncing %s, channel %d on the host" % (self.device_name, channel))
 
     def _config_write(self, channel, **kwargs):
         """ Configure the channel to act as a boolean output
@@ -155,14 +797,19 @@ class ArduinoInterface(base_.BaseInterface):
         """
 
         logger.debug("Configuring %s, channel %d as output" % (self.device_name, channel))
-        self.device.write(self._make_arg(channel, 3))
+        self._command(channel, 3)
         if channel in self.inputs:
             self.inputs.remove(channel)
         if channel not in self.outputs:
             self.outputs.append(channel)
         self._state.setdefault(channel, self._default_state.copy())
+        # The firmware drops any input filter when a pin becomes an output
+        self._state[channel]["filtered"] = False
+        self._state[channel]["suppress"] = False
+        self._state[channel]["debounce"] = 0
 
-    def _read_bool(self, channel, invert=False, event=None, **kwargs):
+    def _read_bool(self, channel, invert=False, event=None, polling=False,
+                   **kwargs):
         """ Read a value from the specified channel
 
         Parameters
@@ -171,6 +818,10 @@ class ArduinoInterface(base_.BaseInterface):
             the channel from which to read
         invert: bool
             whether or not to invert the read value
+        polling: bool
+            whether the read is part of _poll, in which case the firmware
+            reports a press on a channel configured with suppress_longpress
+            only once
 
         Returns
         -------
@@ -186,14 +837,53 @@ class ArduinoInterface(base_.BaseInterface):
         if channel not in self._state:
             raise InterfaceError("Channel %d is not configured on device %s" % (channel, self.device_name))
 
+        if self.streaming:
+            # The reader thread keeps the latest level of every input
+            v = self._state[channel]["level"]
+        else:
+            v = self._request_bool(channel, polling=polling)
+            v = self._debounce_on_host(channel, v, invert)
+
+        # logger.debug("Read value of %d from channel %d on %s" % (v, channel, self))
+        if v in [0, 1]:
+            if invert:
+                v = 1 - v
+            value = v == 1
+            if value:
+                events.write(event)
+            return value
+        else:
+            logger.error("Device %s returned unexpected value of %d on reading channel %d" % (self, v, channel))
+            # raise InterfaceError('Could not read from serial device "%s", channel %d' % (self.device, channel))
+
+    def _debounce_on_host(self, channel, v, invert):
+        """ Without firmware filtering, a pressed reading only counts if the
+        channel still reads pressed once the debounce window has passed
+        """
+
+        debounce = self._state[channel]["debounce"]
+        if (debounce == 0) or self._state[channel]["filtered"]:
+            return v
+        if v != int(not invert): # Not pressed
+            return v
+
+        utils.wait(debounce)
+        return self._request_bool(channel)
+
+    def _request_bool(self, channel, polling=False):
+        """ Query the device for the value of a single channel """
+
+        if self.protocol >= 2:
+            cmd = CMD_POLL_INPUT if polling else 0
+            return bytearray(self._request(cmd, bytes(bytearray([channel]))))[0]
+
         if self.device.inWaiting() > 0: # There is currently data in the input buffer
             self.device.flushInput()
         self.device.write(self._make_arg(channel, 0))
         # Also need to make sure self.device.read() returns something that ord can work with. Possibly except TypeError
         while True:
             try:
-                v = ord(self.device.read())
-                break
+                return ord(self.device.read())
                 # serial.SerialException("Testing")
             except serial.SerialException:
             # This is to make it robust in case it accidentally disconnects or you try to access the arduino in
@@ -202,17 +892,171 @@ class ArduinoInterface(base_.BaseInterface):
             except TypeError:
                 ArduinoException("Could not read from arduino device")
 
-        # logger.debug("Read value of %d from channel %d on %s" % (v, channel, self))
-        if v in [0, 1]:
-            if invert:
+    def _read_bool_many(self, channels, event=None, **kwargs):
+        """ Read the values of several channels with a single request to the
+        device. Each value is inverted according to how its channel was
+        configured.
+
+        Parameters
+        ----------
+        channels: list
+            the channels from which to read
+        event: dict
+            a dictionary of event information to emit if any value is True
+
+        Returns
+        -------
+        list of bool:
+            the values read from the hardware, in the order of channels
+
+        Raises
+        ------
+        ArduinoException
+            The device did not reply with a complete bitmask
+        """
+
+        for channel in channels:
+            if channel not in self._state:
+                raise InterfaceError("Channel %d is not configured on device %s" % (channel, self.device_name))
+
+        if self.streaming:
+            levels = [self._state[channel]["level"] for channel in channels]
+        else:
+            levels = self._request_bool_many(channels)
+
+        values = list()
+        for channel, v in zip(channels, levels):
+            if self._state[channel]["invert"]:
                 v = 1 - v
-            value = v == 1
-            if value:
-                events.write(event)
-            return value
+            values.append(v == 1)
+
+        if any(values):
+            events.write(event)
+
+        return values
+
+    def _request_bool_many(self, channels):
+        """ Query the device for the bitmask of all configured channels and
+        return the levels of the requested channels
+        """
+
+        if self.protocol >= 2:
+            mask = bytearray(self._request(6))
+            nbytes = len(mask)
         else:
-            logger.error("Device %s returned unexpected value of %d on reading channel %d" % (self, v, channel))
-            # raise InterfaceError('Could not read from serial device "%s", channel %d' % (self.device, channel))
+            if self.device.inWaiting() > 0: # There is currently data in the input buffer
+                self.device.flushInput()
+            self.device.write(self._make_arg(0, 6))
+
+            nbytes = self.device.read()
+            if len(nbytes) == 0:
+                raise ArduinoException("Device %s did not respond to a multi-channel read. Is the firmware up to date?" % self)
+            nbytes = ord(nbytes)
+            mask = bytearray(self.device.read(nbytes))
+            if len(mask) != nbytes:
+                raise ArduinoException("Device %s returned %d of %d bytes on a multi-channel read" % (self, len(mask), nbytes))
+
+        levels = list()
+        for channel in channels:
+            byte_index, bit = divmod(channel, 8)
+            if byte_index >= nbytes:
+                raise ArduinoException("Channel %d is outside of the bitmask returned by %s" % (channel, self))
+            levels.append((mask[byte_index] >> bit) & 1)
+
+        return levels
+
+    def _poll(self, channel=None, invert=False, last_value=False,
+              suppress_longpress=False, timeout=None, wait=None, event=None,
+              *args, **kwargs):
+        """ Waits for the boolean input to become True. When streaming, this
+        blocks on the channel's edge queue. Otherwise it falls back to
+        repeatedly reading the channel (see base_.BaseInterface._poll).
+
+        Parameters
+        ----------
+        channel: int
+            the channel to poll
+        invert: bool
+            whether or not to invert the read value
+        last_value: bool
+            if the last read value was True. Necessary to suppress longpresses
+        suppress_longpress: bool
+            if True, a channel that is still True since the last call is ignored until it is released and pressed again.
+        timeout: float
+            the time, in seconds, until polling times out. Defaults to no timeout.
+        wait: float
+            the time, in seconds, to wait between subsequent reads when not streaming
+        event: dict
+            a dictionary of event information to emit when the input becomes True
+
+        Returns
+        -------
+        timestamp of True read or None if timed out
+        """
+
+        if not self.streaming:
+            if (channel in self._state) and self._state[channel]["suppress"]:
+                # The firmware already reports each press only once
+                suppress_longpress = False
+            return super()._poll(channel=channel, invert=invert,
+                                 last_value=last_value,
+                                 suppress_longpress=suppress_longpress,
+                                 timeout=timeout, wait=wait, event=event,
+                                 polling=True, *args, **kwargs)
+
+        if channel not in self._edges:
+            raise InterfaceError("Channel %d is not configured on device %s" % (channel, self.device_name))
+
+        logger.debug("Begin waiting for edges on %s, channel %d" % (self, channel))
+        edges = self._edges[channel]
+        # Only transitions from here on count, so drop anything stale
+        while not edges.empty():
+            edges.get_nowait()
+
+        value = bool(self._state[channel]["level"]) != invert
+        if value and ((last_value is False) or (suppress_longpress is False)):
+            logger.debug("Input detected. Returning")
+            events.write(event)
+            return datetime.datetime.now()
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.debug("Polling timed out. Returning")
+                    return None
+            try:
+                edge = edges.get(timeout=remaining)
+            except queue.Empty:
+                logger.debug("Polling timed out. Returning")
+                return None
+
+            if bool(edge.level) != invert:
+                if not self._edge_settled(channel, edges):
+                    # The press was released within the debounce window
+                    continue
+                logger.debug("Input detected. Returning")
+                events.write(event, time=edge.time, uncertainty=edge.uncertainty)
+                return edge.time
+
+    def _edge_settled(self, channel, edges):
+        """ Without firmware filtering, a press edge only counts if the channel
+        is not released within its debounce window. The release edge is
+        consumed, since polling only acts on presses.
+        """
+
+        debounce = self._state[channel]["debounce"]
+        if (debounce == 0) or self._state[channel]["filtered"]:
+            return True
+        try:
+            edges.get(timeout=debounce)
+        except queue.Empty:
+            return True
+        return False
 
     def _write_bool(self, channel, value, event=None, **kwargs):
         '''Write a value to the specified channel
@@ -226,15 +1070,106 @@ class ArduinoInterface(base_.BaseInterface):
 
         logger.debug("Writing %s to device %s, channel %d" % (value, self, channel))
         events.write(event)
+        # Writing cancels any timer on the channel, which then never reports
+        # being done
+        self._state[channel]["on_done"] = None
         if value:
-            s = self.device.write(self._make_arg(channel, 1))
+            s = self._command(channel, 1)
         else:
-            s = self.device.write(self._make_arg(channel, 2))
+            s = self._command(channel, 2)
         if s:
+            # Outputs are not streamed, so remember what was written to them
+            self._state[channel]["level"] = 1 if value else 0
             return value
         else:
             raise InterfaceError('Could not write to serial device %s, channel %d' % (self.device, channel))
 
+    @property
+    def can_pulse_bool(self):
+        """
+        If the device can time pulses and blink patterns on its own. Requires the framed protocol.
+        """
+
+        return self.protocol >= 2
+
+    def _pulse_bool(self, channel, duration, event=None, on_done=None, **kwargs):
+        """ Set a channel True for a fixed duration, timed by the firmware.
+        Returns as soon as the device has accepted the pulse.
+
+        Parameters
+        ----------
+        channel: int
+            the channel to pulse
+        duration: float
+            the time, in seconds, the channel stays True
+        event: dict
+            a dictionary of event information to emit just before the pulse
+        on_done: callable
+            called from the reader thread with the channel's final value when
+            the device reports that the pulse has ended. It is not called if
+            the channel is written to before then.
+
+        Returns
+        -------
+        True if the device accepted the pulse
+        """
+
+        if channel not in self._state:
+            raise InterfaceError("Channel %d is not configured on device %s" % (channel, self))
+        if not self.can_pulse_bool:
+            raise ArduinoException("Device %s must use the framed protocol for timed outputs" % self)
+
+        logger.debug("Pulsing device %s, channel %d for %.3f seconds" % (self, channel, duration))
+        events.write(event)
+        # Set before the request, since a short pulse can end before its reply
+        self._state[channel]["on_done"] = on_done
+        self._request(CMD_PULSE, struct.pack("<BI", channel, int(round(duration * 1000))))
+        self._state[channel]["level"] = 1
+
+        return True
+
+    def _pattern_bool(self, channel, on_duration, off_duration, duration=None,
+                      event=None, **kwargs):
+        """ Blink a channel, timed by the firmware. The channel starts True and
+        returns to its prior value when the pattern ends. Returns as soon as
+        the device has accepted the pattern.
+
+        Parameters
+        ----------
+        channel: int
+            the channel to blink
+        on_duration: float
+            the time, in seconds, the channel is True in each cycle
+        off_duration: float
+            the time, in seconds, the channel is False in each cycle
+        duration: float
+            the total time, in seconds, of the pattern. If None, the pattern runs until the channel is written to.
+        event: dict
+            a dictionary of event information to emit just before the pattern starts
+
+        Returns
+        -------
+        True if the device accepted the pattern
+        """
+
+        if channel not in self._state:
+            raise InterfaceError("Channel %d is not configured on device %s" % (channel, self))
+        if not self.can_pulse_bool:
+            raise ArduinoException("Device %s must use the framed protocol for timed outputs" % self)
+
+        on_ms = int(round(on_duration * 1000))
+        off_ms = int(round(off_duration * 1000))
+        if not (0 < on_ms <= 0xFFFF and 0 < off_ms <= 0xFFFF):
+            raise ValueError("on_duration and off_duration must be between 1 ms and 65.535 s")
+        duration_ms = 0 if duration is None else max(int(round(duration * 1000)), 1)
+
+        logger.debug("Starting pattern on device %s, channel %d" % (self, channel))
+        events.write(event)
+        self._state[channel]["on_done"] = None
+        self._request(CMD_PATTERN, struct.pack("<BHHI", channel, on_ms, off_ms, duration_ms))
+
+        return True
+
     @staticmethod
     def _make_arg(channel, value):
         """ Turns a channel and boolean value into a 2 byte hex string to be fed to the arduino
@@ -246,6 +1181,7 @@ class ArduinoInterface(base_.BaseInterface):
 
 class MockArduinoInterface(ArduinoInterface):
     def __init__(self, device_name, baud_rate=19200, *args, **kwargs):
+        kwargs.setdefault("protocol", 1)
         super().__init__(device_name, baud_rate, *args, **kwargs)
 
     def open(self):
@@ -272,3 +1208,61 @@ class MockArduinoInterface(ArduinoInterface):
 class ArduinoException(InterfaceError):
 
     pass
+
+
+def benchmark_protocols(device_name, channel=4, n_messages=500,
+                        pipeline_depth=8, baud_rate=19200):
+    """ Measures request throughput for the legacy and framed protocols by
+    repeatedly reading a single input channel.
+
+    Parameters
+    ----------
+    device_name: string
+        The address of the device on the local system
+    channel: int
+        An input channel to read from
+    n_messages: int
+        Number of reads to time for each measurement
+    pipeline_depth: int
+        Number of framed reads kept in flight for the pipelined measurement
+    baud_rate: int
+        The baud rate of the device
+
+    Returns
+    -------
+    dict
+        Messages per second for each protocol and mode
+    """
+
+    results = dict()
+    for protocol in (1, PROTOCOL_VERSION):
+        dev = ArduinoInterface(device_name, baud_rate=baud_rate, protocol=protocol)
+        try:
+            dev._config_read(channel)
+
+            start = time.time()
+            for ii in range(n_messages):
+                dev._read_bool(channel)
+            results["protocol %d sequential" % protocol] = n_messages / (time.time() - start)
+
+            if protocol >= 2:
+                in_flight = collections.deque()
+                payload = bytes(bytearray([channel]))
+                start = time.time()
+                for ii in range(n_messages):
+                    if len(in_flight) >= pipeline_depth:
+                        in_flight.popleft().wait(dev._reply_timeout)
+                    in_flight.append(dev._send(0, payload))
+                while in_flight:
+                    in_flight.popleft().wait(dev._reply_timeout)
+                results["protocol %d pipelined" % protocol] = n_messages / (time.time() - start)
+        finally:
+            dev.close()
+
+    return results
+
+
+if __name__ == "__main__":
+
+    for name, rate in sorted(benchmark_protocols(sys.argv[1]).items()):
+        print("%s: %.1f messages / second" % (name, rate))
@@ -0,0 +1,641 @@
+import os
+import sys
+import tty
+import time
+import heapq
+import queue
+import random
+import select
+import struct
+import logging
+import threading
+import collections
+import ctypes
+import ctypes.util
+
+from pyoperant.interfaces.arduino_ import (EDGE_MARKER, PROTOCOL_VERSION,
+                                           FRAME_SYNC, REPLY_FLAG, CMD_EDGE,
+                                           CMD_HELLO, CMD_PULSE, CMD_PATTERN,
+                                           CMD_OUTPUT_DONE, CMD_CONFIG_INPUT,
+                                           CMD_PING, CMD_POLL_INPUT, CMD_NAK,
+                                           FILTER_SUPPRESS_LONGPRESS,
+                                           FILTER_ACTIVE_LOW, crc8, make_frame,
+                                           benchmark_protocols)
+
+logger = logging.getLogger(__name__)
+
+# Limits and error codes of src/operant_serial/operant_serial.ino
+MAX_PAYLOAD = 32
+MAX_TIMERS = 8
+MAX_FILTERS = 8
+ERROR_CRC = 1
+ERROR_UNKNOWN_COMMAND = 2
+ERROR_BAD_LENGTH = 3
+ERROR_NO_TIMER = 4
+ERROR_NO_FILTER = 5
+
+# inotify events for a file being opened or closed
+IN_CLOSE_WRITE = 0x08
+IN_CLOSE_NOWRITE = 0x10
+IN_OPEN = 0x20
+
+OUTPUT = "output"
+INPUT = "input"
+INPUT_PULLUP = "input_pullup"
+
+# Firmware-timed output on a pin. See OutputTimer in the arduino sketch.
+OutputTimer = collections.namedtuple("OutputTimer", ["toggles", "restore_level",
+                                                     "on_ms", "off_ms",
+                                                     "duration", "started"])
+
+
+def watch_opens(path):
+    """ Returns a non-blocking inotify descriptor that becomes readable
+    whenever path is opened or closed, or None where inotify is unavailable
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_OPEN | IN_CLOSE_WRITE | IN_CLOSE_NOWRITE
+    if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class InputFilter(object):
+    """ Debounce and long press state of an input pin. See InputFilter in the
+    arduino sketch.
+    """
+
+    def __init__(self, debounce_ms, flags, level, now):
+
+        self.debounce_ms = debounce_ms
+        self.flags = flags
+        self.raw_level = level
+        self.level = level
+        # A press that is already held when the filter is set up is not
+        # reported
+        self.reported = level != int(bool(flags & FILTER_ACTIVE_LOW))
+        self.changed_at = now
+
+
+class ArduinoSimulator(object):
+    """ Simulates the operant_serial Arduino firmware on a pseudo-terminal, so
+    that an unmodified ArduinoInterface can open it by path. Both the legacy
+    two byte protocol and the framed protocol are supported, along with edge
+    streaming, firmware-timed outputs, input filters and clock pings.
+
+    Serial timing is modelled in both directions: every byte occupies the line
+    for 10 bit times at baud_rate, and every message is delayed by a further
+    latency, standing in for the USB serial adapter. The device sees a request
+    only once it has fully "arrived", and the host sees a reply only once it
+    has been "transmitted".
+
+    Pecks are scripted as (time, channel, duration) tuples, relative to
+    start(), and/or drawn at random at peck_rate per second on each of
+    peck_channels. press() adds a peck while running. A pecked input reads
+    HIGH, or LOW if it was configured with a pullup.
+
+    A real board resets when the port is opened and prints a banner. On
+    Linux, inotify tells the simulator when the port is opened or closed, and
+    it resets then. Elsewhere it can only tell that the port was closed once
+    nothing has it open, so a port that is closed and immediately reopened may
+    not reset. A pseudo-terminal has no way to tell when the host is ready to
+    read, so the banner is repeated until the host first writes.
+
+    Only works on systems with pseudo-terminals (Linux, macOS).
+
+    Parameters
+    ----------
+    latency: float
+        Time, in seconds, added to every message in each direction (default 0.001)
+    baud_rate: int
+        The simulated baud rate (default 19200)
+    throttle: bool
+        Whether to limit throughput to baud_rate (default True)
+    protocol: int
+        The highest protocol version the simulated firmware speaks. 1 simulates firmware from before the framed protocol.
+    pecks: list
+        (time, channel, duration) tuples of scripted pecks
+    peck_rate: float
+        Mean rate, in pecks per second, of random pecks on each peck channel (default 0)
+    peck_channels: list
+        Channels that receive random pecks (default [4])
+    peck_duration: float
+        Duration, in seconds, of each random peck (default 0.1)
+    n_pins: int
+        Number of digital pins on the simulated board (default 20, like an Uno)
+    seed: int
+        Seed for the random peck stream
+
+    Attributes
+    ----------
+    path: string
+        The pseudo-terminal to pass to ArduinoInterface, once started
+
+    Examples
+    --------
+    sim = ArduinoSimulator(latency=0.002, pecks=[(1.0, 4, 0.1)])
+    sim.start()
+    dev = ArduinoInterface(sim.path)
+    dev._config_read(channel=4)
+    dev._poll(channel=4, timeout=5)
+    dev.close()
+    sim.stop()
+    """
+
+    banner = b"Initialized!\r\n"
+    # Time between loop iterations, standing in for the firmware's loop()
+    _tick = 0.0005
+    # Time between repeats of the banner until the host writes
+    _banner_interval = 0.05
+
+    def __init__(self, latency=0.001, baud_rate=19200, throttle=True,
+                 protocol=PROTOCOL_VERSION, pecks=None, peck_rate=0.0,
+                 peck_channels=(4,), peck_duration=0.1, n_pins=20, seed=None):
+
+        self.latency = latency
+        self.baud_rate = baud_rate
+        self.throttle = throttle
+        self.protocol = protocol
+        self.peck_rate = peck_rate
+        self.peck_channels = list(peck_channels)
+        self.peck_duration = peck_duration
+        self.n_pins = n_pins
+        self.mask_bytes = (n_pins + 7) // 8
+        self._scripted = list(pecks or [])
+        self._random = random.Random(seed)
+
+        self.path = None
+        self._master = None
+        self._watch = None
+        self._thread = None
+        self._writer = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._tx = queue.Queue()
+        self._generation = 0
+        # Which channels are being pecked. This is outside of the board, so
+        # it survives resets.
+        self.pressed = dict()
+        self._reset()
+
+    def __str__(self):
+
+        return "Simulated arduino at %s" % self.path
+
+    def __enter__(self):
+
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+
+        self.stop()
+
+    def start(self):
+        """ Create the pseudo-terminal and start simulating """
+
+        self._master, slave = os.openpty()
+        self.path = os.ttyname(slave)
+        tty.setraw(slave)
+        # Only the host should hold the slave end open, so that closing the
+        # port can be noticed
+        os.close(slave)
+        self._watch = watch_opens(self.path)
+
+        self._started = time.time()
+        with self._lock:
+            self._pecks = list()
+            for at, channel, duration in self._scripted:
+                self._schedule(self._started + at, channel, duration)
+            for channel in self.peck_channels:
+                self._schedule_random(channel, self._started)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="ArduinoSimulator(%s)" % self.path)
+        self._thread.daemon = True
+        self._writer = threading.Thread(target=self._run_writer,
+                                        name="ArduinoSimulatorWriter(%s)" % self.path)
+        self._writer.daemon = True
+        self._thread.start()
+        self._writer.start()
+        logger.debug("Started %s" % self)
+
+    def stop(self):
+        """ Stop simulating and remove the pseudo-terminal """
+
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._tx.put(None)
+        self._thread.join()
+        self._writer.join()
+        self._thread = None
+        self._writer = None
+        os.close(self._master)
+        self._master = None
+        if self._watch is not None:
+            os.close(self._watch)
+            self._watch = None
+        logger.debug("Stopped %s" % self)
+
+    def press(self, channel, duration=None, delay=0.0):
+        """ Peck a channel
+
+        Parameters
+        ----------
+        channel: int
+            The channel to peck
+        duration: float
+            Time, in seconds, the channel stays pecked (default peck_duration)
+        delay: float
+            Time, in seconds, until the peck starts (default now)
+        """
+
+        if duration is None:
+            duration = self.peck_duration
+        with self._lock:
+            self._schedule(time.time() + delay, channel, duration)
+
+    def _schedule(self, at, channel, duration):
+
+        heapq.heappush(self._pecks, (at, channel, True))
+        heapq.heappush(self._pecks, (at + duration, channel, False))
+
+    def _schedule_random(self, channel, after):
+
+        if self.peck_rate > 0:
+            at = after + self._random.expovariate(self.peck_rate)
+            # Random pecks are marked so that the next one is drawn when
+            # this one ends
+            heapq.heappush(self._pecks, (at, channel, None))
+
+    def _reset(self):
+        """ Back to the state of a freshly powered board """
+
+        # Anything still waiting to be transmitted was lost in the reset
+        self._generation += 1
+        self.framed = False
+        self.streaming = False
+        self.modes = dict()
+        self.levels = dict()
+        self.timers = dict()
+        self.filters = dict()
+        self.last_levels = dict()
+        self._connected = False
+        self._greeted = False
+        self._last_banner = 0
+        self._rx = bytearray()
+        self._arriving = collections.deque()
+        self._rx_free_at = 0
+        self._tx_free_at = 0
+
+    # Device clocks
+    def _micros(self):
+
+        return int((time.time() - self._started) * 1e6) % 2 ** 32
+
+    def _millis(self):
+
+        return int((time.time() - self._started) * 1e3)
+
+    def _byte_time(self, nbytes):
+
+        if not self.throttle:
+            return 0.0
+        return nbytes * 10.0 / self.baud_rate
+
+    def _run(self):
+        """ The simulated firmware loop """
+
+        while not self._stop.is_set():
+            timeout = self._tick
+            if self._arriving:
+                timeout = min(timeout, max(self._arriving[0][0] - time.time(), 0))
+            watched = [self._master]
+            if self._watch is not None:
+                watched.append(self._watch)
+            readable = select.select(watched, [], [], timeout)[0]
+            if self._watch in readable:
+                # The port was opened or closed
+                os.read(self._watch, 4096)
+                logger.debug("Host opened or closed %s. Resetting" % self)
+                self._reset()
+            if self._master in readable:
+                try:
+                    data = os.read(self._master, 1024)
+                except OSError:
+                    # No process has the port open
+                    if self._connected and (self._watch is None):
+                        logger.debug("Host closed %s. Resetting" % self)
+                        self._reset()
+                    self._connected = False
+                    time.sleep(0.01)
+                    continue
+                self._connected = True
+                self._greeted = True
+                now = time.time()
+                self._rx_free_at = max(now, self._rx_free_at) + self._byte_time(len(data))
+                self._arriving.append((self._rx_free_at + self.latency, data))
+            else:
+                self._connected = True
+                if not self._greeted and (time.time() - self._last_banner >= self._banner_interval):
+                    self._last_banner = time.time()
+                    self._write(self.banner)
+
+            while self._arriving and self._arriving[0][0] <= time.time():
+                self._rx.extend(self._arriving.popleft()[1])
+            self._process()
+            self._service_pecks()
+            self._service_filters()
+            if self.streaming:
+                self._report_edges()
+            self._service_timers()
+
+    def _run_writer(self):
+        """ Delivers bytes to the host once they have been "transmitted" """
+
+        while True:
+            item = self._tx.get()
+            if item is None:
+                return
+            generation, due, data = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if generation != self._generation:
+                continue
+            try:
+                os.write(self._master, data)
+            except OSError:
+                pass
+
+    def _write(self, data):
+
+        now = time.time()
+        self._tx_free_at = max(now, self._tx_free_at) + self._byte_time(len(data))
+        self._tx.put((self._generation, self._tx_free_at + self.latency, bytes(data)))
+
+    def _send_frame(self, seq, cmd, payload=b""):
+
+        self._write(make_frame(seq, cmd, payload))
+
+    def _send_nak(self, seq, error):
+
+        self._send_frame(seq, CMD_NAK, bytes(bytearray([error])))
+
+    # Pins
+    def _raw_level(self, pin):
+
+        mode = self.modes.get(pin)
+        if mode == OUTPUT:
+            return self.levels.get(pin, 0)
+        pressed = self.pressed.get(pin, False)
+        if mode == INPUT_PULLUP:
+            return int(not pressed)
+        return int(pressed)
+
+    def _pin_level(self, pin):
+
+        if pin in self.filters:
+            return self.filters[pin].level
+        return self._raw_level(pin)
+
+    def _poll_input(self, pin):
+        """ A polling read, with long presses suppressed """
+
+        filt = self.filters.get(pin)
+        if (filt is None) or not (filt.flags & FILTER_SUPPRESS_LONGPRESS):
+            return self._pin_level(pin)
+        released = int(bool(filt.flags & FILTER_ACTIVE_LOW))
+        if (filt.level == released) or filt.reported:
+            return released
+        filt.reported = True
+        return filt.level
+
+    def _configured_mask(self):
+
+        mask = bytearray(self.mask_bytes)
+        for pin in self.modes:
+            if self._pin_level(pin):
+                mask[pin // 8] |= 1 << (pin % 8)
+        return bytes(mask)
+
+    def _set_mode(self, pin, mode):
+
+        if not 0 <= pin < self.n_pins:
+            return
+        if mode == OUTPUT:
+            self.filters.pop(pin, None)
+            self.levels[pin] = 0
+        self.modes[pin] = mode
+
+    def _write_pin(self, pin, level):
+
+        self.timers.pop(pin, None)
+        self.levels[pin] = level
+
+    def _set_streaming(self, enable):
+
+        self.streaming = enable
+        self.last_levels = dict()
+
+    # Protocol handling
+    def _process(self):
+
+        while True:
+            if self.framed:
+                frame = self._receive_frame()
+                if frame is None:
+                    return
+                self._handle_frame(*frame)
+            else:
+                if len(self._rx) < 2:
+                    return
+                channel, action = self._rx[0], self._rx[1]
+                del self._rx[:2]
+                self._handle_legacy(channel, action)
+
+    def _handle_legacy(self, channel, action):
+
+        if action == 0:
+            self._write(bytes(bytearray([self._raw_level(channel)])))
+        elif action == 1:
+            self._write_pin(channel, 1)
+        elif action == 2:
+            self._write_pin(channel, 0)
+        elif action == 3:
+            self._set_mode(channel, OUTPUT)
+        elif action == 4:
+            self._set_mode(channel, INPUT)
+        elif action == 5:
+            self._set_mode(channel, INPUT_PULLUP)
+        elif action == 6:
+            self._write(bytes(bytearray([self.mask_bytes])) + self._configured_mask())
+        elif action == 7:
+            self._set_streaming(channel != 0)
+        elif (action == CMD_HELLO) and (self.protocol >= 2):
+            self.framed = True
+            self._send_frame(0, CMD_HELLO | REPLY_FLAG, bytes(bytearray([self.protocol])))
+
+    def _receive_frame(self):
+        """ Pull the next valid frame out of the receive buffer. Returns
+        (seq, cmd, payload) or None if there isn't a complete frame yet.
+        """
+
+        while True:
+            start = self._rx.find(bytes(bytearray([FRAME_SYNC])))
+            if start < 0:
+                self._rx = bytearray()
+                return None
+            del self._rx[:start]
+            if len(self._rx) < 2:
+                return None
+            length = self._rx[1]
+            if length > MAX_PAYLOAD:
+                del self._rx[:1]
+                continue
+            if len(self._rx) < length + 5:
+                return None
+            frame = bytes(self._rx[:length + 5])
+            del self._rx[:length + 5]
+            if crc8(frame[1:length + 4]) == bytearray(frame[-1:])[0]:
+                return bytearray(frame)[2], bytearray(frame)[3], frame[4:length + 4]
+            self._send_nak(bytearray(frame)[2], ERROR_CRC)
+
+    def _handle_frame(self, seq, cmd, payload):
+
+        length = len(payload)
+        if (((cmd <= 7) and (cmd != 6) and (length < 1)) or
+                ((cmd == CMD_POLL_INPUT) and (length < 1)) or
+                ((cmd == CMD_PULSE) and (length < 5)) or
+                ((cmd == CMD_PATTERN) and (length < 9)) or
+                ((cmd == CMD_CONFIG_INPUT) and (length < 4))):
+            self._send_nak(seq, ERROR_BAD_LENGTH)
+            return
+        pin = bytearray(payload[:1])[0] if length else 0
+        reply = b""
+
+        if cmd == 0:
+            reply = bytes(bytearray([self._pin_level(pin)]))
+        elif cmd == CMD_POLL_INPUT:
+            reply = bytes(bytearray([self._poll_input(pin)]))
+        elif cmd in (1, 2, 3, 4, 5, 7):
+            self._handle_legacy(pin, cmd)
+        elif cmd == 6:
+            reply = self._configured_mask()
+        elif cmd == CMD_PULSE:
+            if not self._start_timer(seq, pin):
+                return
+            duration = struct.unpack("<I", payload[1:5])[0]
+            self.timers[pin] = OutputTimer(False, 0, 0, 0, duration, self._millis())
+            self.levels[pin] = 1
+        elif cmd == CMD_PATTERN:
+            if not self._start_timer(seq, pin):
+                return
+            on_ms, off_ms, duration = struct.unpack("<HHI", payload[1:9])
+            restore_level = self.levels.get(pin, 0)
+            self.timers[pin] = OutputTimer(True, restore_level, on_ms, off_ms,
+                                           duration, self._millis())
+            self.levels[pin] = 1
+        elif cmd == CMD_CONFIG_INPUT:
+            debounce_ms, flags = struct.unpack("<HB", payload[1:4])
+            self.filters.pop(pin, None)
+            if debounce_ms or flags:
+                if len(self.filters) >= MAX_FILTERS:
+                    self._send_nak(seq, ERROR_NO_FILTER)
+                    return
+                self.filters[pin] = InputFilter(debounce_ms, flags,
+                                                self._raw_level(pin),
+                                                self._millis())
+        elif cmd == CMD_PING:
+            reply = struct.pack("<I", self._micros())
+        elif cmd == CMD_HELLO:
+            reply = bytes(bytearray([self.protocol]))
+        else:
+            self._send_nak(seq, ERROR_UNKNOWN_COMMAND)
+            return
+
+        self._send_frame(seq, cmd | REPLY_FLAG, reply)
+
+    # Periodic work
+    def _start_timer(self, seq, pin):
+        """ Claim a timer for a pin, replacing any timer already on it """
+
+        self.timers.pop(pin, None)
+        if len(self.timers) >= MAX_TIMERS:
+            self._send_nak(seq, ERROR_NO_TIMER)
+            return False
+        return True
+
+    def _service_timers(self):
+
+        now = self._millis()
+        for pin, timer in list(self.timers.items()):
+            elapsed = now - timer.started
+            if (timer.duration > 0) and (elapsed >= timer.duration):
+                del self.timers[pin]
+                self.levels[pin] = timer.restore_level
+                self._send_frame(0, CMD_OUTPUT_DONE,
+                                 bytes(bytearray([pin, timer.restore_level])))
+            elif timer.toggles:
+                period = timer.on_ms + timer.off_ms
+                if period > 0:
+                    self.levels[pin] = int(elapsed % period < timer.on_ms)
+
+    def _service_filters(self):
+
+        now = self._millis()
+        for pin, filt in self.filters.items():
+            raw = self._raw_level(pin)
+            if raw != filt.raw_level:
+                filt.raw_level = raw
+                filt.changed_at = now
+            if (raw != filt.level) and (now - filt.changed_at >= filt.debounce_ms):
+                filt.level = raw
+                if raw == int(bool(filt.flags & FILTER_ACTIVE_LOW)):
+                    filt.reported = False
+
+    def _service_pecks(self):
+
+        now = time.time()
+        with self._lock:
+            while self._pecks and self._pecks[0][0] <= now:
+                at, channel, pressed = heapq.heappop(self._pecks)
+                if pressed is None:
+                    # A random peck: press now and draw the next one
+                    self._schedule(at, channel, self.peck_duration)
+                    self._schedule_random(channel, at + self.peck_duration)
+                    continue
+                self.pressed[channel] = pressed
+
+    def _report_edges(self):
+
+        stamp = self._micros()
+        for pin, mode in self.modes.items():
+            if mode == OUTPUT:
+                continue
+            level = self._pin_level(pin)
+            if level != self.last_levels.get(pin, 0):
+                self.last_levels[pin] = level
+                packet = struct.pack("<BBI", pin, level, stamp)
+                if self.framed:
+                    self._send_frame(0, CMD_EDGE, packet)
+                else:
+                    self._write(bytes(bytearray([EDGE_MARKER])) + packet)
+
+
+if __name__ == "__main__":
+
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.001
+    with ArduinoSimulator(latency=latency) as sim:
+        for name, rate in sorted(benchmark_protocols(sim.path).items()):
+            print("%s: %.1f messages / second" % (name, rate))
@@ -1,23 +1,155 @@
 import time
 import datetime
 import logging
-import wave
 import numpy as np
 from pyoperant import InterfaceError
+from pyoperant.stimuli import stimulus_cache
 
 logger = logging.getLogger(__name__)
 
+
+class PollScheduler(object):
+    """ Paces a polling loop at a target sample rate. Each interval is mostly
+    spent asleep, and only the last `jitter` seconds before the deadline are
+    spent spinning on the clock, since sleeping is only accurate to about that
+    much. A loop that falls behind skips the missed deadlines instead of
+    trying to catch up. Without a rate, the loop runs as fast as it can.
+
+    The interval between samples is recorded in a histogram, so the achieved
+    polling rate can be checked.
+
+    Parameters
+    ----------
+    rate: float
+        Target samples per second. None polls as fast as possible (default).
+    jitter: float
+        Time, in seconds, before each deadline to spin instead of sleep (default 0.001)
+    bin_width: float
+        Width, in seconds, of the histogram bins (default 0.0005)
+    max_interval: float
+        Intervals longer than this, in seconds, go in the last histogram bin (default 0.1)
+
+    Attributes
+    ----------
+    counts: numpy array
+        Number of sample intervals in each histogram bin
+    n_samples: int
+        Number of samples recorded
+    """
+
+    def __init__(self, rate=None, jitter=0.001, bin_width=0.0005,
+                 max_interval=0.1):
+
+        self.rate = rate
+        self.jitter = jitter
+        self.bin_width = bin_width
+        self.max_interval = max_interval
+        self._period = None
+        self._deadline = None
+        self._last = None
+        self.reset()
+
+    def reset(self):
+        """ Clear the recorded intervals """
+
+        self.counts = np.zeros(int(np.ceil(self.max_interval / self.bin_width)) + 1,
+                               dtype=np.int64)
+        self.n_samples = 0
+        self._total = 0.0
+
+    def start(self, period=None):
+        """ Start a polling loop. period, in seconds, overrides the target rate
+        for this loop.
+        """
+
+        if period is None and self.rate:
+            period = 1.0 / self.rate
+        self._period = period
+        self._deadline = time.perf_counter()
+        self._last = None
+
+    def tick(self):
+        """ Record a sample """
+
+        now = time.perf_counter()
+        if self._last is not None:
+            interval = now - self._last
+            index = min(int(interval / self.bin_width), len(self.counts) - 1)
+            self.counts[index] += 1
+            self.n_samples += 1
+            self._total += interval
+        self._last = now
+
+    def wait(self):
+        """ Block until the next sample is due """
+
+        if not self._period:
+            return
+
+        self._deadline += self._period
+        now = time.perf_counter()
+        if self._deadline <= now:
+            # Fell behind. Start counting from now instead of rushing.
+            self._deadline = now
+            return
+        if self._deadline - now > self.jitter:
+            time.sleep(self._deadline - now - self.jitter)
+        while time.perf_counter() < self._deadline:
+            pass
+
+    @property
+    def effective_rate(self):
+        """ The achieved samples per second, or None before any samples """
+
+        if self._total == 0:
+            return None
+        return self.n_samples / self._total
+
+    def histogram(self):
+        """ The recorded sample intervals
+
+        Returns
+        -------
+        (numpy array, numpy array)
+            The left edge, in seconds, of each bin and the number of intervals
+            in it. The last bin holds everything longer than max_interval.
+        """
+
+        return np.arange(len(self.counts)) * self.bin_width, self.counts.copy()
+
+    def percentile(self, q):
+        """ Approximate q-th percentile of the sample interval, in seconds """
+
+        if self.n_samples == 0:
+            return None
+        index = np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.n_samples)
+        return (index + 1) * self.bin_width
+
+
 class BaseInterface(object):
     """
     Implements generic interface methods.
     Implemented methods:
     - _poll
+
+    Parameters
+    ----------
+    poll_rate: float
+        Target samples per second for _poll when it is not given a wait. None polls as fast as possible (default).
+    poll_jitter: float
+        Time, in seconds, before each poll to spin instead of sleep (default 0.001)
+
+    Attributes
+    ----------
+    poll_scheduler: PollScheduler
+        Paces _poll and records the achieved polling intervals
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, poll_rate=None, poll_jitter=0.001, **kwargs):
 
         super(BaseInterface, self).__init__()
         self.device_name = None
+        self.poll_scheduler = PollScheduler(rate=poll_rate, jitter=poll_jitter)
 
     def open(self):
         pass
@@ -46,7 +178,7 @@ class BaseInterface(object):
         timeout: float
             the time, in seconds, until polling times out. Defaults to no timeout.
         wait: float
-            the time, in seconds, to wait between subsequent reads (default no wait).
+            the time, in seconds, between the starts of subsequent reads. Defaults to the interface's poll_rate.
         event: dict
             a dictionary of event information to emit just before writing
 
@@ -58,7 +190,10 @@ class BaseInterface(object):
         logger.debug("Begin polling from device %s" % self.device_name)
         if timeout is not None:
             start = time.time()
+        scheduler = self.poll_scheduler
+        scheduler.start(period=wait)
         while True:
+            scheduler.tick()
             value = self._read_bool(channel=channel,
                                    subdevices=subdevices,
                                    invert=invert,
@@ -69,6 +204,7 @@ class BaseInterface(object):
             if value is True:
                 if (last_value is False) or (suppress_longpress is False):
                     logger.debug("Input detected. Returning")
+                    self._log_poll_rate()
                     return datetime.datetime.now()
             else:
                 last_value = False
@@ -76,10 +212,16 @@ class BaseInterface(object):
             if timeout is not None:
                 if time.time() - start >= timeout:
                     logger.debug("Polling timed out. Returning")
+                    self._log_poll_rate()
                     return None
 
-            if wait is not None:
-                utils.wait(wait)
+            scheduler.wait()
+
+    def _log_poll_rate(self):
+
+        rate = self.poll_scheduler.effective_rate
+        if rate is not None:
+            logger.debug("Polling %s at %.1f reads / second (99th percentile interval %.4f s)" % (self.device_name, rate, self.poll_scheduler.percentile(99)))
 
 
     def __del__(self):
@@ -93,6 +235,14 @@ class BaseInterface(object):
 
         return hasattr(self, "_read_bool")
 
+    @property
+    def can_read_bool_many(self):
+        """
+        If the interface is capable of reading several boolean values from the device in a single request
+        """
+
+        return hasattr(self, "_read_bool_many")
+
     @property
     def can_write_bool(self):
         """
@@ -101,6 +251,14 @@ class BaseInterface(object):
 
         return hasattr(self, "_write_bool")
 
+    @property
+    def can_pulse_bool(self):
+        """
+        If the interface is capable of timing boolean pulses and patterns on the device
+        """
+
+        return hasattr(self, "_pulse_bool")
+
     @property
     def can_read_analog(self):
         """
@@ -117,6 +275,70 @@ class BaseInterface(object):
 
         return hasattr(self, "_write_analog")
 
+    @property
+    def can_prepare_analog(self):
+        """
+        If the interface can load analog values onto the device ahead of starting their output
+        """
+
+        return hasattr(self, "_prepare_analog")
+
+    @property
+    def can_stream_analog(self):
+        """
+        If the interface can stream analog values to the device in chunks
+        """
+
+        return hasattr(self, "_stream_analog")
+
+    @property
+    def can_preload_wav(self):
+        """
+        If the interface can decode wave files ahead of queueing them
+        """
+
+        return hasattr(self, "_preload_wav")
+
+    @property
+    def can_record_range(self):
+        """
+        If the interface can return recorded audio for a range of times
+        """
+
+        return hasattr(self, "_get_recorded_range")
+
+    @property
+    def can_report_onset(self):
+        """
+        If the interface can report when a sound actually started playing
+        """
+
+        return hasattr(self, "_get_onset")
+
+    @property
+    def can_schedule_wav(self):
+        """
+        If the interface can start playback at a given time
+        """
+
+        return hasattr(self, "_play_wav_at")
+
+    @property
+    def can_queue_sequence(self):
+        """
+        If the interface can queue several wave files to play back to back
+        """
+
+        return hasattr(self, "_queue_sequence")
+
+    @property
+    def can_report_playing(self):
+        """
+        If the interface can report whether a sound is still playing
+        """
+
+        return hasattr(self, "is_playing")
+
 class AudioInterface(BaseInterface):
     """
     Generic audio interface that implements wavefile handling
@@ -154,13 +376,11 @@ class AudioInterface(BaseInterface):
         return dtype, max_val
 
     def _load_wav(self, filename):
-        """ Loads the .wav file and normalizes it according to its bit depth
+        """ Loads the .wav file through the shared stimulus cache and
+        normalizes it according to its bit depth
         """
 
-        self.wf = wave.open(filename)
-        self.validate()
-
-        dtype, max_val = self._get_dtype(self.wf)
-        data = np.fromstring(self.wf.readframes(-1), dtype=dtype)
+        wav = stimulus_cache.get(filename)
+        dtype, max_val = self._get_dtype(wav)
 
-        return (data / max_val).astype(np.float64)
+        return (wav.samples / max_val).astype(np.float64)
@@ -1,75 +1,442 @@
 import comedi
-import subprocess, datetime
+import datetime
+import time
+import struct
+import logging
+import threading
+from multiprocessing import shared_memory, resource_tracker
 from pyoperant.interfaces import base_
-from pyoperant import utils, InterfaceError
+from pyoperant import InterfaceError
+
+logger = logging.getLogger(__name__)
+
+# comedi_dio_bitfield2 reads up to this many channels at once
+BITFIELD_WIDTH = 32
+
+
+class ChannelState(object):
+    """ The latest value of a polled input channel. pressed is set whenever
+    the channel becomes active, and time holds when that was seen. lock
+    guards active and pressed so a press can't fall between a waiter's check
+    and the scan thread's update.
+    """
+
+    def __init__(self):
+
+        self.active = False
+        self.time = None
+        self.pressed = threading.Event()
+        self.lock = threading.Lock()
+
+
+class ComediScanService(object):
+    """ Scans every digital input subdevice of a comedi device at a fixed rate
+    in a background thread, with one comedi_dio_bitfield2 read per 32 channels
+    of each subdevice, and keeps the latest snapshot of all of them. Callers
+    waiting on a channel are woken when it becomes active.
+
+    There is one service per device in each process, shared by all of its
+    ComediInterfaces (see acquire). With shared=True, the snapshots are also
+    published in shared memory, so that interfaces in other processes read
+    them instead of the hardware. The first process to scan a device publishes
+    and later ones attach. If the publisher stops updating, attached services
+    go back to scanning the hardware themselves.
+
+    Parameters
+    ----------
+    device_name: string
+        The comedi device (e.g. /dev/comedi0)
+    rate: float
+        Scans per second (default 1000)
+    jitter: float
+        Time, in seconds, before each scan to spin instead of sleep (default 0.0005)
+    shared: bool
+        Whether to share snapshots with other processes (default False)
+
+    Attributes
+    ----------
+    scheduler: base_.PollScheduler
+        Paces the scans and records the achieved scan intervals
+    shared: bool
+        Whether the service was asked to share snapshots with other processes
+    publishing: bool
+        Whether this service publishes its snapshots to other processes
+    attached: bool
+        Whether this service reads snapshots published by another process
+    """
+
+    _services = dict()
+    _services_lock = threading.Lock()
+
+    # Snapshots older than this, in seconds, mean the publisher has stopped
+    stale_after = 1.0
+
+    def __init__(self, device_name, rate=1000.0, jitter=0.0005, shared=False):
+
+        self.device_name = device_name
+        self.scheduler = base_.PollScheduler(rate=rate, jitter=jitter)
+        self.shared = shared
+        self.publishing = False
+        self.attached = False
+        self.device = None
+        self.snapshot = None
+        self._shared = None
+        self._blocks = list()
+        self._bits = dict()
+        self._time = None
+        self._channels = dict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._users = 0
+
+        if shared:
+            self._attached_at = time.time()
+            self.snapshot = SharedSnapshot(device_name)
+            self.publishing = self.snapshot.owner
+            self.attached = not self.snapshot.owner
+        if not self.attached:
+            self._open_device()
+
+    @classmethod
+    def acquire(cls, device_name, **kwargs):
+        """ Get the service for a device, creating and starting it if this is
+        the first user in this process. Call release() when done with it.
+
+        Later users get the service the first user started, so their rate and
+        shared arguments are ignored; a warning is logged when they differ.
+        """
+
+        with cls._services_lock:
+            service = cls._services.get(device_name)
+            if service is None:
+                service = cls(device_name, **kwargs)
+                cls._services[device_name] = service
+                service.start()
+            else:
+                rate = kwargs.get("rate", service.scheduler.rate)
+                shared = kwargs.get("shared", service.shared)
+                if rate != service.scheduler.rate or bool(shared) != bool(service.shared):
+                    logger.warning("Comedi device %s is already scanned at %s Hz with shared=%s. Ignoring rate=%s, shared=%s" % (device_name, service.scheduler.rate, service.shared, rate, shared))
+            service._users += 1
+            return service
+
+    def release(self):
+        """ Stop the service once its last user releases it """
+
+        with self._services_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._services.pop(self.device_name, None)
+        self.stop()
+
+    def _open_device(self):
+        """ Open the device and find the blocks of channels to read """
+
+        self.device = comedi.comedi_open(self.device_name)
+        if self.device is None:
+            raise InterfaceError('could not open comedi device %s' % self.device_name)
+        self._blocks = list()
+        for subdevice in range(comedi.comedi_get_n_subdevices(self.device)):
+            subdevice_type = comedi.comedi_get_subdevice_type(self.device, subdevice)
+            if subdevice_type not in (comedi.COMEDI_SUBD_DI, comedi.COMEDI_SUBD_DIO):
+                continue
+            n_channels = comedi.comedi_get_n_channels(self.device, subdevice)
+            for base in range(0, n_channels, BITFIELD_WIDTH):
+                self._blocks.append((subdevice, base))
+
+    def start(self):
+        """ Start the scan thread, if it isn't running """
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="ComediScanService(%s)" % self.device_name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop and join the scan thread and let go of the device """
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        if self.device is not None:
+            comedi.comedi_close(self.device)
+            self.device = None
+
+    def add(self, subdevice, channel):
+        """ Start watching a channel for presses """
+
+        with self._lock:
+            self._channels.setdefault((subdevice, channel), ChannelState())
+
+    def watching(self, subdevice, channel):
+
+        return (subdevice, channel) in self._channels
+
+    def value(self, subdevice, channel):
+        """ The raw value of a channel at the latest scan, or None if the
+        channel is not part of the snapshot
+        """
+
+        base = channel - channel % BITFIELD_WIDTH
+        bits = self._bits.get((subdevice, base))
+        if bits is None:
+            return None
+        return (bits >> (channel - base)) & 1
+
+    def wait(self, subdevice, channel, timeout=None):
+        """ Block until the channel is active
+
+        Returns
+        -------
+        datetime or None:
+            when the channel was seen active, or None if it timed out
+        """
+
+        self.add(subdevice, channel)
+        state = self._channels[(subdevice, channel)]
+        with state.lock:
+            state.pressed.clear()
+            if state.active:
+                return datetime.datetime.now()
+        if state.pressed.wait(timeout):
+            return state.time
+        return None
+
+    def _run(self):
+
+        self.scheduler.start()
+        while not self._stop.is_set():
+            self.scheduler.tick()
+            if self.attached:
+                self._read_snapshot()
+            else:
+                self._scan()
+            self._update_channels()
+            self.scheduler.wait()
+
+    def _scan(self):
+        """ Read every block of channels from the hardware """
+
+        for subdevice, base in self._blocks:
+            (s, bits) = comedi.comedi_dio_bitfield2(self.device, subdevice, 0, 0, base)
+            if s < 0:
+                logger.error('could not read from comedi device "%s", subdevice %s, channels %s-%s' % (self.device_name, subdevice, base, base + BITFIELD_WIDTH - 1))
+                continue
+            self._bits[(subdevice, base)] = bits
+        self._time = time.time()
+        if self.publishing:
+            self.snapshot.write(self._time, self._bits)
+
+    def _read_snapshot(self):
+        """ Read the latest snapshot published by another process """
+
+        scan_time, bits = self.snapshot.read()
+        if scan_time is None:
+            # The publisher has not finished its first scan yet
+            scan_time = self._attached_at
+        if time.time() - scan_time > self.stale_after:
+            logger.warning("Snapshots of comedi device %s are stale. Scanning it from this process" % self.device_name)
+            self.attached = False
+            self._open_device()
+            return
+        if bits is None:
+            return
+        self._bits = bits
+        self._time = scan_time
+
+    def _update_channels(self):
+        """ Wake waiters on channels that have become active """
+
+        if self._time is None:
+            return
+        with self._lock:
+            channels = list(self._channels.items())
+        scan_time = datetime.datetime.fromtimestamp(self._time)
+        for (subdevice, channel), state in channels:
+            value = self.value(subdevice, channel)
+            if value is None:
+                continue
+            # Inputs are active low (see ComediInterface._read_bool)
+            active = not value
+            with state.lock:
+                became_active = active and not state.active
+                state.active = active
+                if became_active:
+                    state.time = scan_time
+                    state.pressed.set()
+
+
+class SharedSnapshot(object):
+    """ The latest scan of a comedi device in shared memory. One process
+    writes and any number read. A sequence counter that is odd while a write
+    is in progress lets readers retry torn reads without locking.
+
+    Layout: sequence (uint64), scan time (float64), number of blocks (uint32),
+    then up to MAX_BLOCKS (subdevice, base channel, bits) uint32 triples.
+
+    Parameters
+    ----------
+    device_name: string
+        The comedi device. The shared memory is named after it.
+
+    Attributes
+    ----------
+    owner: bool
+        Whether this process created the shared memory and writes to it
+    """
+
+    MAX_BLOCKS = 32
+    _header = struct.Struct("<QdI")
+    _block = struct.Struct("<III")
+
+    def __init__(self, device_name):
+
+        self.name = "pyoperant_" + device_name.strip("/").replace("/", "_")
+        size = self._header.size + self.MAX_BLOCKS * self._block.size
+        try:
+            self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+            self.owner = True
+            self._header.pack_into(self.memory.buf, 0, 0, 0.0, 0)
+        except FileExistsError:
+            self.memory = shared_memory.SharedMemory(name=self.name)
+            self.owner = False
+            # Only the owner should remove the shared memory when it exits
+            try:
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+            except Exception:
+                pass
+
+    def write(self, scan_time, bits):
+
+        buf = self.memory.buf
+        seq = self._header.unpack_from(buf, 0)[0]
+        struct.pack_into("<Q", buf, 0, seq + 1)
+        blocks = sorted(bits.items())[:self.MAX_BLOCKS]
+        for ii, ((subdevice, base), value) in enumerate(blocks):
+            self._block.pack_into(buf, self._header.size + ii * self._block.size,
+                                  subdevice, base, value)
+        self._header.pack_into(buf, 0, seq + 2, scan_time, len(blocks))
+
+    def read(self, retries=1000):
+        """ Returns the scan time and a dictionary of bits by (subdevice, base
+        channel), or (None, None) if nothing has been written yet. If no
+        consistent read succeeds within retries attempts (e.g. the writer died
+        mid-write) the bits are None and the scan time is that of the last
+        complete write, so the caller sees the snapshot go stale.
+        """
+
+        buf = self.memory.buf
+        for _ in range(retries):
+            seq, scan_time, n_blocks = self._header.unpack_from(buf, 0)
+            if seq == 0:
+                return None, None
+            if seq % 2:
+                continue
+            bits = dict()
+            for ii in range(n_blocks):
+                subdevice, base, value = self._block.unpack_from(buf, self._header.size + ii * self._block.size)
+                bits[(subdevice, base)] = value
+            if struct.unpack_from("<Q", buf, 0)[0] == seq:
+                return scan_time, bits
+        logger.warning("Gave up reading snapshot %s after %d torn reads" % (self.name, retries))
+        return scan_time, None
+
+    def close(self):
+
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
 
 
 class ComediInterface(base_.BaseInterface):
-    """docstring for ComediInterface"""
-    def __init__(self,device_name,*args,**kwargs):
+    """ Interface to a comedi device's digital inputs and outputs. Inputs are
+    read from the snapshots of the device's ComediScanService, which is shared
+    by every interface to the same device, so polling and reading do not go
+    back to the hardware.
+
+    Parameters
+    ----------
+    device_name: string
+        The comedi device (e.g. /dev/comedi0)
+    scan_rate: float
+        Scans per second of the input channels (default 1000)
+    shared_scan: bool
+        Whether to share scans of the device with other processes through shared memory (default False)
+    """
+    def __init__(self,device_name,scan_rate=1000.0,shared_scan=False,*args,**kwargs):
         super(ComediInterface, self).__init__(*args,**kwargs)
         self.device_name = device_name
         self.read_params = ('subdevice',
                             'channel',
                             )
+        self.scan_rate = scan_rate
+        self.shared_scan = shared_scan
+        self.scanner = None
         self.open()
 
     def open(self):
         self.device = comedi.comedi_open(self.device_name)
         if self.device is None:
             raise InterfaceError('could not open comedi device %s' % self.device_name)
+        self.scanner = ComediScanService.acquire(self.device_name,
+                                                 rate=self.scan_rate,
+                                                 shared=self.shared_scan)
 
     def close(self):
+        if self.scanner is not None:
+            self.scanner.release()
+            self.scanner = None
         s = comedi.comedi_close(self.device)
         if s < 0:
             raise InterfaceError('could not close comedi device %s(%s)' % (self.device_name, self.device))
 
-    def _config_read(self,subdevice,channel):
+    def _config_read(self,subdevice,channel,**kwargs):
         s = comedi.comedi_dio_config(self.device,subdevice,channel,comedi.COMEDI_INPUT)
         if s < 0:
             raise InterfaceError('could not configure comedi device "%s", subdevice %s, channel %s' % (self.device,subdevice,channel))
         else:
+            self.scanner.add(subdevice, channel)
             return True
 
-    def _config_write(self,subdevice,channel):
+    def _config_write(self,subdevice,channel,**kwargs):
         s = comedi.comedi_dio_config(self.device,subdevice,channel,comedi.COMEDI_OUTPUT)
         if s < 0:
             raise InterfaceError('could not configure comedi device "%s", subdevice %s, channel %s' % (self.device,subdevice,channel))
         else:
             return True
 
-    def _read_bool(self,subdevice,channel):
+    def _read_bool(self,subdevice,channel,**kwargs):
         """ read from comedi port
         """
+        v = self.scanner.value(subdevice,channel)
+        if v is not None:
+            return (not v)
         (s,v) = comedi.comedi_dio_read(self.device,subdevice,channel)
         if s:
             return (not v)
         else:
             raise InterfaceError('could not read from comedi device "%s", subdevice %s, channel %s' % (self.device,subdevice,channel))
 
-    def _poll(self,subdevice,channel,timeout=None):
-        """ runs a loop, querying for pecks. returns peck time or "GoodNite" exception """
-        date_fmt = '%Y-%m-%d %H:%M:%S.%f'
-        cmd = ['comedi_poll', self.device_name, '-s', str(subdevice), '-c', str(channel)]
-        poll_command = utils.Command(cmd)
-        status, output, error = poll_command.run(timeout=timeout)
-        if status < 0:
-            return None
-        else:
-            timestamp = output
-            return datetime.datetime.strptime(timestamp.strip(),date_fmt)
+    def _poll(self,subdevice,channel,timeout=None,**kwargs):
+        """ waits for the channel to become active. returns peck time or None if timed out """
+        return self.scanner.wait(subdevice, channel, timeout=timeout)
 
-    def _write_bool(self,subdevice,channel,value):
+    def _write_bool(self,subdevice,channel,value,**kwargs):
         """Write to comedi port
         """
         value = not value #invert the value for comedi
-        
+
         s = comedi.comedi_dio_write(self.device,subdevice,channel,value)
         if s:
             return True
         else:
             raise InterfaceError('could not write to comedi device "%s", subdevice %s, channel %s' % (self.device,subdevice,channel))
-
-
-
-
@@ -1,11 +1,16 @@
 import time
 import datetime
 import logging
+import collections
+import queue
+import threading
 import numpy as np
 import nidaqmx
 import wave
 from pyoperant.interfaces import base_
+from pyoperant.interfaces.utils import RingBuffer, AnalogOutputStream
 from pyoperant import utils, InterfaceError
+from pyoperant.stimuli import stimulus_cache, concat_wavs
 from pyoperant.events import events, EventDToAHandler
 
 logger = logging.getLogger(__name__)
@@ -63,6 +68,341 @@ class NIDAQmxError(InterfaceError):
     pass
 
 
+# A transition found in the samples of a continuous digital input. sample is
+# the index of the first sample at the new level, counted from the start of
+# the task, and time is that sample's host timestamp.
+DigitalEdge = collections.namedtuple("DigitalEdge", ["level", "sample", "time"])
+
+
+class ContinuousInput(object):
+    """ A digital input task that runs continuously on the sample clock. New
+    samples are drained into a host ring buffer and scanned for transitions,
+    which are timestamped from their sample index.
+
+    Parameters
+    ----------
+    task: nidaqmx.DigitalInputTask
+        a task configured for continuous sampling
+    samplerate: float
+        the rate of the task's sample clock
+    buffer_seconds: float
+        how many seconds of samples to keep in the host ring buffer
+
+    Attributes
+    ----------
+    buffer: RingBuffer
+        the most recent samples, one column per line
+    n_samples: int
+        the number of samples acquired since the task was started
+    level: int
+        the most recent value of the first line
+    edges: queue.Queue
+        DigitalEdge tuples for every transition on the first line
+    start_time: float
+        the host time of the first sample
+    """
+
+    def __init__(self, task, samplerate, buffer_seconds=10.0):
+        self.task = task
+        self.samplerate = float(samplerate)
+        self.buffer = RingBuffer(maxlen=int(buffer_seconds * self.samplerate),
+                                 dtype=np.uint8)
+        self.edges = queue.Queue()
+        self.n_samples = 0
+        self.level = None
+        self.start_time = None
+
+    def start(self):
+        """ Start the task. The first sample is timestamped halfway through the
+        start call. """
+
+        before = time.time()
+        self.task.start()
+        after = time.time()
+        self.start_time = 0.5 * (before + after)
+        self.n_samples = 0
+
+    def stop(self):
+        self.task.stop()
+
+    def sample_time(self, sample):
+        """ Host timestamp of the given sample index """
+
+        return datetime.datetime.fromtimestamp(self.start_time +
+                                               sample / self.samplerate)
+
+    def drain(self):
+        """ Read every sample that the driver has acquired since the last call
+        and queue the transitions found in them.
+
+        Returns
+        -------
+        the number of samples read
+        """
+
+        available = self.task.get_samples_per_channel_available()
+        if available == 0:
+            return 0
+
+        values, bits_per_sample = self.task.read(available)
+        values = np.asarray(values, dtype=np.uint8).reshape((available, -1))
+        self.buffer.extend(values)
+
+        line = values[:, 0]
+        if self.level is None:
+            self.level = int(line[0])
+        # Indices where the level differs from the sample before it
+        changes = np.flatnonzero(np.diff(line, prepend=self.level))
+        for index in changes:
+            sample = self.n_samples + int(index)
+            self.edges.put(DigitalEdge(level=int(line[index]),
+                                       sample=sample,
+                                       time=self.sample_time(sample)))
+        self.level = int(line[-1])
+        self.n_samples += available
+
+        return available
+
+
+class AnalogOutputTask(object):
+    """ An analog output task that is kept between writes. The sample clock is
+    only reconfigured when the number of samples changes, and the output
+    arrays (with the event channel, if any) are preallocated per shape and
+    filled in place.
+
+    Parameters
+    ----------
+    task: nidaqmx.AnalogOutputTask
+        a task with its voltage channels created
+    clock_channel: string
+        the source of the sample clock
+    samplerate: float
+        the rate of the sample clock
+    event_handler: instance of events.EventDToAHandler
+        if given, the last channel of the task carries the event bits
+    max_buffers: int
+        the number of differently shaped output arrays to keep
+
+    Attributes
+    ----------
+    n_samples: int
+        the number of samples the sample clock is currently configured for
+    buffers: dict
+        preallocated output arrays keyed by (n_samples, n_channels)
+    prepared: bool
+        whether a buffer has been written and is waiting for trigger()
+    stream: AnalogOutputStream
+        the stream being written by start_stream(), if any
+    """
+
+    def __init__(self, task, clock_channel, samplerate, event_handler=None,
+                 max_buffers=8):
+        self.task = task
+        self.clock_channel = clock_channel
+        self.samplerate = samplerate
+        self.event_handler = event_handler
+        self.max_buffers = max_buffers
+
+        self.n_samples = None
+        self.buffers = collections.OrderedDict()
+        self.prepared = False
+        self.running = False
+        self.stream = None
+        self._regeneration = True
+        self._stream_thread = None
+
+    def get_buffer(self, n_samples, n_channels):
+        """ Returns the preallocated output array of the given shape,
+        allocating it the first time it is needed """
+
+        key = (n_samples, n_channels)
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+            return self.buffers[key]
+
+        if len(self.buffers) >= self.max_buffers:
+            self.buffers.popitem(last=False)
+        logger.debug("Allocating a %d x %d analog output buffer" % key)
+        buf = np.zeros(key, dtype=np.float64)
+        self.buffers[key] = buf
+        return buf
+
+    def configure(self, n_samples):
+        """ Configures the sample clock for n_samples, unless it already is """
+
+        if n_samples == self.n_samples:
+            return
+        if not self._regeneration:
+            self.task.set_regeneration(True)
+            self._regeneration = True
+        self.task.configure_timing_sample_clock(source=self.clock_channel,
+                                                rate=self.samplerate,
+                                                sample_mode="finite",
+                                                samples_per_channel=n_samples)
+        self.n_samples = n_samples
+
+    def prepare(self, values, event=None):
+        """ Copies values, and the event bits, into the output buffer and
+        writes it to the device without starting the task.
+
+        Parameters
+        ----------
+        values: numpy array
+            an array of nsamples or nsamples x nchannels values
+        event: dict
+            the event to encode on the event channel
+        """
+
+        values = np.asarray(values)
+        if values.ndim == 1:
+            values = values.reshape((-1, 1))
+        n_samples, n_channels = values.shape
+        if self.event_handler is not None:
+            n_channels += 1
+
+        self.stop()
+        self.configure(n_samples)
+        buf = self.get_buffer(n_samples, n_channels)
+        buf[:, :values.shape[1]] = values
+        if self.event_handler is not None:
+            # Place the bit string at the start of the event channel
+            bit_string = self.event_handler.to_bit_sequence(event)
+            buf[:, -1] = 0
+            buf[:len(bit_string), -1] = bit_string
+
+        # I think we might want to set layout='group_by_scan_number' in .write()
+        self.task.write(buf, auto_start=False)
+        self.prepared = True
+
+    def trigger(self, is_blocking=False):
+        """ Starts output of the prepared buffer """
+
+        if not self.prepared:
+            raise NIDAQmxError("Analog output triggered without being prepared")
+
+        self.task.start()
+        self.running = True
+        self.prepared = False
+        if is_blocking:
+            self.task.wait_until_done()
+            self.stop()
+
+    def stop(self):
+        thread = self._stream_thread
+        if (thread is not None) and (thread is not threading.current_thread()):
+            self._stream_stop.set()
+            self.stream.close()
+            thread.join()
+        if self.running:
+            self.running = False
+            self.task.stop()
+
+    def start_stream(self, data, chunk_size, buffer_size, event=None):
+        """ Streams data to the device in chunks from a background thread. The
+        task runs continuously on a buffer of buffer_size samples with
+        regeneration disabled, so every sample is written exactly once and the
+        device underflows rather than repeating old samples.
+
+        Parameters
+        ----------
+        data: numpy array or iterable
+            an array (e.g. a np.memmap) or an iterable of arrays (e.g. a
+            generator) of nsamples x nchannels values
+        chunk_size: int
+            the number of samples per write
+        buffer_size: int
+            the size of the device buffer, which is filled before starting
+        event: dict
+            the event to encode on the event channel at the start of the stream
+
+        Returns
+        -------
+        the AnalogOutputStream, which counts underruns
+        """
+
+        self.stop()
+        self.prepared = False
+        self.n_samples = None
+        self.task.configure_timing_sample_clock(source=self.clock_channel,
+                                                rate=self.samplerate,
+                                                sample_mode="continuous",
+                                                samples_per_channel=buffer_size)
+        self.task.set_buffer_size(buffer_size)
+        self.task.set_regeneration(False)
+        self._regeneration = False
+
+        bit_string = None
+        if self.event_handler is not None:
+            bit_string = self.event_handler.to_bit_sequence(event)
+
+        self.stream = AnalogOutputStream(data, chunk_size, buffer_size)
+        self._stream_stop = threading.Event()
+        self._stream_thread = threading.Thread(target=self._run_stream,
+                                               args=(self.stream, bit_string,
+                                                     self._stream_stop),
+                                               name="NIDAQmxStream")
+        self._stream_thread.daemon = True
+        self._stream_thread.start()
+
+        return self.stream
+
+    def wait_stream(self):
+        """ Blocks until the current stream has finished playing """
+
+        if self._stream_thread is not None:
+            self._stream_thread.join()
+
+    def _run_stream(self, stream, bit_string, stop):
+        """ Fills the device buffer, starts the task and then keeps writing
+        chunks as space frees up. Writes block while the buffer is full, which
+        paces the loop. """
+
+        n_prefill = stream.buffer_size
+        n_written = 0
+        try:
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                self.task.write(self._compose_chunk(chunk, bit_string if n_written == 0 else None),
+                                auto_start=False)
+                n_written += len(chunk)
+                if (not self.running) and (n_written >= n_prefill):
+                    self.task.start()
+                    self.running = True
+
+            if (not self.running) and (n_written > 0) and (not stop.is_set()):
+                self.task.start()
+                self.running = True
+            # Let the device play out what is still in its buffer
+            stop.wait(min(n_written, stream.buffer_size) / float(self.samplerate))
+        except RuntimeError as e:
+            # Without regeneration, running out of samples is an error
+            stream.report_underrun("(%s)" % e)
+        finally:
+            stream.close()
+            self._stream_thread = None
+            try:
+                self.stop()
+            except RuntimeError:
+                pass
+
+    def _compose_chunk(self, chunk, bit_string=None):
+        """ Appends the event channel to a chunk, with bit_string at its start
+        if given """
+
+        if self.event_handler is None:
+            return chunk
+
+        buf = self.get_buffer(len(chunk), chunk.shape[1] + 1)
+        buf[:, :-1] = chunk
+        buf[:, -1] = 0
+        if bit_string is not None:
+            n_bits = min(len(bit_string), len(chunk))
+            buf[:n_bits, -1] = bit_string[:n_bits]
+
+        return buf
+
+
 class NIDAQmxInterface(base_.BaseInterface):
     """ Creates an interface for inputs and outputs to a NIDAQ card using
     the pylibnidaqmx library: https://github.com/imrehg/pylibnidaqmx
@@ -80,6 +420,9 @@ class NIDAQmxInterface(base_.BaseInterface):
         an event handler for sending event information down an analog channel.
         Should have a channel attribute. This can also be passed when you
         configure the analog output.
+    drain_interval: float
+        the time, in seconds, between reads of the continuous digital inputs
+        by the background thread
 
     Attributes
     ----------
@@ -104,6 +447,9 @@ class NIDAQmxInterface(base_.BaseInterface):
     _config_write_analog
     _config_read_analog
     _write_analog
+    _prepare_analog
+    _trigger_analog
+    _stream_analog
     _read_analog
 
     Examples
@@ -122,6 +468,10 @@ class NIDAQmxInterface(base_.BaseInterface):
     # Read from that input
     dev._read_bool("Dev1/port0/line1")
 
+    # Or sample it continuously so that polling reports every transition
+    dev._config_read("Dev1/port0/line2", continuous=True)
+    dev._poll("Dev1/port0/line2", timeout=10)
+
     # Configure an analog output on channel ao0
     dev._config_write("Dev1/ao0")
     # Set the output to True
@@ -135,14 +485,18 @@ class NIDAQmxInterface(base_.BaseInterface):
 
     def __init__(self, device_name, samplerate=30000,
                  analog_event_handler=None, clock_channel="OnboardClock",
-                 *args, **kwargs):
+                 drain_interval=0.005, *args, **kwargs):
         super(NIDAQmxInterface, self).__init__(*args, **kwargs)
         self.device_name = device_name
         self.samplerate = samplerate
         self.clock_channel = clock_channel
+        self.drain_interval = drain_interval
         self._analog_event_handler = analog_event_handler
 
         self.tasks = dict()
+        self._inputs = dict()
+        self._outputs = dict()
+        self._reader_thread = None
         self.open()
 
     def open(self):
@@ -155,6 +509,9 @@ class NIDAQmxInterface(base_.BaseInterface):
         """ Closes the nidaqmx device and deletes all of the tasks """
 
         logger.debug("Closing nidaqmx device named %s" % self.device_name)
+        self._stop_reader()
+        self._inputs = dict()
+        self._outputs = dict()
         for task in self.tasks.values():
             logger.debug("Deleting task named %s" % str(task.name))
             task.stop()
@@ -162,13 +519,18 @@ class NIDAQmxInterface(base_.BaseInterface):
             del task
         self.tasks = dict()
 
-    def _config_read(self, channel, **kwargs):
+    def _config_read(self, channel, continuous=False, buffer_seconds=10.0,
+                     **kwargs):
         """Configure a channel or group of channels as a boolean input
 
         Parameters
         ----------
         channel: string
             a channel or group of channels that will all be read from at the same time (e.g. "Dev1/port0/line1" or "Dev1/port0/line1-7")
+        continuous: bool
+            if True, the task runs on the sample clock from now until the device is closed. A background thread drains it into a host ring buffer and timestamps every transition of the first line from its sample index.
+        buffer_seconds: float
+            the length of the host ring buffer (and the driver's buffer) for continuous inputs
 
         Returns
         -------
@@ -182,9 +544,58 @@ class NIDAQmxInterface(base_.BaseInterface):
         task.configure_timing_sample_clock(source=self.clock_channel,
                                            rate=self.samplerate,
                                            sample_mode="continuous")
-        task.set_read_relative_to("most_recent")
-        task.set_read_offset(-1)
+        if not continuous:
+            task.set_read_relative_to("most_recent")
+            task.set_read_offset(-1)
+            self.tasks[channel] = task
+            return True
+
+        task.set_buffer_size(int(buffer_seconds * self.samplerate))
+        state = ContinuousInput(task, self.samplerate,
+                                buffer_seconds=buffer_seconds)
+        state.start()
         self.tasks[channel] = task
+        self._inputs[channel] = state
+        if self._reader_thread is None:
+            self._start_reader()
+
+        return True
+
+    def _start_reader(self):
+        """ Start a background thread that drains the continuous inputs """
+
+        self._reader_stop = threading.Event()
+        self._reader_thread = threading.Thread(target=self._run_reader,
+                                               args=(self._reader_stop,),
+                                               name="NIDAQmxReader(%s)" % self.device_name)
+        self._reader_thread.daemon = True
+        self._reader_thread.start()
+
+    def _stop_reader(self):
+        """ Stop and join the background reader thread, if it is running """
+
+        if self._reader_thread is None:
+            return
+        self._reader_stop.set()
+        self._reader_thread.join()
+        self._reader_thread = None
+
+    def _run_reader(self, stop):
+        """ Reads every continuous input each drain_interval until stopped. If
+        the driver's buffer overflowed, the task is restarted and the edges
+        missed in between are lost.
+        """
+
+        while not stop.is_set():
+            for channel, state in list(self._inputs.items()):
+                try:
+                    state.drain()
+                except RuntimeError as e:
+                    logger.warning("Restarting continuous input %s on %s after error: %s" % (channel, self.device_name, e))
+                    state.stop()
+                    state.level = None
+                    state.start()
+            stop.wait(self.drain_interval)
 
     def _config_write(self, channel, **kwargs):
         """ Configure a channel or group of channels as a boolean output
@@ -227,6 +638,18 @@ class NIDAQmxInterface(base_.BaseInterface):
         if channel not in self.tasks:
             raise NIDAQmxError("Channel(s) %s not yet configured" % str(channel))
 
+        if channel in self._inputs:
+            # The task is always running, so report the latest sample
+            value = self._inputs[channel].level
+            if value is None:
+                raise NIDAQmxError("No samples acquired yet on channel(s) %s" % str(channel))
+            if invert:
+                value = 1 - value
+            value = bool(value == 1)
+            if value:
+                events.write(event)
+            return value
+
         task = self.tasks[channel]
         task.start()
         # while task.get_samples_per_channel_acquired() == 0:
@@ -284,11 +707,11 @@ class NIDAQmxInterface(base_.BaseInterface):
         timeout: float
             the time, in seconds, until polling times out. Defaults to no timeout.
         wait: float
-            the time, in seconds, to wait between subsequent reads (default no wait).
+            the time, in seconds, to wait between subsequent reads (default no wait). Ignored for continuous inputs.
 
         Returns
         -------
-        timestamp of True read or None if timed out
+        timestamp of True read or None if timed out. For continuous inputs this is the timestamp of the sample at which the input became True.
         """
 
         logger.debug("Begin polling from device %s" % self.device_name)
@@ -298,6 +721,12 @@ class NIDAQmxInterface(base_.BaseInterface):
         if channel not in self.tasks:
             raise NIDAQmxError("Channel(s) %s not yet configured" % str(channel))
 
+        if channel in self._inputs:
+            return self._poll_continuous(self._inputs[channel], invert=invert,
+                                         last_value=last_value,
+                                         suppress_longpress=suppress_longpress,
+                                         timeout=timeout, event=event)
+
         task = self.tasks[channel]
         task.start()
         while True:
@@ -331,6 +760,45 @@ class NIDAQmxInterface(base_.BaseInterface):
             if wait is not None:
                 utils.wait(wait)
 
+    def _poll_continuous(self, state, invert=False, last_value=False,
+                         suppress_longpress=False, timeout=None, event=None):
+        """ Waits on a continuous input's edge queue for the input to become
+        True. See _poll for the parameters.
+        """
+
+        edges = state.edges
+        # Only transitions from here on count, so drop anything stale
+        while not edges.empty():
+            edges.get_nowait()
+
+        if state.level is not None:
+            value = bool(state.level == 1) != invert
+            if value and ((last_value is False) or (suppress_longpress is False)):
+                logger.debug("Input detected. Returning")
+                events.write(event)
+                return datetime.datetime.now()
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.debug("Polling timed out. Returning")
+                    return None
+            try:
+                edge = edges.get(timeout=remaining)
+            except queue.Empty:
+                logger.debug("Polling timed out. Returning")
+                return None
+
+            if bool(edge.level == 1) != invert:
+                logger.debug("Input detected. Returning")
+                events.write(event, time=edge.time)
+                return edge.time
+
 
     def _config_read_analog(self, channel, min_val=-10.0, max_val=10.0,
                             **kwargs):
@@ -386,16 +854,22 @@ class NIDAQmxInterface(base_.BaseInterface):
             analog_event_handler is not None:
             if not hasattr(analog_event_handler, "channel"):
                 raise AttributeError("analog_event_handler must have a channel attribute")
-            channel = nidaqmx.libnidaqmx.make_pattern([channel,
-                                                       analog_event_handler.channel])
             logger.debug("Configuring digital to analog output as well.")
             self._analog_event_handler = analog_event_handler
 
-        task.create_voltage_channel(channel, min_val=min_val, max_val=max_val)
-        task.configure_timing_sample_clock(source=self.clock_channel,
-                                           rate=self.samplerate,
-                                           sample_mode="finite")
+        task_channels = channel
+        if self._analog_event_handler is not None:
+            task_channels = nidaqmx.libnidaqmx.make_pattern([channel,
+                                                             self._analog_event_handler.channel])
+
+        task.create_voltage_channel(task_channels, min_val=min_val,
+                                    max_val=max_val)
         self.tasks[channel] = task
+        self._outputs[channel] = AnalogOutputTask(task, self.clock_channel,
+                                                  self.samplerate,
+                                                  event_handler=self._analog_event_handler)
+
+        return True
 
     def _read_analog(self, channel, nsamples, event=None, **kwargs):
         """ Read from a channel or group of channels for the specified number of
@@ -430,14 +904,15 @@ class NIDAQmxInterface(base_.BaseInterface):
     def _write_analog(self, channel, values, is_blocking=False, event=None,
                       **kwargs):
         """ Write a numpy array of float64 values to the buffer on a channel or
-        group of channels
+        group of channels and start the output. This is _prepare_analog
+        followed immediately by _trigger_analog.
 
         Parameters
         ----------
         channel: string
             a channel or group of channels that will all be written to at the same time
         values: numpy array of float64 values
-            values to write to the hardware. Should be of dimension nchannels x nsamples.
+            values to write to the hardware. Should be of dimension nsamples x nchannels.
         is_blocking: bool
             whether or not to block execution until all samples are written to the hardware
         event: dict
@@ -448,41 +923,110 @@ class NIDAQmxInterface(base_.BaseInterface):
         True
         """
 
-        if channel not in self.tasks:
+        self._prepare_analog(channel, values, event=event)
+        return self._trigger_analog(channel, is_blocking=is_blocking,
+                                    event=event)
+
+    def _prepare_analog(self, channel, values, event=None, **kwargs):
+        """ Write values to the device buffer of a channel or group of
+        channels without starting output. The task and its output buffer are
+        reused, so call this before the time-critical part of a trial and
+        _trigger_analog when the output should begin.
+
+        Parameters
+        ----------
+        channel: string
+            a channel or group of channels that will all be written to at the same time
+        values: numpy array of float64 values
+            values to write to the hardware. Should be of dimension nsamples x nchannels.
+        event: dict
+            a dictionary of event information to encode on the event channel
+
+        Returns
+        -------
+        True
+        """
+
+        if channel not in self._outputs:
             raise NIDAQmxError("Channel(s) %s not yet configured" % str(channel))
 
-        task = self.tasks[channel]
-        task.stop()
-        task.configure_timing_sample_clock(source=self.clock_channel,
-                                           rate=self.samplerate,
-                                           sample_mode="finite",
-                                           samples_per_channel=values.shape[0])
+        self._outputs[channel].prepare(values, event=event)
 
-        if self._analog_event_handler is not None:
-            # Get the string of (scaled) bits from the event handler
-            bit_string = self._analog_event_handler.to_bit_sequence(event)
+        return True
 
-            # multi-channel outputs need to be of shape nsamples x nchannels
-            if len(values.shape) == 1:
-                values = values.reshape((-1, 1))
+    def _trigger_analog(self, channel, is_blocking=False, event=None,
+                        **kwargs):
+        """ Start output of the values prepared on a channel or group of
+        channels
 
-            # Add a channel of all zeros
-            values = np.hstack([values, np.zeros((values.shape[0], 1))])
-            # Place the bit string at the start
-            values[:len(bit_string), -1] = bit_string
+        Parameters
+        ----------
+        channel: string
+            a channel or group of channels that will all be written to at the same time
+        is_blocking: bool
+            whether or not to block execution until all samples are written to the hardware
+        event: dict
+            a dictionary of event information to emit just before starting
+
+        Returns
+        -------
+        True
+        """
+
+        if channel not in self._outputs:
+            raise NIDAQmxError("Channel(s) %s not yet configured" % str(channel))
 
-        # Write the values to the nidaq buffer
-        # I think we might want to set layout='group_by_scan_number' in .write()
-        task.write(values, auto_start=False)
         events.write(event)
-        task.start()
-        if is_blocking:
-            task.wait_until_done()
-            task.stop()
+        self._outputs[channel].trigger(is_blocking=is_blocking)
 
         return True
 
 
+    def _stream_analog(self, channel, data, chunk_size=None, buffer_size=None,
+                       is_blocking=False, event=None, **kwargs):
+        """ Stream values to a channel or group of channels in chunks, so that
+        arbitrarily long or generated signals can be output with a fixed
+        amount of memory. The stream is read ahead in a background thread and
+        written to the device from another.
+
+        Parameters
+        ----------
+        channel: string
+            a channel or group of channels that will all be written to at the same time
+        data: numpy array or iterable
+            an array (e.g. a np.memmap) of dimension nsamples x nchannels, or an iterable of such arrays (e.g. a generator)
+        chunk_size: int
+            the number of samples per write (default 0.1 seconds)
+        buffer_size: int
+            the number of samples buffered on the device and read ahead on the host (default 1 second)
+        is_blocking: bool
+            whether or not to block execution until the stream has finished
+        event: dict
+            a dictionary of event information to emit just before streaming
+
+        Returns
+        -------
+        the AnalogOutputStream, whose underruns attribute counts underruns
+        """
+
+        if channel not in self._outputs:
+            raise NIDAQmxError("Channel(s) %s not yet configured" % str(channel))
+
+        if chunk_size is None:
+            chunk_size = int(self.samplerate / 10)
+        if buffer_size is None:
+            buffer_size = int(self.samplerate)
+
+        output = self._outputs[channel]
+        events.write(event)
+        stream = output.start_stream(data, chunk_size, buffer_size,
+                                     event=event)
+        if is_blocking:
+            output.wait_stream()
+
+        return stream
+
+
 class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
     """ Creates an interface for writing audio data to a NIDAQ card using
     the pylibnidaqmx library: https://github.com/imrehg/pylibnidaqmx
@@ -510,18 +1054,27 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
         the task used for writing out sound data
     wf: file handle
         the currently playing wavefile handle
+    stimuli: dict
+        preloaded output buffers keyed by wavefile name
 
     Methods
     -------
     _config_write_analog
+    _preload_wav
     _get_stream
     _queue_wav
+    _queue_sequence
     _play_wav
+    _play_wav_at
     _stop_wav
+    is_playing
 
     Examples
     --------
-
+    # Decode a block's stimuli once, then queue them without file I/O
+    dev._preload_wav(["/path/to/stim1.wav", "/path/to/stim2.wav"])
+    dev._queue_wav("/path/to/stim1.wav", event=event)
+    dev._play_wav()
     """
     def __init__(self, device_name, samplerate=30000.0,
                  clock_channel=None, *args, **kwargs):
@@ -533,6 +1086,10 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
         self.stream = None
         self.wf = None
         self._wav_data = None
+        self._output = None
+        self.stimuli = dict()
+        self._scheduled = None
+        self._start_thread = None
 
     def _config_write_analog(self, channel, analog_event_handler=None,
                              min_val=-10.0, max_val=10.0, **kwargs):
@@ -560,7 +1117,59 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
                                                 min_val=min_val,
                                                 max_val=max_val,
                                                 **kwargs)
-        self.stream = self.tasks.values()[0]
+        self.stream = self.tasks[channel]
+        self._output = self._outputs[channel]
+
+    def _preload_wav(self, wav_files, **kwargs):
+        """ Decode wave files into output buffers, with the event channel
+        already laid out, so that queueing them later only has to write the
+        buffer to the device. Previously preloaded files that are not in
+        wav_files are released.
+
+        Parameters
+        ----------
+        wav_files: list
+            Paths to the wave files to load
+
+        Returns
+        -------
+        True
+        """
+
+        stimuli = dict()
+        for wav_file in wav_files:
+            if wav_file in stimuli:
+                continue
+            if wav_file in self.stimuli:
+                stimuli[wav_file] = self.stimuli[wav_file]
+                continue
+            logger.debug("Preloading wavfile %s" % wav_file)
+            stimuli[wav_file] = self._compose_wav(wav_file)
+        self.stimuli = stimuli
+
+        return True
+
+    def _compose_wav(self, wav_file):
+        """ Loads a wave file as a contiguous nsamples x nchannels float64
+        array, followed by an empty event channel if there is an analog event
+        handler.
+        """
+
+        return self._compose_samples(stimulus_cache.get(wav_file))
+
+    def _compose_samples(self, wav):
+        """ Lays out a decoded wave file (a stimuli.CachedWav) as
+        _compose_wav does """
+
+        dtype, max_val = self._get_dtype(wav)
+        data = (wav.samples / max_val).reshape((-1, wav.getnchannels()))
+        n_channels = data.shape[1]
+        if self._analog_event_handler is not None:
+            n_channels += 1
+        composed = np.zeros((data.shape[0], n_channels), dtype=np.float64)
+        composed[:, :data.shape[1]] = data
+
+        return composed
 
     def _queue_wav(self, wav_file, start=False, event=None, **kwargs):
         """ Queue the wav file for playback
@@ -575,26 +1184,50 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
             a dictionary of event information to emit just before playback
         """
 
-        if self.wf is not None:
+        if self._wav_data is not None:
             self._stop_wav()
 
         events.write(event)
-        logger.debug("Queueing wavfile %s" % wav_file)
-        self._wav_data = self._load_wav(wav_file)
+        if wav_file in self.stimuli:
+            logger.debug("Queueing preloaded wavfile %s" % wav_file)
+            self._wav_data = self.stimuli[wav_file]
+        else:
+            logger.debug("Queueing wavfile %s" % wav_file)
+            self._wav_data = self._compose_wav(wav_file)
+        self._queue_data(event=event, start=start, **kwargs)
+
+    def _queue_sequence(self, sequence, start=False, event=None, **kwargs):
+        """ Queue a sequence of wave files to play back to back in one
+        buffer, with no gaps other than the silences requested
 
-        if self._analog_event_handler is not None:
-            # Get the string of (scaled) bits from the event handler
-            bit_string = self._analog_event_handler.to_bit_sequence(event)
+        Parameters
+        ----------
+        sequence: list
+            (wav_file, isi) pairs, where isi is the silence in seconds after
+            the file
+        start: bool
+            Whether or not to immediately start playback
+        event: dict
+            a dictionary of event information to emit just before playback
+        """
 
-            # multi-channel outputs need to be of shape nsamples x nchannels
-            if len(self._wav_data.shape) == 1:
-                values = self._wav_data.reshape((-1, 1))
-            else:
-                values = self._wav_data
+        if self._wav_data is not None:
+            self._stop_wav()
+
+        events.write(event)
+        logger.debug("Queueing sequence of %d wavfiles" % len(sequence))
+        wav, offsets = concat_wavs(sequence)
+        self._wav_data = self._compose_samples(wav)
+        self._queue_data(event=event, start=start, **kwargs)
+
+    def _queue_data(self, event=None, start=False, **kwargs):
+        """ Writes the event bits into the queued data and writes it to the
+        device """
 
-            # Add a channel of all zeros
-            self._wav_data = np.hstack([values, np.zeros((values.shape[0], 1))])
-            # Place the bit string at the start
+        if self._analog_event_handler is not None:
+            # Get the string of (scaled) bits from the event handler. Its
+            # length is fixed, so this overwrites any previous event in place.
+            bit_string = self._analog_event_handler.to_bit_sequence(event)
             self._wav_data[:len(bit_string), -1] = bit_string
         self._get_stream(start=start, **kwargs)
 
@@ -607,10 +1240,8 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
             Whether or not to immediately start playback
         """
 
-        self.stream.configure_timing_sample_clock(source=self.clock_channel,
-                                                  rate=self.samplerate,
-                                                  sample_mode="finite",
-                                                  samples_per_channel=self._wav_data.shape[0])
+        # The sample clock is only reconfigured if the length changed
+        self._output.configure(self._wav_data.shape[0])
         # I think we might want to set layout='group_by_scan_number' in .write()
         self.stream.write(self._wav_data, auto_start=False)
         if start:
@@ -631,7 +1262,51 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
         events.write(event)
         self.stream.start()
         if is_blocking:
-            self.wait_until_done()
+            self.stream.wait_until_done()
+
+    def _play_wav_at(self, start_time, is_blocking=False, event=None, **kwargs):
+        """ Play the data that is currently in the buffer starting at a given
+        time. The data is already on the device, so a thread only has to wait
+        on the host clock and start the task.
+
+        Parameters
+        ----------
+        start_time: float
+            The time.monotonic() time at which to start
+        is_blocking: bool
+            Whether or not to block until the sound has played
+        event: dict
+            a dictionary of event information, written with the start time
+        """
+
+        logger.debug("Playing wavfile at %.4f" % start_time)
+        events.write(event, time=datetime.datetime.fromtimestamp(time.time() + start_time - time.monotonic()))
+        cancel = threading.Event()
+        self._scheduled = cancel
+
+        def start():
+            utils.wait_until(start_time)
+            if not cancel.is_set():
+                self.stream.start()
+
+        if is_blocking:
+            start()
+            self.stream.wait_until_done()
+        else:
+            thread = threading.Thread(target=start, name="NIDAQmxPlayAt")
+            thread.daemon = True
+            thread.start()
+            self._start_thread = thread
+
+    def is_playing(self, **kwargs):
+        """ Whether a sound is scheduled or its output task is still running """
+
+        if self.stream is None:
+            return False
+        thread = self._start_thread
+        if (thread is not None) and thread.is_alive():
+            return True
+        return not self.stream.is_done()
 
     def _stop_wav(self, event=None, **kwargs):
         """ Stop the current playback and clear the buffer
@@ -642,6 +1317,9 @@ class NIDAQmxAudioInterface(NIDAQmxInterface, base_.AudioInterface):
             a dictionary of event information to emit just before stopping
         """
 
+        if self._scheduled is not None:
+            self._scheduled.set()
+            self._scheduled = None
         try:
             logger.debug("Attempting to close stream")
             events.write(event)
@@ -2,6 +2,7 @@
 from ctypes import *
 from contextlib import contextmanager
 import collections
+import datetime
 import os
 import logging
 import queue
@@ -13,9 +14,10 @@ import scipy.io.wavfile
 import time
 
 import pyaudio
-import wave
 from pyoperant.interfaces import base_
+from pyoperant.interfaces.utils import SPSCRingBuffer, WavSegmentRecorder
 from pyoperant import InterfaceError, utils
+from pyoperant.stimuli import stimulus_cache, concat_wavs
 from pyoperant.events import events
 
 
@@ -23,6 +25,7 @@ logger = logging.getLogger(__name__)
 
 
 REC_CHUNK = 1024
+PLAY_CHUNK = 1024
 
 FauxTb = collections.namedtuple("FauxTb", ["tb_frame", "tb_lineno", "tb_next"])
 _exception_queue = queue.Queue()
@@ -127,134 +130,245 @@ def log_alsa_warnings():
         yield
 
 
-class RingBuffer(object):
-    """A circular buffer
+def apply_gain(samples, gain=None):
+    """ Scales integer PCM samples by a gain in dB, clipping to the range of
+    their dtype, and returns them as bytes ready to hand to PortAudio.
+    """
+
+    if not gain:
+        return samples.tobytes()
+
+    info = np.iinfo(samples.dtype)
+    scaled = samples * np.float32(10.0 ** (gain / 20.0))
+    np.clip(scaled, info.min, info.max, out=scaled)
+    return scaled.astype(samples.dtype).tobytes()
 
-    Allocates space for the max buffer length. Use RingBuffer.extend(data)
-    to add to the buffer and RingBuffer.to_array() to get the current contents.
 
-    Methods
-    =======
-    RingBuffer.extend(data)
-        Extends the buffer with a 2D numpy array
-    RingBuffer.to_array()
-        Return an array representation of data in the buffer (copied
-        so that it can be modified without affecting the buffer)
+def dac_delay(time_info, latency=0.0):
+    """ Time in seconds from now until the first frame of an output
+    callback's buffer reaches the DAC. PortAudio reports that time and the
+    time of the callback on the stream's clock, so this is their difference.
+    Backends that leave them at 0 fall back to the stream's output latency.
     """
-    def __init__(self, maxlen=0, n_channels=None, dtype=None):
-        """Initialize circular buffer
-
-        Params
-        ======
-        maxlen : int (default 0)
-            Maximum size of buffer
-        n_channels : int (default None)
-            Enforce number of channels in buffer. If None,
-            will choose the number of channels the first time .extend()
-            is called.
-        dtype : type (default None)
-            Enforce datatype of buffer. If None,
-            will choose the datatype the first time .extend()
-            is called.
-        """
-        self.maxlen = maxlen
 
-        # Keep track of original value for if the buffer is cleared
-        self._init_n_channels = n_channels
-        self.n_channels = n_channels
-        self._init_dtype = dtype
-        self.dtype = dtype
-
-        # Data is stored in a numpy array of maxlen even when
-        # the amount of data is smaller than that. When data
-        # exceeds maxlen we loop around and keep track of where we
-        # started.
-        self._write_at = 0  # Where the next data should be written
-        self._length = 0  # The amount of samples of real data in the buffer
-        self._start = 0  # Starting index where data should be read from
-        self._overlapping = False  # Has the data wrapper around the end
-        self._ringbuffer = np.zeros((self.maxlen, self.n_channels or 0), dtype=self.dtype or np.int16)
-
-    def __len__(self):
-        return self._length
-
-    def __array__(self):
-        return self.to_array()
-
-    def to_array(self):
-        # Read to the end and then wrap around to the beginning
-        # if self._start + self._length > self.maxlen:
-        if self._overlapping:
-            return np.roll(self._ringbuffer, -self._start, axis=0)
+    dac = time_info.get("output_buffer_dac_time", 0.0) if time_info else 0.0
+    current = time_info.get("current_time", 0.0) if time_info else 0.0
+    if (dac > 0) and (current > 0):
+        return dac - current
+    return latency
+
+
+def dac_time(time_info, latency=0.0):
+    """ Host time (seconds since the epoch) at which the first frame of an
+    output callback's buffer reaches the DAC """
+
+    return time.time() + dac_delay(time_info, latency)
+
+
+def _monotonic_to_datetime(monotonic_time):
+    return datetime.datetime.fromtimestamp(time.time() + monotonic_time - time.monotonic())
+
+
+def _release(*playbacks):
+    """ Marks playbacks that were dropped before being handed over
+    completely as done """
+
+    for playback in playbacks:
+        if playback is not None:
+            playback.done.set()
+
+
+def _wait_onset(playback, timeout=1.0, event=None):
+    """ Waits until a playback has been handed to PortAudio, writes its onset
+    to the events and returns it as a datetime (None if it did not start
+    within timeout) """
+
+    if (playback is None) or (not playback.started.wait(timeout)):
+        return None
+    events.write(event, time=playback.onset)
+
+    return playback.onset
+
+
+def _wait_onsets(playback, timeout=1.0, event=None):
+    """ Waits until a playback has been handed to PortAudio, writes the onset
+    of each of its elements to the events, with the element's file as
+    metadata, and returns them as datetimes (None if it did not start within
+    timeout) """
+
+    if (playback is None) or (not playback.started.wait(timeout)):
+        return None
+    onsets = playback.onsets
+    if event is not None:
+        for (offset, name), onset in zip(playback.elements, onsets):
+            events.write(dict(event, metadata=name), time=onset)
+
+    return onsets
+
+
+class Playback(object):
+    """A decoded sound as it is handed to PortAudio
+
+    Parameters
+    ----------
+    samples : numpy array
+        The interleaved integer samples of the sound
+    params : tuple
+        (rate, sampwidth, nchannels) of the samples
+    gain : float
+        Gain in dB to apply to the samples
+    raw : bytes
+        The samples as bytes, handed over as they are when there is no gain
+    elements : list
+        (frame offset, name) of each sound in a sequence joined into one
+        playback
+
+    Attributes
+    ----------
+    data : memoryview
+        The samples with the gain applied, which read slices without copying
+    position : int
+        Byte offset of the next slice to hand over
+    done : threading.Event
+        Set once the last slice has been handed over, or the playback was
+        dropped
+    started : threading.Event
+        Set once the first slice has been handed over
+    onset_time : float
+        Host time (seconds since the epoch) at which the first sample reaches
+        the DAC, once started
+    start_at : float
+        If set, the time.monotonic() time at which the first sample should
+        reach the DAC
+    """
+    def __init__(self, samples, params, gain=None, raw=None, elements=None):
+        self.samples = samples
+        self.raw = raw
+        self.params = params
+        if elements is None:
+            elements = [(0, None)]
+        self.elements = elements
+        self.frame_bytes = params[1] * params[2]
+        self.position = 0
+        self.done = threading.Event()
+        self.started = threading.Event()
+        self.onset_time = None
+        self.start_at = None
+        self.set_gain(gain)
+
+    def set_onset(self, onset_time):
+        self.onset_time = onset_time
+        self.started.set()
+
+    def start_frame(self, delay, rate):
+        """The frame of a callback's buffer, whose first frame reaches the DAC
+        in delay seconds, at which this playback should start (0 if it is
+        unscheduled or late)"""
+        if self.start_at is None:
+            return 0
+        return max(0, int(round((self.start_at - time.monotonic() - delay) * rate)))
+
+    @property
+    def onset(self):
+        """The onset as a datetime"""
+        if self.onset_time is None:
+            return None
+        return datetime.datetime.fromtimestamp(self.onset_time)
+
+    @property
+    def onsets(self):
+        """The onset of each element as a datetime"""
+        if self.onset_time is None:
+            return None
+        rate = float(self.params[0])
+        return [datetime.datetime.fromtimestamp(self.onset_time + offset / rate)
+                for offset, name in self.elements]
+
+    def set_gain(self, gain):
+        self.gain = gain
+        if (not gain) and (self.raw is not None):
+            self.data = memoryview(self.raw)
         else:
-            return self._ringbuffer[:self._length].copy()
+            self.data = memoryview(apply_gain(self.samples, gain))
+
+    @property
+    def finished(self):
+        return self.position >= len(self.data)
 
-    def clear(self):
-        self._write_at = 0
-        self._length = 0
-        self._start = 0
-        self.n_channels = self._init_n_channels
-        self.dtype = self._init_dtype
-        self._overlapping = False
-        self._ringbuffer = np.zeros((self.maxlen, self.n_channels or 0), dtype=self.dtype or np.int16)
+    def read(self, nbytes):
+        """Return a view of the next nbytes of data (fewer at the end)"""
+        start = self.position
+        self.position = start + nbytes
+        return self.data[start:self.position]
 
-    def extend(self, data):
-        """Extend the buffer with a 2D (samples x channels) array
+    def read_frames(self, n_frames):
+        """Return the next n_frames as an array of samples (fewer at the end)"""
+        return np.frombuffer(self.read(n_frames * self.frame_bytes),
+                             dtype=self.samples.dtype)
 
-        Requires shape to be consistent with existing data
+
+def _read_ring_range(buffer, rate, start_time, stop_time):
+    """ Reads the samples recorded between two times (seconds since the epoch
+    or datetimes) from a SPSCRingBuffer, counting back from now """
+
+    if isinstance(start_time, datetime.datetime):
+        start_time = start_time.timestamp()
+    if isinstance(stop_time, datetime.datetime):
+        stop_time = stop_time.timestamp()
+    now = time.time()
+    written = buffer.written
+    start = written - int((now - start_time) * rate)
+    stop = written - int((now - stop_time) * rate)
+    return buffer.read_range(max(start, 0), min(stop, written))
+
+
+class PyAudioDevice(base_.AudioInterface):
+    """Finds a PortAudio device by its name (self.device_name) and opens
+    PyAudio for it"""
+
+    def _refresh_device_index(self):
+        """Use this on pyaudio errors to check if the device index hsa changed
         """
-        if self.maxlen == 0:
-            return
+        old_device_index = self.device_index
+        for index in range(self.pa.get_device_count()):
+            if self.device_name == self.pa.get_device_info_by_index(index)['name']:
+                logger.debug("Found device %s at index %d" % (self.device_name, index))
+                self.device_index = index
+                break
+            else:
+                self.device_index = None
+        if old_device_index != self.device_index:
+            logger.debug("Device index changed from {} to {}".format(old_device_index, self.device_index))
 
-        # Reshape 1-D signals to be 2D with one channel
-        to_add = np.array(data)
-        if self.dtype is None:
-            self.dtype = to_add.dtype
-            self._ringbuffer = self._ringbuffer.astype(self.dtype)
-
-        if to_add.ndim == 1:
-            to_add = to_add[:, None]
-
-        # Enforce channels here
-        if self.n_channels and to_add.shape[1] != self.n_channels:
-            raise ValueError("Cannot extend {} channel Buffer with data of shape {}".format(
-                self.n_channels,
-                to_add.shape
-            ))
-
-        if self._length == 0 and self.n_channels is None:
-            self._ringbuffer = np.zeros((self.maxlen, to_add.shape[1]), dtype=self.dtype)
-            self.n_channels = to_add.shape[1]
-
-        if len(to_add) > self.maxlen:
-            self._ringbuffer[:] = to_add[-self.maxlen:]
-            self._write_at = 0
-            self._length = self.maxlen
-            self._start = 0
-            self._overlapping = False
-        elif self._write_at + len(to_add) < self.maxlen:
-            self._ringbuffer[self._write_at:self._write_at + len(to_add)] = to_add
-            self._write_at += len(to_add)
-            self._length = self.maxlen if self._overlapping else self._write_at
-            self._start = self._write_at if self._overlapping else 0
-        else:
-            first_part_size = self.maxlen - self._write_at
-            first_part = to_add[:first_part_size]
-            second_part = to_add[first_part_size:]
-            self._ringbuffer[self._write_at:] = first_part
-            self._ringbuffer[:len(second_part)] = second_part
-            self._write_at = len(second_part)
-            self._length = self.maxlen
-            self._start = self._write_at
-            self._overlapping = True
+        if self.device_index == None:
+            raise InterfaceError('could not find pyaudio device %s' % (self.device_name))
 
-    def read_last(self, n_samples):
-        return self.to_array()[-n_samples:]
+    def open(self):
+        with log_alsa_warnings():
+            self.pa = pyaudio.PyAudio()
+        self._refresh_device_index()
+        self.device_info = self.pa.get_device_info_by_index(self.device_index)
+        self.rate = int(self.device_info["defaultSampleRate"])
 
 
-class PyAudioInterface(base_.AudioInterface):
+class PyAudioInterface(PyAudioDevice):
     """Class which holds information about an audio device
 
+    Playback uses PortAudio's callback mode. Queueing a file decodes it
+    completely, applies the gain once to the whole buffer and opens a stopped
+    output stream. Playing starts the stream, and each callback only hands
+    over the next slice of the buffer.
+
+    With persistent_stream=True a single output stream stays open and plays
+    silence between sounds. Queueing arms the next sound, playing switches to
+    it on the next callback, and the stream is only reopened when the sample
+    rate, width or channel count changes.
+
+    A microphone (is_mic=True) keeps the last 20 seconds in memory. With a
+    record_directory, everything it records is also archived on disk as WAV
+    files of at most record_segment_bytes, and any time range of the session
+    can be read back with _get_recorded_range.
+
     assign a simple callback function that will execute on each frame
     presentation by writing interface.callback
 
@@ -265,7 +379,9 @@ class PyAudioInterface(base_.AudioInterface):
     https://www.assembla.com/spaces/portaudio/wiki/Tips_Callbacks
 
     """
-    def __init__(self, device_name="default", is_mic=False, *args, **kwargs):
+    def __init__(self, device_name="default", is_mic=False,
+                 persistent_stream=False, record_directory=None,
+                 record_segment_bytes=100 * 2 ** 20, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.device_name = device_name
         self.device_index = None
@@ -276,48 +392,43 @@ class PyAudioInterface(base_.AudioInterface):
         self.open()
         self.gain = None
         self.stream = None
-        self.play_thread = None
-        self._playback_quit_signal = None
-        self._playback_lock = threading.Lock()
-
+        self.persistent_stream = persistent_stream
+        self._stream_params = None
+        self._frame_bytes = 0
+        self._silence = b""
+        self._output_latency = 0.0
+        # The last Playback played, whose onset _get_onset reports
+        self._played = None
+
+        # A queued Playback moves from _armed (queued) to _pending (played,
+        # waiting for the next callback) to _current (being handed over).
+        # _handover guards _pending and _current, which both threads change.
+        self._armed = None
+        self._pending = None
+        self._current = None
+        self._handover = threading.Lock()
+
+        self.record_directory = record_directory
+        self.record_segment_bytes = record_segment_bytes
+        self.recorder = None
         if is_mic:
             self.rec_stream = None
-            self.record_buffer = RingBuffer()
+            self.record_buffer = None
             self.listen()
 
     def set_gain(self, gain):
         self.gain = gain
 
-    def _refresh_device_index(self):
-        """Use this on pyaudio errors to check if the device index hsa changed
-        """
-        old_device_index = self.device_index
-        for index in range(self.pa.get_device_count()):
-            if self.device_name == self.pa.get_device_info_by_index(index)['name']:
-                logger.debug("Found device %s at index %d" % (self.device_name, index))
-                self.device_index = index
-                break
-            else:
-                self.device_index = None
-        if old_device_index != self.device_index:
-            logger.debug("Device index changed from {} to {}".format(old_device_index, self.device_index))
-
-        if self.device_index == None:
-            raise InterfaceError('could not find pyaudio device %s' % (self.device_name))
-
-    def open(self):
-        with log_alsa_warnings():
-            self.pa = pyaudio.PyAudio()
-        self._refresh_device_index()
-        self.device_info = self.pa.get_device_info_by_index(self.device_index)
-        self.rate = int(self.device_info["defaultSampleRate"])
-
     def close(self):
         if not sys.is_finalizing():
             logger.debug("Closing device")
 
         self.abort_signal.set()
         self.abort_signal = threading.Event()
+        self._close_stream()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
         try:
             self.wf.close()
@@ -325,17 +436,20 @@ class PyAudioInterface(base_.AudioInterface):
             self.wf = None
         self.pa.terminate()
 
-    def _try_hard_to_open_stream(self, wf, chunk, retries=10, wait=0.5):
+    def _try_hard_to_open_stream(self, rate, sampwidth, nchannels, chunk,
+                                 callback=None, retries=10, wait=0.5):
         errors = []
         for attempt in range(retries + 1):
             try:
                 stream = self.pa.open(
-                    format=self.pa.get_format_from_width(wf.getsampwidth()),
-                    channels=wf.getnchannels(),
-                    rate=wf.getframerate(),
+                    format=self.pa.get_format_from_width(sampwidth),
+                    channels=nchannels,
+                    rate=rate,
                     output=True,
                     frames_per_buffer=chunk,
                     output_device_index=self.device_index,
+                    stream_callback=callback,
+                    start=callback is None,
                 )
             except Exception as e:
                 errors.append(e)
@@ -362,98 +476,352 @@ class PyAudioInterface(base_.AudioInterface):
                     ))
                 return stream
 
-    def _run_play(self, wf=None, quit_signal=None, abort_signal=None):
-        """Function to play back a sound
-
-        Plays back a sound in chunks of 512 until the wav file is completed
-        or a quit_signal or abort_signal is received.
-
-        Parameters
-        ----------
-        wf : wav file opened with wave.open
-        quit_signal : threading.Event
-            thread-safe signal that will end the playback when the event is set
-        abort_signal : threading.Event
-            thread-safe signal that will end the playback when the event is set
+    def _play_callback(self, in_data, frame_count, time_info, status):
+        """PortAudio output callback. Hands over the next slice of the
+        current playback and switches to a pending one, at the frame it is
+        scheduled for if it has a start time. Plays silence otherwise.
+        Without a persistent stream, the stream completes after the last
+        slice and PortAudio pads it with silence.
         """
-        chunk = 1024
+        nbytes = frame_count * self._frame_bytes
+        switch = nbytes
+        with self._handover:
+            pending = self._pending
+            if pending is not None:
+                rate = self._stream_params[0]
+                delay = dac_delay(time_info, self._output_latency)
+                frame = pending.start_frame(delay, rate)
+                if frame < frame_count:
+                    self._pending = None
+                    switch = frame * self._frame_bytes
+                    pending.set_onset(time.time() + delay + frame / float(rate))
+
+            # Whatever is playing continues up to the switch. Slices are
+            # memoryviews, and PortAudio gets them joined into one bytes
+            # object.
+            data = self._read_current(switch)
+            if switch < nbytes:
+                chunks = [data]
+                if len(data) < switch:
+                    chunks.append(self._silence[:switch - len(data)])
+                self._current = pending
+                chunks.append(self._read_current(nbytes - switch))
+                data = b"".join(chunks)
+
+            complete = (not self.persistent_stream) and \
+                (self._current is None) and (self._pending is None)
+        if complete:
+            return bytes(data), pyaudio.paComplete
+        if len(data) < nbytes:
+            data = b"".join((data, self._silence[:nbytes - len(data)]))
+
+        return bytes(data), pyaudio.paContinue
+
+    def _read_current(self, nbytes):
+        """The next nbytes (fewer at the end) of the current playback"""
+        current = self._current
+        if current is None:
+            return b""
+
+        data = current.read(nbytes)
+        if current.finished:
+            self._current = None
+            current.done.set()
+        return data
+
+    def _open_output_stream(self, params):
+        """Open an output stream for (rate, sampwidth, nchannels). A
+        persistent stream is kept if it already has that format.
+        """
+        if self.persistent_stream and (self.stream is not None) and \
+                (params == self._stream_params):
+            return
 
-        if self.stream:
+        self._close_stream()
+        rate, sampwidth, nchannels = params
+        self._frame_bytes = sampwidth * nchannels
+        # Enough silence for callbacks larger than requested
+        self._silence = bytes(4 * PLAY_CHUNK * self._frame_bytes)
+
+        # Try at most for 1 second to open the stream
+        self.stream = self._try_hard_to_open_stream(rate, sampwidth, nchannels,
+                                                    PLAY_CHUNK,
+                                                    callback=self._play_callback,
+                                                    retries=5, wait=0.2)
+        self._stream_params = params
+        self._output_latency = self.stream.get_output_latency()
+        if self.persistent_stream:
+            logger.debug("Starting persistent output stream: {}".format(params))
+            self.stream.start_stream()
+
+    def _stop_playback(self):
+        """Drop the pending and current playback. A persistent stream
+        continues with silence on its next callback."""
+        with self._handover:
+            dropped = (self._pending, self._current)
+            self._pending = None
+            self._current = None
+        _release(*dropped)
+
+    def _close_stream(self):
+        """Stop and close the output stream, if there is one"""
+        self._stop_playback()
+        if self.stream is None:
+            return
+        logger.debug("Attempting to close pyaudio stream")
+        try:
             self.stream.stop_stream()
             self.stream.close()
+        except Exception as e:
+            logger.warning("Error closing pyaudio stream: {}".format(e))
+        self.stream = None
+        self._stream_params = None
 
-        # Try at most for 1 seconds to open stream
-        self.stream = self._try_hard_to_open_stream(wf, chunk, retries=5, wait=0.2)
-
-        data = wf.readframes(chunk)
+    def _load_pcm(self, wav_file):
+        """Decode a wave file, through the shared stimulus cache
 
-        while data != b"":
-            if quit_signal.is_set() or abort_signal.is_set():
-                logger.debug("Attempting to close pyaudio stream on interrupt")
-                self.stream.close()
-                self._playback_lock.release()
-                logger.debug("Stream closed")
-                break
+        Returns
+        -------
+        wav : stimuli.CachedWav
+        params : tuple of (rate, sampwidth, nchannels)
+        """
+        wav = stimulus_cache.get(wav_file)
+        params = (wav.getframerate(), wav.getsampwidth(), wav.getnchannels())
 
-            dtype, max_val = self._get_dtype(wf)
-            data = np.frombuffer(data, dtype)
+        return wav, params
 
-            if self.gain:
-                data = data * np.power(10.0, self.gain / 20.0)
+    def is_playing(self, **kwargs):
+        """Whether a sound has been played and not yet handed over completely"""
+        return (self._pending is not None) or (self._current is not None)
 
-            data = data.astype(dtype).tostring()
-            self.stream.write(data)
-            data = wf.readframes(chunk)
-        else:  # This block is run when the while condition becomes False (not on break)
-            logger.debug("Attempting to close pyaudio stream on file complete")
-            self._playback_lock.release()
-            # Closing the stream here can cut off a pretty significant portion of the playback
-            # Instead we let the stream finish and close itself.
+    def rec_callback(self, in_data, frame_count, time_info, status):
+        # Runs on the PortAudio thread: a single copy into the preallocated
+        # buffer, which the main thread can read without locking
+        self.record_buffer.write(in_data)
+        return in_data, pyaudio.paContinue
 
-        try:
-            wf.close()
-        except:
-            logger.error("Error closing wave file. Attempting to continue")
-
-    def _get_stream(self, start=False, event=None, **kwargs):
-        """Prepare a thread to run stimulus playback
-
-        Parameters
-        ----------
-        start : bool
-            When set to true, automatically launch the playback thread right away
-        event :
-            Evenet for logging purposes
+    def listen(self):
+        """Start microphone recording stream
         """
-        new_quit_signal = threading.Event()
-
-        self.play_thread = threading.Thread(
-            target=self._run_play,
-            kwargs={
-                "wf": self.wf,
-                "quit_signal": new_quit_signal,
-                "abort_signal": self.abort_signal
-            }
+        # Set up buffer to store last 20 seconds of audio at all times
+        self.record_buffer = SPSCRingBuffer(int(self.rate) * 20, n_channels=1,
+                                            dtype=np.int16)
+        self.rec_stream = self.pa.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=self.rate,
+            input_device_index=self.device_index,
+            input=True,
+            output=False,
+            frames_per_buffer=REC_CHUNK,
+            stream_callback=self.rec_callback
         )
+        if self.record_directory is not None:
+            self.recorder = WavSegmentRecorder(self.record_buffer, self.rate,
+                                               self.record_directory,
+                                               prefix=self.device_name,
+                                               segment_bytes=self.record_segment_bytes)
+            self.recorder.start()
+
+    def _get_last_recorded_data(self, duration, **kwargs):
+        """Get last few seconds of recorded audio input from mic buffer, or
+        from disk if they are no longer in the buffer"""
+        n_samples = int(duration * self.rate)
+        if (self.recorder is not None) and (n_samples > self.record_buffer.maxlen):
+            written = self.record_buffer.written
+            return self.recorder.read(written - n_samples, written), self.rate
+        return self.record_buffer.read_last(n_samples), self.rate
+
+    def _get_recorded_range(self, start_time, stop_time, **kwargs):
+        """Get the audio recorded between two times (seconds since the epoch
+        or datetimes). Without a recorder, only the last 20 seconds are
+        available and times are counted back from now."""
+        if self.recorder is not None:
+            return self.recorder.record_range(start_time, stop_time), self.rate
+        return _read_ring_range(self.record_buffer, self.rate, start_time, stop_time), self.rate
+
+    def _queue_wav(self, wav_file, start=False, event=None, **kwargs):
+        # Stop whatever is playing
+        if self.persistent_stream:
+            self._stop_playback()
+        else:
+            self._close_stream()
+
+        logger.debug("Queueing wavfile %s" % wav_file)
+        wav, params = self._load_pcm(wav_file)
+        # CachedWav has the header accessors that validate checks
+        self.wf = wav
+        self.validate()
+        playback = Playback(wav.samples, params, gain=self.gain, raw=wav.data,
+                            elements=[(0, wav_file)])
+        self._open_output_stream(params)
+        self._armed = playback
 
         if start:
-            self._play_wav(event=event)
+            self._play_wav(event=event, gain=self.gain)
 
-        self.wf = None
+    def _queue_sequence(self, sequence, start=False, event=None, **kwargs):
+        """Queue a sequence of (wav_file, isi) pairs to play back to back as
+        one sound, each file followed by isi seconds of silence"""
+        if self.persistent_stream:
+            self._stop_playback()
+        else:
+            self._close_stream()
+
+        logger.debug("Queueing sequence of %d wavfiles" % len(sequence))
+        wav, offsets = concat_wavs(sequence)
+        self.wf = wav
+        self.validate()
+        params = (wav.getframerate(), wav.getsampwidth(), wav.getnchannels())
+        elements = [(offset, wav_file) for offset, (wav_file, isi) in zip(offsets, sequence)]
+        playback = Playback(wav.samples, params, gain=self.gain, raw=wav.data,
+                            elements=elements)
+        self._open_output_stream(params)
+        self._armed = playback
+
+        if start:
+            self._play_wav(event=event, gain=self.gain)
+
+    def _play_wav(self, event=None, gain=None, start_at=None, **kwargs):
+        logger.debug("Playing wavfile")
+        self.set_gain(gain)
+        playback = self._armed
+        if playback is None:
+            logger.warning("Nothing was queued for playback")
+            return
+        self._armed = None
+
+        if gain != playback.gain:
+            playback.set_gain(gain)
+
+        if start_at is None:
+            events.write(event)
+        else:
+            playback.start_at = start_at
+            events.write(event, time=_monotonic_to_datetime(start_at))
+        # The callback switches to it on its next call
+        self._played = playback
+        with self._handover:
+            dropped = self._pending
+            self._pending = playback
+        _release(dropped)
+        if not self.persistent_stream:
+            self.stream.start_stream()
+
+    def _play_wav_at(self, start_time, event=None, gain=None, **kwargs):
+        """Play the queued sound so that its first sample reaches the DAC at
+        start_time (a time.monotonic() time). The callback starts it at that
+        frame of its buffer, or as soon as possible if that has passed.
+        """
+        return self._play_wav(event=event, gain=gain, start_at=start_time)
+
+    def _get_onset(self, timeout=1.0, event=None, **kwargs):
+        """Wait until the sound last played has started and return the time
+        (a datetime) at which its first sample reaches the DAC, or None if it
+        has not started within timeout. The onset is written to the events.
+        """
+        return _wait_onset(self._played, timeout=timeout, event=event)
+
+    def _get_onsets(self, timeout=1.0, event=None, **kwargs):
+        """Wait until the sound or sequence last played has started and
+        return the DAC onset of each of its files"""
+        return _wait_onsets(self._played, timeout=timeout, event=event)
+
+    def _stop_wav(self, event=None, **kwargs):
+        if self.persistent_stream:
+            self._stop_playback()
+        else:
+            self._close_stream()
+
+
+class PyAudioCaptureInterface(PyAudioDevice):
+    """Records from all the channels of an input device with a single stream
+    and splits them into one ring buffer per channel.
+
+    Several microphones on one sound card (e.g. one per box) can share this
+    interface instead of each opening its own stream: there is then one
+    PortAudio callback for all of them, and their recordings are sample-
+    aligned. The callback deinterleaves each block with numpy and copies each
+    configured channel into its buffer. Use shared_capture to get the
+    interface for a device, so that it is only opened once per process.
+
+    Parameters
+    ----------
+    device_name : string
+        Name of the input device
+    n_channels : int
+        Number of channels to open (defaults to all of the device's inputs)
+    buffer_seconds : float (default 20)
+        Length of the per-channel ring buffers
+    record_directory : string
+        If given, each channel is also archived to WAV files in a
+        subdirectory named after the channel
+    record_segment_bytes : int
+        Size of each of those files
+
+    Examples
+    --------
+    capture = pyaudio_.shared_capture("hw:U192k", n_channels=8)
+    audio_in = hwio.AudioInput(interface=capture, params=dict(channel=2))
+    mic = components.Microphone(audio_in)
+    """
 
-        return new_quit_signal
+    def __init__(self, device_name="default", n_channels=None,
+                 buffer_seconds=20, record_directory=None,
+                 record_segment_bytes=100 * 2 ** 20, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device_name = device_name
+        self.device_index = None
+        self.rate = None
+        self.open()
+        if n_channels is None:
+            n_channels = int(self.device_info["maxInputChannels"])
+        self.n_channels = n_channels
+        self.buffer_seconds = buffer_seconds
+        self.record_directory = record_directory
+        self.record_segment_bytes = record_segment_bytes
+        self.rec_stream = None
+        # Replaced rather than modified, so the callback never sees a
+        # dictionary that is changing size
+        self.buffers = dict()
+        self.recorders = dict()
+
+    def _config_read_analog(self, channel=0, **kwargs):
+        """ Adds a ring buffer (and recorder) for a channel and starts the
+        stream if it is not running yet """
+
+        if not (0 <= channel < self.n_channels):
+            raise InterfaceError("Channel %s is not one of the %d channels of %s" % (channel, self.n_channels, self.device_name))
+
+        if channel not in self.buffers:
+            buffer = SPSCRingBuffer(int(self.rate * self.buffer_seconds), n_channels=1,
+                                    dtype=np.int16)
+            if self.record_directory is not None:
+                recorder = WavSegmentRecorder(buffer, self.rate,
+                                              os.path.join(self.record_directory, "channel%d" % channel),
+                                              prefix=self.device_name,
+                                              segment_bytes=self.record_segment_bytes)
+                recorder.start()
+                self.recorders = {**self.recorders, channel: recorder}
+            self.buffers = {**self.buffers, channel: buffer}
+        self.listen()
+
+        return True
 
     def rec_callback(self, in_data, frame_count, time_info, status):
-        data = np.frombuffer(in_data, dtype=np.int16)
-        self.record_buffer.extend(data)
+        frames = np.frombuffer(in_data, dtype=np.int16).reshape((-1, self.n_channels))
+        for channel, buffer in self.buffers.items():
+            buffer.write_array(frames[:, channel])
         return in_data, pyaudio.paContinue
 
     def listen(self):
-        """Start microphone recording stream
-        """
+        """Start the capture stream, if it is not running yet"""
+        if self.rec_stream is not None:
+            return
+        logger.debug("Opening %d channel capture stream on %s" % (self.n_channels, self.device_name))
         self.rec_stream = self.pa.open(
             format=pyaudio.paInt16,
-            channels=1,
+            channels=self.n_channels,
             rate=self.rate,
             input_device_index=self.device_index,
             input=True,
@@ -462,41 +830,297 @@ class PyAudioInterface(base_.AudioInterface):
             stream_callback=self.rec_callback
         )
 
-        # Set up buffer to store last 10 seconds of audio at all times
-        self.record_buffer = RingBuffer(int(self.rate) * 20)
+    def close(self):
+        if self.rec_stream is not None:
+            try:
+                self.rec_stream.stop_stream()
+                self.rec_stream.close()
+            except Exception as e:
+                logger.warning("Error closing pyaudio stream: {}".format(e))
+            self.rec_stream = None
+        for recorder in self.recorders.values():
+            recorder.close()
+        self.recorders = dict()
+        self.pa.terminate()
+        _shared_captures.pop(self.device_name, None)
+
+    def _get_buffer(self, channel):
+        try:
+            return self.buffers[channel]
+        except KeyError:
+            raise InterfaceError("Channel %s of %s is not configured" % (channel, self.device_name))
 
-    def _get_last_recorded_data(self, duration):
-        """Get last few seconds of recorded audio input from mic buffer"""
+    def _get_last_recorded_data(self, duration, channel=0, **kwargs):
+        """Get last few seconds of recorded audio from a channel"""
+        buffer = self._get_buffer(channel)
         n_samples = int(duration * self.rate)
-        return self.record_buffer.read_last(n_samples), self.rate
+        recorder = self.recorders.get(channel)
+        if (recorder is not None) and (n_samples > buffer.maxlen):
+            written = buffer.written
+            return recorder.read(written - n_samples, written), self.rate
+        return buffer.read_last(n_samples), self.rate
+
+    def _get_recorded_range(self, start_time, stop_time, channel=0, **kwargs):
+        """Get the audio recorded on a channel between two times"""
+        buffer = self._get_buffer(channel)
+        recorder = self.recorders.get(channel)
+        if recorder is not None:
+            return recorder.record_range(start_time, stop_time), self.rate
+        return _read_ring_range(buffer, self.rate, start_time, stop_time), self.rate
+
+
+class PyAudioMixerInterface(PyAudioDevice):
+    """Plays sounds on the channels of one output device through a single
+    stream that stays open for the whole session.
+
+    Several speakers on one sound card (e.g. one per box) can share this
+    interface instead of each opening a stream for every trial: there is then
+    one PortAudio callback for all of them, and sounds played at the same time
+    start on the same sample. Each speaker has a channel slot. Queueing arms a
+    mono sound for a slot, playing switches the slot to it on the next
+    callback, and the callback copies the next slice of every playing slot
+    into its column of the output block and leaves the other columns silent.
+    Use shared_mixer to get the interface for a device, so that it is only
+    opened once per process.
+
+    Parameters
+    ----------
+    device_name : string
+        Name of the output device
+    n_channels : int
+        Number of channels to open (defaults to all of the device's outputs)
+
+    Examples
+    --------
+    mixer = pyaudio_.shared_mixer("surround40:U192k", n_channels=4)
+    audio_out = hwio.AudioOutput(interface=mixer, params=dict(channel=2))
+    speaker = components.Speaker(audio_out)
+    """
 
-    def _queue_wav(self, wav_file, start=False, event=None, **kwargs):
-        if self._playback_quit_signal:
-            self._playback_quit_signal.set()
+    def __init__(self, device_name="default", n_channels=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device_name = device_name
+        self.device_index = None
+        self.rate = None
+        self.open()
+        if n_channels is None:
+            n_channels = int(self.device_info["maxOutputChannels"])
+        self.n_channels = n_channels
+        self.stream = None
+        self._mix = np.zeros((4 * PLAY_CHUNK, n_channels), dtype=np.int16)
+
+        # Per channel, a queued Playback moves from _armed (queued) to
+        # _pending (played, waiting for the next callback) to _current
+        # (being handed over). _handover guards _pending and _current, which
+        # both threads change.
+        self._channels = tuple()
+        self._armed = dict()
+        self._pending = dict()
+        self._current = dict()
+        self._handover = threading.Lock()
+        self._gains = dict()
+        self._played = dict()
+        self._output_latency = 0.0
+
+    def _config_write_analog(self, channel=0, **kwargs):
+        """ Adds a slot for a channel and starts the stream if it is not
+        running yet """
+
+        if not (0 <= channel < self.n_channels):
+            raise InterfaceError("Channel %s is not one of the %d channels of %s" % (channel, self.n_channels, self.device_name))
+
+        if channel not in self._channels:
+            self._armed[channel] = None
+            self._pending[channel] = None
+            self._current[channel] = None
+            self._gains[channel] = None
+            self._channels = self._channels + (channel,)
+        self._open_stream()
+
+        return True
+
+    def _open_stream(self):
+        if self.stream is not None:
+            return
+        logger.debug("Opening %d channel output stream on %s" % (self.n_channels, self.device_name))
+        self.stream = self.pa.open(
+            format=pyaudio.paInt16,
+            channels=self.n_channels,
+            rate=self.rate,
+            output=True,
+            frames_per_buffer=PLAY_CHUNK,
+            output_device_index=self.device_index,
+            stream_callback=self._play_callback,
+        )
+        self._output_latency = self.stream.get_output_latency()
+
+    def _play_callback(self, in_data, frame_count, time_info, status):
+        """PortAudio output callback. Fills each channel's column with the
+        next slice of its current playback, switching to a pending one at the
+        frame it is scheduled for, and leaves the rest silent"""
+        if frame_count > len(self._mix):
+            self._mix = np.zeros((frame_count, self.n_channels), dtype=np.int16)
+        mix = self._mix[:frame_count]
+        mix[:] = 0
+
+        delay = None
+        with self._handover:
+            for channel in self._channels:
+                switch = frame_count
+                pending = self._pending[channel]
+                if pending is not None:
+                    if delay is None:
+                        delay = dac_delay(time_info, self._output_latency)
+                    frame = pending.start_frame(delay, self.rate)
+                    if frame < frame_count:
+                        self._pending[channel] = None
+                        switch = frame
+                        pending.set_onset(time.time() + delay + frame / float(self.rate))
+
+                # Whatever is playing continues up to the switch
+                self._read_current(channel, mix[:switch, channel])
+                if switch < frame_count:
+                    self._current[channel] = pending
+                    self._read_current(channel, mix[switch:, channel])
+
+        return mix.tobytes(), pyaudio.paContinue
+
+    def _read_current(self, channel, column):
+        """Copy the next slice of a channel's current playback into column"""
+        current = self._current[channel]
+        if current is None:
+            return
 
-        # We must wait for the previous stream to be closed
-        self._playback_lock.acquire()
+        frames = current.read_frames(len(column))
+        column[:len(frames)] = frames
+        if current.finished:
+            self._current[channel] = None
+            current.done.set()
 
-        logger.debug("Queueing wavfile %s" % wav_file)
-        self.wf = wave.open(wav_file)
-        self.validate()
-        self._playback_quit_signal = self._get_stream(
-            start=start,
-            event=event
-        )
+    def _get_channel(self, channel):
+        if channel not in self._channels:
+            raise InterfaceError("Channel %s of %s is not configured" % (channel, self.device_name))
+        return channel
 
-    def _play_wav(self, event=None, gain=None, **kwargs):
-        logger.debug("Playing wavfile")
-        events.write(event)
+    def _queue_wav(self, wav_file, start=False, event=None, channel=0, **kwargs):
+        channel = self._get_channel(channel)
+        self._stop_wav(channel=channel)
 
-        self.set_gain(gain)
+        logger.debug("Queueing wavfile %s on channel %s" % (wav_file, channel))
+        self._arm(channel, stimulus_cache.get(wav_file), [(0, wav_file)])
 
-        if self.play_thread is not None:
-            self.play_thread.start()
+        if start:
+            self._play_wav(event=event, gain=self._gains[channel], channel=channel)
 
-    def _stop_wav(self, event=None, **kwargs):
-        self._playback_quit_signal.set()
-        self.play_thread = None
+    def _queue_sequence(self, sequence, start=False, event=None, channel=0, **kwargs):
+        """Queue a sequence of (wav_file, isi) pairs on a channel to play
+        back to back as one sound, each file followed by isi seconds of
+        silence"""
+        channel = self._get_channel(channel)
+        self._stop_wav(channel=channel)
+
+        logger.debug("Queueing sequence of %d wavfiles on channel %s" % (len(sequence), channel))
+        wav, offsets = concat_wavs(sequence)
+        self._arm(channel, wav, [(offset, wav_file) for offset, (wav_file, isi) in zip(offsets, sequence)])
+
+        if start:
+            self._play_wav(event=event, gain=self._gains[channel], channel=channel)
+
+    def _arm(self, channel, wav, elements):
+        params = (wav.getframerate(), wav.getsampwidth(), wav.getnchannels())
+        if params != (self.rate, 2, 1):
+            raise InterfaceError("Can only mix mono 16 bit files at %d Hz, but %s is %d channel, %d bit at %d Hz" % (self.rate, elements[0][1], params[2], 8 * params[1], params[0]))
+        # Apply the gain of the last sound played on this channel now, so
+        # that playing does not have to unless it changed
+        self._armed[channel] = Playback(wav.samples, params, gain=self._gains[channel],
+                                        raw=wav.data, elements=elements)
+
+    def _play_wav(self, event=None, gain=None, channel=0, start_at=None, **kwargs):
+        channel = self._get_channel(channel)
+        playback = self._armed[channel]
+        if playback is None:
+            logger.warning("Nothing was queued for playback on channel %s" % channel)
+            return
+        self._armed[channel] = None
+
+        self._gains[channel] = gain
+        if gain != playback.gain:
+            playback.set_gain(gain)
+
+        if start_at is None:
+            events.write(event)
+        else:
+            playback.start_at = start_at
+            events.write(event, time=_monotonic_to_datetime(start_at))
+        # The callback switches to it on its next call
+        self._played[channel] = playback
+        with self._handover:
+            dropped = self._pending[channel]
+            self._pending[channel] = playback
+        _release(dropped)
+
+    def _play_wav_at(self, start_time, event=None, gain=None, channel=0, **kwargs):
+        """Play the sound queued on a channel so that its first sample
+        reaches the DAC at start_time (a time.monotonic() time)"""
+        return self._play_wav(event=event, gain=gain, channel=channel,
+                              start_at=start_time)
+
+    def _get_onset(self, timeout=1.0, event=None, channel=0, **kwargs):
+        """Wait until the sound last played on a channel has started and
+        return the time (a datetime) at which its first sample reaches the
+        DAC, or None if it has not started within timeout"""
+        return _wait_onset(self._played.get(channel), timeout=timeout, event=event)
+
+    def _get_onsets(self, timeout=1.0, event=None, channel=0, **kwargs):
+        """Wait until the sound or sequence last played on a channel has
+        started and return the DAC onset of each of its files"""
+        return _wait_onsets(self._played.get(channel), timeout=timeout, event=event)
+
+    def _stop_wav(self, event=None, channel=0, **kwargs):
+        channel = self._get_channel(channel)
+        with self._handover:
+            dropped = (self._pending[channel], self._current[channel])
+            self._pending[channel] = None
+            self._current[channel] = None
+        _release(*dropped)
+
+    def is_playing(self, channel=0, **kwargs):
+        """Whether a sound has been played on a channel and not yet handed
+        over completely"""
+        return (self._pending.get(channel) is not None) or (self._current.get(channel) is not None)
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.stop_stream()
+                self.stream.close()
+            except Exception as e:
+                logger.warning("Error closing pyaudio stream: {}".format(e))
+            self.stream = None
+        self.pa.terminate()
+        _shared_mixers.pop(self.device_name, None)
+
+
+_shared_captures = dict()
+_shared_mixers = dict()
+
+
+def shared_capture(device_name, **kwargs):
+    """ Returns the PyAudioCaptureInterface for a device, opening it the first
+    time. Keyword arguments are only used then. """
+
+    if device_name not in _shared_captures:
+        _shared_captures[device_name] = PyAudioCaptureInterface(device_name=device_name, **kwargs)
+    return _shared_captures[device_name]
+
+
+def shared_mixer(device_name, **kwargs):
+    """ Returns the PyAudioMixerInterface for a device, opening it the first
+    time. Keyword arguments are only used then. """
+
+    if device_name not in _shared_mixers:
+        _shared_mixers[device_name] = PyAudioMixerInterface(device_name=device_name, **kwargs)
+    return _shared_mixers[device_name]
 
 
 from unittest import mock
@@ -512,8 +1136,41 @@ class MockPyAudioInterface(PyAudioInterface):
 
 
 
+def benchmark_onsets(device_name, wav_file, n_trials=20, persistent_stream=True):
+    """ Plays a file n_trials times and prints how far the old stimulus
+    timestamp (the time just before play()) was from the DAC onset reported
+    by PortAudio, which is the error reaction times used to include.
+
+    python -m pyoperant.interfaces.pyaudio_ <device_name> <wav_file>
+    """
+
+    interface = PyAudioInterface(device_name=device_name,
+                                 persistent_stream=persistent_stream)
+    errors = list()
+    try:
+        for trial in range(n_trials):
+            interface._queue_wav(wav_file)
+            before = datetime.datetime.now()
+            interface._play_wav()
+            onset = interface._get_onset()
+            errors.append((onset - before).total_seconds())
+            while interface.is_playing():
+                time.sleep(0.01)
+    finally:
+        interface.close()
+
+    errors = np.array(errors) * 1e3
+    print("Stimulus time error of datetime.now() before play(), {} trials, persistent_stream={}".format(n_trials, persistent_stream))
+    print("mean {:.2f} ms, sd {:.2f} ms, min {:.2f} ms, max {:.2f} ms".format(errors.mean(), errors.std(), errors.min(), errors.max()))
+
+
 if __name__ == "__main__":
 
+    if len(sys.argv) > 2:
+        for persistent_stream in [False, True]:
+            benchmark_onsets(sys.argv[1], sys.argv[2], persistent_stream=persistent_stream)
+        sys.exit()
+
     with log_alsa_warnings():
         pa = pyaudio.PyAudio()
     pa.terminate()
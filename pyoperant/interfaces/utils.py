@@ -1,10 +1,189 @@
+import bisect
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+import wave
 from contextlib import contextmanager
 from enum import Enum
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def iter_chunks(data, chunk_size):
+    """ Splits data into float64 chunks of chunk_size samples
+
+    Parameters
+    ----------
+    data: numpy array or iterable
+        an nsamples (x nchannels) array, which can be a np.memmap, or an
+        iterable of such arrays of any length (e.g. a generator)
+    chunk_size: int
+        the number of samples in each chunk. Only the last chunk can be
+        shorter.
+
+    Yields
+    ------
+    nsamples x nchannels float64 arrays
+    """
+
+    if isinstance(data, np.ndarray):
+        array = data
+        data = (array[start:start + chunk_size]
+                for start in range(0, len(array), chunk_size))
+
+    pending = list()
+    n_pending = 0
+    for block in data:
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1:
+            block = block.reshape((-1, 1))
+        pending.append(block)
+        n_pending += len(block)
+        if n_pending < chunk_size:
+            continue
+        block = np.concatenate(pending) if len(pending) > 1 else pending[0]
+        n_full = (len(block) // chunk_size) * chunk_size
+        for start in range(0, n_full, chunk_size):
+            yield np.ascontiguousarray(block[start:start + chunk_size])
+        pending = [block[n_full:]] if n_full < len(block) else list()
+        n_pending = len(block) - n_full
+
+    if n_pending > 0:
+        yield np.ascontiguousarray(np.concatenate(pending))
+
+
+class AnalogOutputStream(object):
+    """ Reads chunks of an analog output stream ahead of the device. A
+    background thread pulls chunks from the source (see iter_chunks) into a
+    queue holding at most buffer_size samples, so that file reads or signal
+    generation never block the thread writing to the device. Iterating over
+    the stream yields the chunks in order.
+
+    Interfaces call report_underrun when the device runs out of samples.
+
+    Parameters
+    ----------
+    data: numpy array or iterable
+        an nsamples (x nchannels) array, which can be a np.memmap, or an
+        iterable of such arrays (e.g. a generator)
+    chunk_size: int
+        the number of samples in each chunk written to the device
+    buffer_size: int
+        the number of samples to read ahead of the device
+
+    Attributes
+    ----------
+    underruns: int
+        the number of underruns reported so far
+    n_samples: int
+        the number of samples handed out so far
+    error: Exception
+        the exception raised by the source, if any
+    """
+
+    def __init__(self, data, chunk_size, buffer_size):
+        self.chunk_size = int(chunk_size)
+        self.buffer_size = int(buffer_size)
+        self.underruns = 0
+        self.n_samples = 0
+        self.error = None
+
+        self._chunks = queue.Queue(maxsize=max(1, self.buffer_size // self.chunk_size))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill,
+                                        args=(iter_chunks(data, self.chunk_size),),
+                                        name="AnalogOutputStream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self, chunks):
+        """ Queues chunks from the source until it is exhausted or the stream
+        is closed. None marks the end of the stream. """
+
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            logger.error("Analog output source failed: %s" % e)
+            self.error = e
+        self._put(None)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            self.n_samples += len(chunk)
+            yield chunk
+
+    def report_underrun(self, reason=""):
+        """ Records an underrun after n_samples samples """
+
+        self.underruns += 1
+        logger.warning("Analog output underrun #%d after %d samples %s" % (self.underruns, self.n_samples, reason))
+
+    def close(self):
+        """ Stops reading from the source """
+
+        self._stop.set()
+        # Unblock the filling thread if it is waiting on a full queue
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+        # and anyone still iterating
+        try:
+            self._chunks.put_nowait(None)
+        except queue.Full:
+            pass
+
 
 @contextmanager
 def buffered_analog_output(data, chunk_size, buffer_size):
+    """ Context manager for streaming data to an analog output in chunks
 
-    pass
+    Parameters
+    ----------
+    data: numpy array or iterable
+        an nsamples (x nchannels) array, which can be a np.memmap, or an
+        iterable of such arrays (e.g. a generator)
+    chunk_size: int
+        the number of samples in each chunk written to the device
+    buffer_size: int
+        the number of samples to read ahead of the device
+
+    Yields
+    ------
+    an AnalogOutputStream, which is closed on exit
+
+    Examples
+    --------
+    with buffered_analog_output(np.load("long.npy", mmap_mode="r"), 3000, 30000) as stream:
+        for chunk in stream:
+            task.write(chunk)
+    """
+
+    stream = AnalogOutputStream(data, chunk_size, buffer_size)
+    try:
+        yield stream
+    finally:
+        stream.close()
 
 
 class MessageStatus(Enum):
@@ -12,3 +191,547 @@ class MessageStatus(Enum):
     NORMAL = 1
     ABORT = 2
 
+
+class RingBuffer(object):
+    """A circular buffer
+
+    Allocates space for the max buffer length. Use RingBuffer.extend(data)
+    to add to the buffer and RingBuffer.to_array() to get the current contents.
+
+    Methods
+    =======
+    RingBuffer.extend(data)
+        Extends the buffer with a 2D numpy array
+    RingBuffer.to_array()
+        Return an array representation of data in the buffer (copied
+        so that it can be modified without affecting the buffer)
+    RingBuffer.read_last(n_samples)
+        Return a copy of only the last n_samples in the buffer
+    RingBuffer.view_last(n_samples)
+        Return the last n_samples as two memoryviews into the buffer
+    """
+    def __init__(self, maxlen=0, n_channels=None, dtype=None):
+        """Initialize circular buffer
+
+        Params
+        ======
+        maxlen : int (default 0)
+            Maximum size of buffer
+        n_channels : int (default None)
+            Enforce number of channels in buffer. If None,
+            will choose the number of channels the first time .extend()
+            is called.
+        dtype : type (default None)
+            Enforce datatype of buffer. If None,
+            will choose the datatype the first time .extend()
+            is called.
+        """
+        self.maxlen = maxlen
+
+        # Keep track of original value for if the buffer is cleared
+        self._init_n_channels = n_channels
+        self.n_channels = n_channels
+        self._init_dtype = dtype
+        self.dtype = dtype
+
+        # Data is stored in a numpy array of maxlen even when
+        # the amount of data is smaller than that. When data
+        # exceeds maxlen we loop around and keep track of where we
+        # started.
+        self._write_at = 0  # Where the next data should be written
+        self._length = 0  # The amount of samples of real data in the buffer
+        self._start = 0  # Starting index where data should be read from
+        self._overlapping = False  # Has the data wrapper around the end
+        self._ringbuffer = np.zeros((self.maxlen, self.n_channels or 0), dtype=self.dtype or np.int16)
+
+    def __len__(self):
+        return self._length
+
+    def __array__(self):
+        return self.to_array()
+
+    def to_array(self):
+        # Read to the end and then wrap around to the beginning
+        # if self._start + self._length > self.maxlen:
+        if self._overlapping:
+            return np.roll(self._ringbuffer, -self._start, axis=0)
+        else:
+            return self._ringbuffer[:self._length].copy()
+
+    def clear(self):
+        self._write_at = 0
+        self._length = 0
+        self._start = 0
+        self.n_channels = self._init_n_channels
+        self.dtype = self._init_dtype
+        self._overlapping = False
+        self._ringbuffer = np.zeros((self.maxlen, self.n_channels or 0), dtype=self.dtype or np.int16)
+
+    def extend(self, data):
+        """Extend the buffer with a 2D (samples x channels) array
+
+        Requires shape to be consistent with existing data
+        """
+        if self.maxlen == 0:
+            return
+
+        # Reshape 1-D signals to be 2D with one channel
+        to_add = np.array(data)
+        if self.dtype is None:
+            self.dtype = to_add.dtype
+            self._ringbuffer = self._ringbuffer.astype(self.dtype)
+
+        if to_add.ndim == 1:
+            to_add = to_add[:, None]
+
+        # Enforce channels here
+        if self.n_channels and to_add.shape[1] != self.n_channels:
+            raise ValueError("Cannot extend {} channel Buffer with data of shape {}".format(
+                self.n_channels,
+                to_add.shape
+            ))
+
+        if self._length == 0 and self.n_channels is None:
+            self._ringbuffer = np.zeros((self.maxlen, to_add.shape[1]), dtype=self.dtype)
+            self.n_channels = to_add.shape[1]
+
+        if len(to_add) > self.maxlen:
+            self._ringbuffer[:] = to_add[-self.maxlen:]
+            self._write_at = 0
+            self._length = self.maxlen
+            self._start = 0
+            # The buffer is full, so the next write wraps around
+            self._overlapping = True
+        elif self._write_at + len(to_add) < self.maxlen:
+            self._ringbuffer[self._write_at:self._write_at + len(to_add)] = to_add
+            self._write_at += len(to_add)
+            self._length = self.maxlen if self._overlapping else self._write_at
+            self._start = self._write_at if self._overlapping else 0
+        else:
+            first_part_size = self.maxlen - self._write_at
+            first_part = to_add[:first_part_size]
+            second_part = to_add[first_part_size:]
+            self._ringbuffer[self._write_at:] = first_part
+            self._ringbuffer[:len(second_part)] = second_part
+            self._write_at = len(second_part)
+            self._length = self.maxlen
+            self._start = self._write_at
+            self._overlapping = True
+
+    def _last_slices(self, n_samples):
+        """The last n_samples of the buffer as at most two slices (the
+        second one empty unless they wrap around the end)"""
+        n_samples = max(0, min(n_samples, self._length))
+        start = self._write_at - n_samples
+        if start >= 0:
+            return (self._ringbuffer[start:self._write_at],
+                    self._ringbuffer[:0])
+        return (self._ringbuffer[self.maxlen + start:],
+                self._ringbuffer[:self._write_at])
+
+    def read_last(self, n_samples):
+        """Copy the last n_samples (or as many as there are) into a new array"""
+        first, second = self._last_slices(n_samples)
+        out = np.empty((len(first) + len(second), self._ringbuffer.shape[1]),
+                       dtype=self._ringbuffer.dtype)
+        out[:len(first)] = first
+        out[len(first):] = second
+        return out
+
+    def view_last(self, n_samples):
+        """Return the last n_samples without copying, as two memoryviews of
+        the oldest and the newest part. The views change as the buffer is
+        extended, so copy them before the buffer wraps around to them.
+        """
+        first, second = self._last_slices(n_samples)
+        return memoryview(first), memoryview(second)
+
+
+
+class SPSCRingBuffer(object):
+    """A ring buffer of samples for exactly one writer thread (e.g. a PortAudio
+    callback) and one reader thread, without locks.
+
+    The samples live in one preallocated array. A write copies the data in
+    and only then advances the total count of samples written, so a reader
+    never sees a sample before it is complete. A read copies out the samples
+    it wants and then checks the count again: if the writer has wrapped
+    around onto them in the meantime, it retries (and finally drops the
+    overwritten part), so every snapshot it returns is consistent.
+
+    Parameters
+    ----------
+    maxlen : int
+        Number of samples (frames) the buffer holds
+    n_channels : int (default 1)
+        Number of interleaved channels per sample
+    dtype : numpy dtype (default np.int16)
+        Sample type of the data written
+
+    Attributes
+    ----------
+    written : int
+        Total number of samples written so far. Sample i (counting from the
+        first one written) is in the buffer while written - maxlen <= i.
+    """
+    def __init__(self, maxlen, n_channels=1, dtype=np.int16):
+        self.maxlen = int(maxlen)
+        self.n_channels = n_channels
+        self.dtype = np.dtype(dtype)
+        self._frame_bytes = self.dtype.itemsize * n_channels
+        self._bytes = bytearray(self.maxlen * self._frame_bytes)
+        self._view = memoryview(self._bytes)
+        self._array = np.frombuffer(self._bytes, dtype=self.dtype).reshape((self.maxlen, n_channels))
+        self.written = 0
+
+    def __len__(self):
+        return min(self.written, self.maxlen)
+
+    def write(self, data):
+        """Copy a bytes-like object of whole samples into the buffer. Only
+        one thread may call this.
+        """
+        nbytes = len(data)
+        n_samples = nbytes // self._frame_bytes
+        size = len(self._bytes)
+        first = self.written
+        if nbytes > size:
+            # Only the last maxlen samples will be kept
+            data = memoryview(data)[nbytes - size:]
+            nbytes = size
+            first += n_samples - self.maxlen
+        start = (first % self.maxlen) * self._frame_bytes
+        end = start + nbytes
+        if end <= size:
+            self._view[start:end] = data
+        else:
+            data = memoryview(data)
+            self._view[start:] = data[:size - start]
+            self._view[:end - size] = data[size - start:]
+        # Publish the samples only after they have been copied
+        self.written += n_samples
+
+    def write_array(self, samples):
+        """Copy an array of samples (n_samples or n_samples x n_channels, of
+        the buffer's dtype) into the buffer. Unlike write, the array may be
+        a strided view, e.g. one channel of an interleaved block. Only one
+        thread may call this.
+        """
+        samples = samples.reshape((len(samples), -1))
+        n_samples = len(samples)
+        first = self.written
+        if n_samples > self.maxlen:
+            samples = samples[n_samples - self.maxlen:]
+            first += n_samples - self.maxlen
+        start = first % self.maxlen
+        split = min(len(samples), self.maxlen - start)
+        self._array[start:start + split] = samples[:split]
+        self._array[:len(samples) - split] = samples[split:]
+        # Publish the samples only after they have been copied
+        self.written += n_samples
+
+    def read_range(self, start, stop, retries=3):
+        """Copy the samples with indices start to stop (counted from the
+        first sample written). Samples that are no longer in the buffer, or
+        that are overwritten while copying, are left out of the result.
+        """
+        for attempt in range(retries + 1):
+            written = self.written
+            stop = min(stop, written)
+            first = max(start, written - self.maxlen, 0)
+            out = self._copy(first, stop)
+            # Anything older than this may have been overwritten while copying
+            oldest = self.written - self.maxlen
+            if first >= oldest:
+                return out
+        return out[max(0, oldest - first):]
+
+    def _copy(self, start, stop):
+        out = np.empty((max(0, stop - start), self.n_channels), dtype=self.dtype)
+        if stop <= start:
+            return out
+        i, j = start % self.maxlen, stop % self.maxlen
+        if i < j:
+            out[:] = self._array[i:j]
+        else:
+            split = self.maxlen - i
+            out[:split] = self._array[i:]
+            out[split:] = self._array[:j]
+        return out
+
+    def read_last(self, n_samples):
+        """Copy the last n_samples (or as many as there are)"""
+        written = self.written
+        return self.read_range(written - max(0, n_samples), written)
+
+    def to_array(self):
+        return self.read_last(self.maxlen)
+
+    def __array__(self):
+        return self.to_array()
+
+
+class WavSegment(object):
+    """One file written by WavSegmentRecorder, holding the samples with
+    indices start to start + n_samples of the recording"""
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+        self.n_samples = 0
+
+    @property
+    def stop(self):
+        return self.start + self.n_samples
+
+
+class WavSegmentRecorder(object):
+    """Archives everything written to an SPSCRingBuffer as a series of WAV
+    files, so that a whole session is kept on disk with a fixed amount of
+    memory. A background thread drains the ring buffer every drain_interval
+    seconds and starts a new file once the current one reaches segment_bytes.
+
+    The recorder keeps an index of which file holds which samples and of
+    the host time of the samples, so any range of the recording can be read
+    back by time: from the ring buffer while it is still there, and from
+    disk otherwise. The host time is anchored every anchor_interval seconds
+    to the drain that ran soonest after new samples arrived, which follows
+    any drift between the audio and host clocks.
+
+    Parameters
+    ----------
+    buffer : SPSCRingBuffer
+        The buffer the samples are written to
+    rate : int
+        Sample rate of the recording
+    directory : string
+        Where to write the files
+    prefix : string (default "recording")
+        Start of the file names, which continue with the start time and a
+        segment number
+    segment_bytes : int (default 100 MB)
+        Size at which a new file is started
+    drain_interval : float (default 0.25)
+        Time in seconds between writes to disk
+    anchor_interval : float (default 10.0)
+        Time in seconds between host time anchors
+
+    Attributes
+    ----------
+    segments : list of WavSegment
+        All of the files written so far, in order
+    flushed : int
+        Number of samples written to disk
+    lost : int
+        Number of samples that were overwritten in the ring buffer before
+        they could be written to disk. They are written as silence.
+    """
+    def __init__(self, buffer, rate, directory, prefix="recording",
+                 segment_bytes=100 * 2 ** 20, drain_interval=0.25,
+                 anchor_interval=10.0):
+        self.buffer = buffer
+        self.rate = rate
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.drain_interval = drain_interval
+        self.anchor_interval = anchor_interval
+
+        self.segments = list()
+        self.flushed = 0
+        self.lost = 0
+        # The current segment's file, which wave is given so that it can be
+        # flushed for reads
+        self._file = None
+        self._wf = None
+        self._lock = threading.Lock()
+        self._anchor_samples = list()
+        self._anchor_times = list()
+        self._best_anchor = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="WavSegmentRecorder(%s)" % self.prefix)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Write out what is left in the buffer and close the current file"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._drain()
+        with self._lock:
+            if self._wf is not None:
+                self._close_segment()
+
+    def _run(self):
+        while not self._stop.wait(self.drain_interval):
+            try:
+                self._drain()
+            except Exception as e:
+                logger.error("Error writing recording to %s: %s" % (self.directory, e))
+
+    def _drain(self):
+        now = time.time()
+        written = self.buffer.written
+        self._update_anchor(written, now)
+        if written <= self.flushed:
+            return
+
+        data = self.buffer.read_range(self.flushed, written)
+        missing = (written - self.flushed) - len(data)
+        if missing > 0:
+            logger.warning("Recording to %s fell behind and lost %d samples" % (self.directory, missing))
+            self.lost += missing
+            data = np.concatenate([np.zeros((missing, data.shape[1]), dtype=data.dtype), data])
+        self._write(data)
+
+    def _update_anchor(self, written, now):
+        """Keep the drain that saw new samples soonest (the one implying the
+        earliest start time) in each anchor_interval as the next anchor"""
+        if written == 0:
+            return
+        implied_start = now - written / float(self.rate)
+        if (self._best_anchor is None) or (implied_start < self._best_anchor[0]):
+            self._best_anchor = (implied_start, written, now)
+
+        if self._anchor_times and (now - self._anchor_times[-1] < self.anchor_interval):
+            return
+        implied_start, samples, anchor_time = self._best_anchor
+        with self._lock:
+            self._anchor_samples.append(samples)
+            self._anchor_times.append(anchor_time)
+        self._best_anchor = None
+
+    def _write(self, data):
+        frame_bytes = data.dtype.itemsize * data.shape[1]
+        with self._lock:
+            while len(data) > 0:
+                if self._wf is None:
+                    self._open_segment(data)
+                segment = self.segments[-1]
+                room = max(1, (self.segment_bytes - segment.n_samples * frame_bytes) // frame_bytes)
+                chunk = data[:room]
+                self._wf.writeframes(chunk.tobytes())
+                segment.n_samples += len(chunk)
+                self.flushed += len(chunk)
+                data = data[len(chunk):]
+                if segment.n_samples * frame_bytes >= self.segment_bytes:
+                    self._close_segment()
+
+    def _open_segment(self, data):
+        name = "{}_{}_{:04d}.wav".format(self.prefix,
+                                         datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+                                         len(self.segments))
+        path = os.path.join(self.directory, name)
+        logger.debug("Starting recording segment %s" % path)
+        self._file = open(path, "wb")
+        self._wf = wave.open(self._file, "wb")
+        self._wf.setnchannels(data.shape[1])
+        self._wf.setsampwidth(data.dtype.itemsize)
+        self._wf.setframerate(self.rate)
+        self.segments.append(WavSegment(path, self.flushed))
+
+    def _close_segment(self):
+        # wave does not close files it was given
+        self._wf.close()
+        self._file.close()
+        self._wf = None
+        self._file = None
+
+    def time_to_sample(self, t):
+        """Index of the sample recorded at host time t (seconds since the
+        epoch, or a datetime)"""
+        if isinstance(t, datetime.datetime):
+            t = t.timestamp()
+        with self._lock:
+            if not self._anchor_times:
+                raise ValueError("Nothing has been recorded yet")
+            k = max(0, bisect.bisect_right(self._anchor_times, t) - 1)
+            return int(round(self._anchor_samples[k] + (t - self._anchor_times[k]) * self.rate))
+
+    def locate(self, t):
+        """The file holding the sample recorded at host time t and the
+        sample offset into it, or None if it is not on disk"""
+        sample = self.time_to_sample(t)
+        with self._lock:
+            for segment in self.segments:
+                if segment.start <= sample < segment.stop:
+                    return segment.path, sample - segment.start
+        return None
+
+    def read(self, start, stop):
+        """Samples start to stop of the recording, read from the ring buffer
+        where possible and from disk otherwise"""
+        written = self.buffer.written
+        start = max(0, start)
+        stop = min(stop, written)
+        in_ring = max(written - self.buffer.maxlen, 0)
+        parts = list()
+        if start < in_ring:
+            parts.append(self._read_disk(start, min(stop, in_ring)))
+            start = in_ring
+        parts.append(self.buffer.read_range(start, stop))
+
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def _read_disk(self, start, stop):
+        parts = list()
+        with self._lock:
+            for segment in self.segments:
+                if (segment.stop <= start) or (segment.start >= stop):
+                    continue
+                first = max(start, segment.start)
+                last = min(stop, segment.stop)
+                if segment is self.segments[-1] and self._file is not None:
+                    self._file.flush()
+                with wave.open(segment.path, "rb") as wf:
+                    wf.setpos(first - segment.start)
+                    frames = wf.readframes(last - first)
+                parts.append(np.frombuffer(frames, dtype=self.buffer.dtype).reshape((-1, self.buffer.n_channels)))
+        if not parts:
+            return np.empty((0, self.buffer.n_channels), dtype=self.buffer.dtype)
+        return np.concatenate(parts)
+
+    def record_range(self, start_time, stop_time):
+        """Samples recorded between two host times (seconds since the epoch,
+        or datetimes)"""
+        return self.read(self.time_to_sample(start_time),
+                         self.time_to_sample(stop_time))
+
+
+def benchmark_ring_buffer(rate=44100, durations=(1, 10, 60, 600), number=20):
+    """ Times reading the last second of int16 RingBuffers holding each of
+    durations seconds, using the old roll and slice (to_array()[-n:]),
+    read_last and view_last, and prints the best time of each per read.
+
+    python -m pyoperant.interfaces.utils
+    """
+
+    import timeit
+
+    print("RingBuffer.read_last(1 s) at {} Hz, int16".format(rate))
+    print("{:>10} {:>14} {:>14} {:>14}".format("buffer", "to_array()[-n:]", "read_last", "view_last"))
+    for seconds in durations:
+        buf = RingBuffer(rate * seconds, n_channels=1, dtype=np.int16)
+        # Fill and wrap around, so that the data is split in two
+        buf.extend(np.zeros(rate * seconds, dtype=np.int16))
+        buf.extend(np.ones(rate // 2, dtype=np.int16))
+        assert np.array_equal(buf.read_last(rate), buf.to_array()[-rate:])
+        times = [min(timeit.repeat(f, number=number, repeat=3)) / number
+                 for f in (lambda: buf.to_array()[-rate:],
+                           lambda: buf.read_last(rate),
+                           lambda: buf.view_last(rate))]
+        print("{:>9}s {:>12.3f}ms {:>12.3f}ms {:>12.3f}ms".format(seconds, *[t * 1e3 for t in times]))
+
+
+if __name__ == "__main__":
+
+    benchmark_ring_buffer()
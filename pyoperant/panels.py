@@ -1,3 +1,5 @@
+from pyoperant import hwio
+
 ## Panel classes
 
 class BasePanel(object):
@@ -55,6 +57,14 @@ class BasePanel(object):
 
         return True
 
+    def read_inputs(self):
+        """
+        Read every boolean input on the panel. Inputs that share an interface
+        are sampled together when the interface supports it.
+        """
+
+        return hwio.BooleanInputGroup(self.inputs).read()
+
     def reward(self):
 
         pass
@@ -4,13 +4,221 @@ import os
 import wave
 import logging
 import random
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 from contextlib import closing
+import numpy as np
 from pyoperant import StimulusMissing
 from pyoperant.utils import Event, filter_files
 
 logger = logging.getLogger(__name__)
 
+# numpy dtypes of the sample widths (in bytes) that can be decoded
+WAV_DTYPES = {2: np.int16, 4: np.int32}
+
+
+class CachedWav(object):
+    """ A decoded wave file. It has the header accessors of an open
+    wave.Wave_read, so it can be used wherever only the header is needed.
+
+    Attributes
+    ----------
+    filename: string
+        Path of the file
+    mtime: int
+        Modification time of the file, in ns, when it was decoded
+    params: wave._wave_params
+        The header of the file (nchannels, sampwidth, framerate, nframes,
+        comptype, compname)
+    data: bytes
+        The raw interleaved frames
+    samples: numpy array
+        A read-only view of data as integer samples
+    nbytes: int
+        Size of the decoded data
+    """
+
+    def __init__(self, filename, mtime, params, data):
+        self.filename = filename
+        self.mtime = mtime
+        self.params = params
+        self.data = data
+        self.nbytes = len(data)
+        try:
+            dtype = WAV_DTYPES[params.sampwidth]
+        except KeyError:
+            raise ValueError("Cannot decode %d byte samples in %s" % (params.sampwidth, filename))
+        self.samples = np.frombuffer(data, dtype=dtype)
+
+    @classmethod
+    def from_file(cls, filename, mtime=None):
+        if mtime is None:
+            mtime = os.stat(filename).st_mtime_ns
+        with closing(wave.open(filename, "rb")) as wf:
+            params = wf.getparams()
+            data = wf.readframes(params.nframes)
+
+        return cls(filename, mtime, params, data)
+
+    def getparams(self):
+        return self.params
+
+    def getnchannels(self):
+        return self.params.nchannels
+
+    def getsampwidth(self):
+        return self.params.sampwidth
+
+    def getframerate(self):
+        return self.params.framerate
+
+    def getnframes(self):
+        return self.params.nframes
+
+
+class StimulusCache(object):
+    """ Process-wide cache of decoded wave files, keyed by path and
+    modification time so that edited files are decoded again. When the
+    decoded data exceeds max_bytes, the least recently used files are
+    evicted.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Budget for the decoded data of all cached files
+
+    Attributes
+    ----------
+    nbytes: int
+        Size of the decoded data currently cached
+    hits: int
+        Number of lookups served from the cache
+    misses: int
+        Number of lookups that decoded the file
+
+    Methods
+    -------
+    get(filename)
+        Returns the CachedWav for filename, decoding it if necessary
+    clear()
+        Empties the cache
+
+    Examples
+    --------
+    wav = stimulus_cache.get("/path/to/stimulus.wav")
+    wav.samples, wav.getframerate()
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename):
+        """ Returns the decoded file, from the cache if it has not been
+        modified since it was decoded.
+
+        Parameters
+        ----------
+        filename: string
+            Path to the wave file
+
+        Returns
+        -------
+        CachedWav
+        """
+
+        filename = os.path.abspath(filename)
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            raise StimulusMissing("Stimulus file %s does not exist" % filename)
+
+        with self._lock:
+            wav = self._entries.get(filename)
+            if (wav is not None) and (wav.mtime == mtime):
+                self._entries.move_to_end(filename)
+                self.hits += 1
+                return wav
+
+        wav = CachedWav.from_file(filename, mtime=mtime)
+        with self._lock:
+            self.misses += 1
+            self._discard(filename)
+            if wav.nbytes <= self.max_bytes:
+                self._entries[filename] = wav
+                self.nbytes += wav.nbytes
+                while self.nbytes > self.max_bytes:
+                    evicted = next(iter(self._entries))
+                    logger.debug("Evicting %s from the stimulus cache" % evicted)
+                    self._discard(evicted)
+
+        return wav
+
+    def _discard(self, filename):
+        wav = self._entries.pop(filename, None)
+        if wav is not None:
+            self.nbytes -= wav.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+stimulus_cache = StimulusCache()
+
+
+def concat_wavs(sequence):
+    """ Joins wave files, each followed by a silent gap, into a single
+    CachedWav that only exists in memory, so that the whole sequence can be
+    played back without gaps from one buffer.
+
+    Parameters
+    ----------
+    sequence: list
+        (filename, isi) pairs, where isi is the silence in seconds after the
+        file
+
+    Returns
+    -------
+    wav: CachedWav
+        The joined sequence
+    offsets: list
+        The frame at which each file starts
+    """
+
+    parts = list()
+    offsets = list()
+    params = None
+    n_frames = 0
+    for filename, isi in sequence:
+        wav = stimulus_cache.get(filename)
+        if params is None:
+            params = wav.params
+        elif wav.params[:3] != params[:3]:
+            raise ValueError("%s does not have the channels, sample width and rate of %s" % (filename, sequence[0][0]))
+        offsets.append(n_frames)
+        parts.append(wav.data)
+        n_frames += wav.params.nframes
+
+        gap = int(round(isi * params.framerate))
+        if gap > 0:
+            parts.append(bytes(gap * params.nchannels * params.sampwidth))
+            n_frames += gap
+
+    if params is None:
+        raise ValueError("Cannot join an empty sequence")
+    wav = CachedWav(None, None, params._replace(nframes=n_frames), b"".join(parts))
+
+    return wav, offsets
+
 # TODO: Integrate this concept of "event" with the one in events.py
 
 class Stimulus(Event):
@@ -34,23 +242,28 @@ class AuditoryStimulus(Stimulus):
         logger.debug("Attempting to create stimulus object from %s" % wavfile)
         with closing(wave.open(wavfile,'rb')) as wf:
             (nchannels, sampwidth, framerate, nframes, comptype, compname) = wf.getparams()
-
-            duration = float(nframes)/sampwidth
-            duration = duration * 2.0 / framerate
-            stim = cls(time=0.0,
-                       duration=duration,
-                       name=wavfile,
-                       label='wav',
-                       description='',
-                       file_origin=wavfile,
-                       annotations={'nchannels': nchannels,
-                                    'sampwidth': sampwidth,
-                                    'framerate': framerate,
-                                    'nframes': nframes,
-                                    'comptype': comptype,
-                                    'compname': compname,
-                                    }
-                       )
+        # Decoding through the cache means the interface will not have to
+        # read the file again when the stimulus is queued. Files it can't
+        # decode only need their header here.
+        if sampwidth in WAV_DTYPES:
+            stimulus_cache.get(wavfile)
+
+        duration = float(nframes)/sampwidth
+        duration = duration * 2.0 / framerate
+        stim = cls(time=0.0,
+                   duration=duration,
+                   name=wavfile,
+                   label='wav',
+                   description='',
+                   file_origin=wavfile,
+                   annotations={'nchannels': nchannels,
+                                'sampwidth': sampwidth,
+                                'framerate': framerate,
+                                'nframes': nframes,
+                                'comptype': comptype,
+                                'compname': compname,
+                                }
+                   )
         return stim
 
 
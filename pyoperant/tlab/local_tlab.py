@@ -10,7 +10,7 @@ from unittest import mock
 import scipy.io.wavfile
 
 from pyoperant import hwio, components, panels, utils, InterfaceError
-from pyoperant.interfaces import pyaudio_, arduino_
+from pyoperant.interfaces import pyaudio_, arduino_, arduino_sim
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +45,16 @@ class Panel125(panels.BasePanel):
         Path to the arduino for this box
     speaker: string
         Speaker device name for this box
+    mic: string
+        Microphone device name for this box
+    record_directory: string
+        Where to archive everything the microphone records (optional)
+    mic_channel: int
+        If given, mic is a multichannel device shared with other boxes and
+        this box records from this channel of it
+    speaker_channel: int
+        If given, speaker is a multichannel device shared with other boxes
+        and this box plays on this channel of it
 
     Attributes
     ----------
@@ -62,7 +72,9 @@ class Panel125(panels.BasePanel):
     _default_sound_file = "/data/pecking_test/stimuli/debugging/test_song.wav"
     _default_box_sound_file = "/data/pecking_test/stimuli/debugging/test_song.wav"
 
-    def __init__(self, arduino=None, speaker=None, mic=None, name=None, *args, **kwargs):
+    def __init__(self, arduino=None, speaker=None, mic=None, name=None,
+                 record_directory=None, mic_channel=None, speaker_channel=None,
+                 *args, **kwargs):
         super(Panel125, self).__init__(self, *args, **kwargs)
         if arduino is None:
             raise ValueError("Arduino serial port not specified or configured.")
@@ -74,12 +86,19 @@ class Panel125(panels.BasePanel):
         # Initialize interfaces
         arduino = arduino_.ArduinoInterface(device_name=arduino,
                                             baud_rate=19200)
-        headphone_out = pyaudio_.PyAudioInterface(device_name=speaker)
+        if speaker_channel is not None:
+            # One channel of an output stream shared with the other boxes
+            headphone_out = pyaudio_.shared_mixer(speaker)
+            speaker_params = dict(channel=speaker_channel)
+        else:
+            headphone_out = pyaudio_.PyAudioInterface(device_name=speaker)
+            speaker_params = dict()
 
         # Create input and output for the pecking key
         button = hwio.BooleanInput(name="Pecking key input",
                                    interface=arduino,
-                                   params=dict(channel=4, invert=True, suppress_longpress=True))
+                                   params=dict(channel=4, invert=True, debounce_ms=20,
+                                               suppress_longpress=True))
         light = hwio.BooleanOutput(name="Pecking key light",
                                    interface=arduino,
                                    params=dict(channel=8))
@@ -92,11 +111,18 @@ class Panel125(panels.BasePanel):
                                     interface=arduino,
                                     params=dict(channel=10))
         # Create an audio output
-        audio_out = hwio.AudioOutput(interface=headphone_out)
+        audio_out = hwio.AudioOutput(interface=headphone_out, params=speaker_params)
 
         # Create a mic input
-        if mic is not None:
-            mic_in = pyaudio_.PyAudioInterface(device_name=mic, is_mic=True)
+        if mic is not None and mic_channel is not None:
+            # One channel of a capture stream shared with the other boxes
+            mic_in = pyaudio_.shared_capture(mic, record_directory=record_directory)
+            audio_in = hwio.AudioInput(interface=mic_in, params=dict(channel=mic_channel))
+            self.mic = components.Microphone(audio_in)
+        elif mic is not None:
+            # With a record_directory, the whole session is archived to disk
+            mic_in = pyaudio_.PyAudioInterface(device_name=mic, is_mic=True,
+                                               record_directory=record_directory)
             audio_in = hwio.AudioInput(interface=mic_in)
             self.mic = components.Microphone(audio_in)
 
@@ -308,17 +334,33 @@ class Box6(Panel125):
 
 
 class BoxVirtual(Panel125):
+    """ A box whose arduino is simulated on a pseudo-terminal, with random
+    pecks on the pecking key
+    """
+
     defaults = dict(
         name="Virtual Box",
-        arduino="fakearduinoboi",
         speaker="default",
         mic="default",
     )
 
     # @mock.patch("pyoperant.interfaces.pyaudio_.PyAudioInterface", pyaudio_.MockPyAudioInterface)
-    @mock.patch("pyoperant.interfaces.arduino_.ArduinoInterface", arduino_.MockArduinoInterface)
-    def __init__(self, *args, **kwargs):
-        super(BoxVirtual, self).__init__(*args, **{**self.defaults, **kwargs})
+    def __init__(self, *args, peck_rate=0.1, **kwargs):
+        self.simulator = arduino_sim.ArduinoSimulator(peck_rate=peck_rate)
+        self.simulator.start()
+        try:
+            super(BoxVirtual, self).__init__(*args, **{**self.defaults,
+                                                       "arduino": self.simulator.path,
+                                                       **kwargs})
+        except Exception:
+            self.simulator.stop()
+            raise
+
+    def close(self):
+        """ Close the arduino interface and stop its simulator """
+
+        self.peck_port.IR.interface.close()
+        self.simulator.stop()
 
 
 PANELS = {
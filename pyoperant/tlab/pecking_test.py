@@ -153,6 +153,11 @@ class PeckingTest(GoNoGoInterrupt):
 class PeckingAndPlaybackTest(PeckingTest, record_trials.RecordTrialsMixin):
     """A go no-go interruption experiment combined with occasional playbacks
 
+    Playbacks are scheduled on the output for the end of the inactivity
+    timeout. Polling runs for the whole timeout, so that a peck right before
+    it ends still counts, and the playback starts as soon as the stimulus has
+    been queued.
+
     Parameters
     ----------
     block_queue: dict
@@ -204,6 +209,7 @@ class PeckingAndPlaybackTest(PeckingTest, record_trials.RecordTrialsMixin):
 
         self.inactivity_before_playback = inactivity_before_playback
         self.inactivity_before_playback_restart = inactivity_before_playback_restart
+        self._playback_start_at = None
 
         # Will not start playbacks unless subject has started pecking
         self._delay_before_first_playback = inactivity_before_playback_restart
@@ -234,8 +240,10 @@ class PeckingAndPlaybackTest(PeckingTest, record_trials.RecordTrialsMixin):
                     # will occur at normal intervals.
                     timeout = self._delay_before_first_playback + np.random.uniform(*self.inactivity_before_playback)
                     self._delay_before_first_playback = 0
+                self._playback_start_at = time.monotonic() + timeout
                 response = self.panel.response_port.poll(timeout=timeout)
             else:
+                self._playback_start_at = None
                 response = True
 
             if response is None:  # timeout
@@ -254,12 +262,35 @@ class PeckingAndPlaybackTest(PeckingTest, record_trials.RecordTrialsMixin):
                 self.panel.speaker.set_gain(self.gain.get(block_name, None))
                 break
 
+    def stimulus_main(self):
+        if (self.this_trial.block == self.block_queue.blocks["pecking"]) or \
+                (self._playback_start_at is None):
+            return super(PeckingAndPlaybackTest, self).stimulus_main()
+
+        # Start the playback when the inactivity timeout runs out
+        logger.info("Trial %d - %s - %s - %s" % (
+                                     self.this_trial.index,
+                                     self.this_trial.time.strftime("%H:%M:%S"),
+                                     self.this_trial.condition.name,
+                                     self.this_trial.stimulus.name))
+        self.panel.speaker.queue(self.this_trial.stimulus.file_origin)
+        self.panel.speaker.play_at(self._playback_start_at)
+        onset = self.panel.speaker.wait_onset()
+        self.this_trial.annotate(stimulus_time=onset if onset is not None else dt.datetime.now())
+
     def response_main(self):
         if self.this_trial.block == self.block_queue.blocks["pecking"]:
             GoNoGoInterrupt.response_main(self)
         else:
             self.this_trial.rt = np.nan
-            utils.wait(self.this_trial.stimulus.duration)
+            if self._playback_start_at is not None:
+                # The playback starts a little after the end of the timeout,
+                # so wait from its actual onset
+                stimulus_end = self.this_trial.annotations["stimulus_time"] + \
+                    dt.timedelta(seconds=self.this_trial.stimulus.duration)
+                utils.wait(max((stimulus_end - dt.datetime.now()).total_seconds(), 0))
+            else:
+                utils.wait(self.this_trial.stimulus.duration)
             self.panel.speaker.stop()
 
     def response_post(self):
@@ -269,6 +300,6 @@ class PeckingAndPlaybackTest(PeckingTest, record_trials.RecordTrialsMixin):
         for block_name in self.record_audio:
             if self.record_audio[block_name] and self.this_trial.block == self.block_queue.blocks[block_name]:
                 utils.wait(2.0)  # Record for two extra second after the end of the stim and 6 seconds before stim onset
-                data, rate = self.panel.mic.record_last(6.0 + (time.time() - self._stim_start_time))
+                data, rate = self.panel.mic.record_range(self._stim_start_time - 6.0, time.time())
                 self.save_wavfile(data, rate, self.get_wavfile_path())
                 break
@@ -306,6 +306,17 @@ def check_time(schedule,fmt="%H:%M"):
                 return True
     return False
 
+def wait_until(monotonic_time, final_countdown=0.002):
+    """Wait until time.monotonic() reaches monotonic_time, sleeping for all
+    but the last final_countdown seconds and polling the clock for those.
+    """
+    remaining = monotonic_time - time.monotonic()
+    if remaining > final_countdown:
+        time.sleep(remaining - final_countdown)
+    while time.monotonic() < monotonic_time:
+        pass
+
+
 def wait(secs=1.0, final_countdown=0.0,waitfunc=None):
     """Smartly wait for a given time period.
 
@@ -426,6 +437,44 @@ def concat_wav(input_file_list, output_filename='concat.wav'):
     return (concat_wav,epochs)
 
 
+def sequence_stimulus(input_file_list, name='sequence'):
+    """ describe a set of wav files, each followed by a pause, as a single
+    stimulus without writing anything to disk
+
+    takes in a tuple list of files and duration of pause after the file, as
+    concat_wav does, and returns the stimulus and a list of AuditoryStimulus
+    epochs. The list is kept in the stimulus' 'sequence' annotation, to be
+    played with Speaker.queue_sequence().
+    """
+
+    input_file_list = list(input_file_list)
+    cursor = 0.0
+    epochs = []
+    for input_filename, isi in input_file_list:
+        with closing(wave.open(input_filename, 'rb')) as wav_part:
+            params = wav_part.getparams()
+        fs = float(params.framerate)
+
+        epochs.append(AuditoryStimulus(time=cursor,
+                                       duration=params.nframes / fs,
+                                       name=input_filename,
+                                       file_origin=input_filename,
+                                       annotations=params,
+                                       label='motif'
+                                       ))
+        # the pause is rounded to whole frames, as it is when played
+        cursor += (params.nframes + int(round(isi * fs))) / fs
+
+    return (AuditoryStimulus(time=0.0,
+                             duration=epochs[-1].time + epochs[-1].duration,
+                             name=name,
+                             label='wav',
+                             description='sequenced on-the-fly',
+                             sequence=input_file_list,
+                             ),
+            epochs)
+
+
 def get_num_open_fds():
     '''
     return the number of open file descriptors for current process
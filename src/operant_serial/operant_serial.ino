@@ -1,8 +1,345 @@
-
 int baudRate = 19200; // 9600 seems common though it can probably be increased significantly if needed.
 char ioBytes[2];
 int ioPort = 0;
 
+// Bitmasks over all digital pins. Pin N lives in byte N / 8, bit N % 8.
+#define MASK_BYTES ((NUM_DIGITAL_PINS + 7) / 8)
+byte configuredPins[MASK_BYTES]; // Pins set up through actions 3, 4 or 5
+byte inputPins[MASK_BYTES]; // Pins set up through actions 4 or 5
+byte pinStates[MASK_BYTES]; // Scratch space for multi-pin reads
+
+// Edge streaming. When enabled, every change on an input pin is pushed to the
+// host as a 7 byte packet: EDGE_MARKER, pin, level and micros() as 4 bytes
+// (least significant first).
+#define EDGE_MARKER 0xFE
+bool streaming = false;
+byte lastLevels[MASK_BYTES]; // Last level reported for each input pin
+
+// Framed protocol (version 2). The device starts out speaking the legacy two
+// byte protocol and switches to frames when it receives action 9. A frame is
+//   FRAME_SYNC, length, sequence, command, payload (length bytes), crc8
+// where the crc8 covers length, sequence, command and payload. Every request
+// is answered with a frame carrying the same sequence number and the command
+// with REPLY_FLAG set, or with a CMD_NAK frame. Edges are pushed as CMD_EDGE
+// frames with sequence number 0.
+#define PROTOCOL_VERSION 2
+#define FRAME_SYNC 0xA5
+#define MAX_PAYLOAD 32
+#define REPLY_FLAG 0x80
+#define CMD_EDGE 8
+#define CMD_HELLO 9
+#define CMD_NAK 0x7F
+#define ERROR_CRC 1
+#define ERROR_UNKNOWN_COMMAND 2
+#define ERROR_BAD_LENGTH 3
+#define ERROR_NO_TIMER 4
+#define ERROR_NO_FILTER 5
+bool framed = false;
+byte rxFrame[MAX_PAYLOAD + 5];
+int rxCount = 0;
+byte txPayload[MAX_PAYLOAD];
+
+// Firmware-timed outputs (framed protocol only).
+// CMD_PULSE: payload pin, duration in ms (4 bytes). Sets the pin HIGH and
+//   back to LOW after the duration.
+// CMD_PATTERN: payload pin, on ms (2 bytes), off ms (2 bytes), duration in
+//   ms (4 bytes, 0 runs until cancelled). Blinks the pin starting HIGH and
+//   restores its prior level at the end.
+// Writing to a pin cancels any timer running on it. When a timer finishes on
+// its own, a CMD_OUTPUT_DONE frame with the pin and its final level is pushed
+// with sequence number 0.
+#define CMD_PULSE 10
+#define CMD_PATTERN 11
+#define CMD_OUTPUT_DONE 12
+#define MAX_TIMERS 8
+struct OutputTimer {
+  int pin; // -1 when the slot is free
+  bool toggles; // false for a single pulse
+  bool level; // current level while blinking
+  bool restoreLevel; // level written when the timer finishes
+  unsigned int onMs;
+  unsigned int offMs;
+  unsigned long duration;
+  unsigned long started;
+  unsigned long lastToggle;
+};
+OutputTimer timers[MAX_TIMERS];
+
+// Input filters (framed protocol only).
+// CMD_CONFIG_INPUT: payload pin, debounce in ms (2 bytes), flags. A reading
+//   has to hold for the debounce window before the pin's level changes. This
+//   filtered level is used for reads and edges. With FILTER_SUPPRESS_LONGPRESS
+//   set, a polling read (CMD_POLL_INPUT) reports each press only once:
+//   further polling reads return the released level until the pin is
+//   released and pressed again. Single reads (command 0), bitmask reads and
+//   edges always report the filtered level. FILTER_ACTIVE_LOW marks pins
+//   that read LOW when pressed. A debounce of 0 with no flags removes the
+//   filter.
+#define CMD_CONFIG_INPUT 13
+#define MAX_FILTERS 8
+#define FILTER_SUPPRESS_LONGPRESS 1
+#define FILTER_ACTIVE_LOW 2
+struct InputFilter {
+  int pin; // -1 when the slot is free
+  unsigned int debounceMs;
+  byte flags;
+  bool rawLevel; // last level read from the pin
+  bool level; // filtered level
+  bool reported; // the current press has already been returned by a polling read
+  unsigned long changedAt;
+};
+InputFilter filters[MAX_FILTERS];
+
+// Clock synchronization (framed protocol only).
+// CMD_PING: no payload. The reply carries micros() (4 bytes), taken as soon as
+//   the request has been received, so the host can map device timestamps to
+//   its own clock.
+#define CMD_PING 14
+
+// Polling reads (framed protocol only).
+// CMD_POLL_INPUT: payload pin. Like command 0, except that a pin filtered
+//   with FILTER_SUPPRESS_LONGPRESS reports each press only once.
+#define CMD_POLL_INPUT 15
+
+bool maskHas(byte *mask, int pin) {
+  return mask[pin / 8] & (1 << (pin % 8));
+}
+
+void maskSet(byte *mask, int pin, bool value) {
+  if (value) {
+    mask[pin / 8] |= (1 << (pin % 8));
+  } else {
+    mask[pin / 8] &= ~(1 << (pin % 8));
+  }
+}
+
+void setConfigured(int pin, bool isInput) {
+  maskSet(configuredPins, pin, true);
+  maskSet(inputPins, pin, isInput);
+}
+
+InputFilter *findFilter(int pin) {
+  for (int ii = 0; ii < MAX_FILTERS; ii++) {
+    if (filters[ii].pin == pin) {
+      return &filters[ii];
+    }
+  }
+  return NULL;
+}
+
+void clearFilter(int pin) {
+  InputFilter *filter = findFilter(pin);
+  if (filter != NULL) {
+    filter->pin = -1;
+  }
+}
+
+// Set up or replace the filter on a pin. Returns false if every slot is in use.
+bool configureFilter(int pin, unsigned int debounceMs, byte flags) {
+  clearFilter(pin);
+  if ((debounceMs == 0) && (flags == 0)) {
+    return true;
+  }
+  InputFilter *filter = findFilter(-1);
+  if (filter == NULL) {
+    return false;
+  }
+  filter->pin = pin;
+  filter->debounceMs = debounceMs;
+  filter->flags = flags;
+  filter->rawLevel = digitalRead(pin) == HIGH;
+  filter->level = filter->rawLevel;
+  // A press that is already held when the filter is set up is not reported
+  filter->reported = filter->level != ((flags & FILTER_ACTIVE_LOW) != 0);
+  filter->changedAt = millis();
+  return true;
+}
+
+void serviceFilters() {
+  unsigned long now = millis();
+  for (int ii = 0; ii < MAX_FILTERS; ii++) {
+    InputFilter *filter = &filters[ii];
+    if (filter->pin == -1) {
+      continue;
+    }
+    bool raw = digitalRead(filter->pin) == HIGH;
+    if (raw != filter->rawLevel) {
+      filter->rawLevel = raw;
+      filter->changedAt = now;
+    }
+    if ((raw != filter->level) && (now - filter->changedAt >= filter->debounceMs)) {
+      filter->level = raw;
+      if (raw == ((filter->flags & FILTER_ACTIVE_LOW) != 0)) {
+        filter->reported = false; // Released
+      }
+    }
+  }
+}
+
+// The level of a pin, after debouncing if it has a filter
+bool pinLevel(int pin) {
+  InputFilter *filter = findFilter(pin);
+  if (filter == NULL) {
+    return digitalRead(pin) == HIGH;
+  }
+  return filter->level;
+}
+
+// The level of a pin for a polling read, with long presses suppressed
+bool pollInput(int pin) {
+  InputFilter *filter = findFilter(pin);
+  if ((filter == NULL) || !(filter->flags & FILTER_SUPPRESS_LONGPRESS)) {
+    return pinLevel(pin);
+  }
+  bool released = (filter->flags & FILTER_ACTIVE_LOW) != 0;
+  if (filter->level == released) {
+    return released;
+  }
+  if (filter->reported) {
+    return released;
+  }
+  filter->reported = true;
+  return filter->level;
+}
+
+// CRC-8 with polynomial 0x07 and an initial value of 0
+byte crc8Update(byte crc, byte data) {
+  crc ^= data;
+  for (int bit = 0; bit < 8; bit++) {
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+  }
+  return crc;
+}
+
+byte crc8(const byte *data, int len) {
+  byte crc = 0;
+  for (int ii = 0; ii < len; ii++) {
+    crc = crc8Update(crc, data[ii]);
+  }
+  return crc;
+}
+
+void sendFrame(byte seq, byte cmd, const byte *payload, int len) {
+  byte header[4] = {FRAME_SYNC, (byte) len, seq, cmd};
+  byte crc = crc8(header + 1, 3);
+  for (int ii = 0; ii < len; ii++) {
+    crc = crc8Update(crc, payload[ii]);
+  }
+  Serial.write(header, 4);
+  Serial.write(payload, len);
+  Serial.write(crc);
+}
+
+void sendNak(byte seq, byte error) {
+  sendFrame(seq, CMD_NAK, &error, 1);
+}
+
+void sendEdge(int pin, int level, unsigned long stamp) {
+  byte packet[7];
+  packet[0] = EDGE_MARKER;
+  packet[1] = (byte) pin;
+  packet[2] = (byte) level;
+  for (int ii = 0; ii < 4; ii++) {
+    packet[3 + ii] = (byte) (stamp >> (8 * ii));
+  }
+  if (framed) {
+    sendFrame(0, CMD_EDGE, packet + 1, 6);
+  } else {
+    Serial.write(packet, 7);
+  }
+}
+
+// Compare every input pin against its last reported level and push changes
+void reportEdges() {
+  unsigned long stamp = micros();
+  for (int pin = 0; pin < NUM_DIGITAL_PINS; pin++) {
+    if (maskHas(inputPins, pin)) {
+      bool level = pinLevel(pin);
+      if (level != maskHas(lastLevels, pin)) {
+        maskSet(lastLevels, pin, level);
+        sendEdge(pin, level, stamp);
+      }
+    }
+  }
+}
+
+// Fill pinStates with the current value of every configured pin
+void readConfiguredPins() {
+  for (int ii = 0; ii < MASK_BYTES; ii++) {
+    pinStates[ii] = 0;
+  }
+  for (int pin = 0; pin < NUM_DIGITAL_PINS; pin++) {
+    if (maskHas(configuredPins, pin)) {
+      maskSet(pinStates, pin, pinLevel(pin));
+    }
+  }
+}
+
+void setStreaming(bool enable) {
+  streaming = enable;
+  for (int ii = 0; ii < MASK_BYTES; ii++) {
+    lastLevels[ii] = 0;
+  }
+}
+
+// Read a little-endian unsigned integer of nbytes from a payload
+unsigned long readUnsigned(const byte *data, int nbytes) {
+  unsigned long value = 0;
+  for (int ii = nbytes - 1; ii >= 0; ii--) {
+    value = (value << 8) | data[ii];
+  }
+  return value;
+}
+
+void cancelTimer(int pin) {
+  for (int ii = 0; ii < MAX_TIMERS; ii++) {
+    if (timers[ii].pin == pin) {
+      timers[ii].pin = -1;
+    }
+  }
+}
+
+// Claim a timer slot for a pin, replacing any timer already running on it.
+// Returns NULL if every slot is in use.
+OutputTimer *startTimer(int pin) {
+  cancelTimer(pin);
+  for (int ii = 0; ii < MAX_TIMERS; ii++) {
+    if (timers[ii].pin == -1) {
+      timers[ii].pin = pin;
+      timers[ii].started = millis();
+      timers[ii].lastToggle = timers[ii].started;
+      return &timers[ii];
+    }
+  }
+  return NULL;
+}
+
+void serviceTimers() {
+  unsigned long now = millis();
+  for (int ii = 0; ii < MAX_TIMERS; ii++) {
+    OutputTimer *timer = &timers[ii];
+    if (timer->pin == -1) {
+      continue;
+    }
+    if ((timer->duration > 0) && (now - timer->started >= timer->duration)) {
+      digitalWrite(timer->pin, timer->restoreLevel);
+      txPayload[0] = (byte) timer->pin;
+      txPayload[1] = timer->restoreLevel;
+      timer->pin = -1;
+      sendFrame(0, CMD_OUTPUT_DONE, txPayload, 2);
+      continue;
+    }
+    if (timer->toggles) {
+      unsigned long period = timer->level ? timer->onMs : timer->offMs;
+      if (now - timer->lastToggle >= period) {
+        timer->level = !timer->level;
+        digitalWrite(timer->pin, timer->level);
+        timer->lastToggle += period;
+      }
+    }
+  }
+}
+
 void setup()
 {
   // start serial port at the specified baud rate
@@ -10,52 +347,229 @@ void setup()
   while (!Serial) {
     ; // wait for serial port to connect. Needed for Leonardo only
   }
+  for (int ii = 0; ii < MAX_TIMERS; ii++) {
+    timers[ii].pin = -1;
+  }
+  for (int ii = 0; ii < MAX_FILTERS; ii++) {
+    filters[ii].pin = -1;
+  }
   Serial.println("Initialized!");
 }
 
+// Legacy protocol: all serial communications are two bytes long
+// The first byte specifies the port to act on
+// The second byte specifies the action to take
+// The actions are:
+// 0: Read the specified input
+// 1: Write the specified output to HIGH
+// 2: Write the specified output to LOW
+// 3: Set the specified pin to OUTPUT
+// 4: Set the specified pin to INPUT
+// 5: Set the specified pin to INPUT_PULLUP
+// 6: Read all configured pins. The port byte is ignored. The reply is one
+//    byte with the number of mask bytes followed by the bitmask itself.
+// 7: Enable (port byte 1) or disable (port byte 0) edge streaming. Enabling
+//    reports the current level of every input pin that is HIGH.
+// 9: Switch to the framed protocol. The reply is a CMD_HELLO frame carrying
+//    PROTOCOL_VERSION.
+void handleLegacy() {
+  // get incoming two bytes:
+  Serial.readBytes(ioBytes, 2);
+  //Serial.println("I received: ");
+  //Serial.println(ioBytes[0], DEC);
+  //Serial.println(ioBytes[1], DEC);
+  // Extract the specified port
+  ioPort = (int) ioBytes[0];
+  // Switch case on the specified action
+  switch ((int) ioBytes[1]) {
+    case 0: // Read an input
+      Serial.write(digitalRead(ioPort));
+      break;
+    case 1: // Write an output to HIGH
+      cancelTimer(ioPort);
+      digitalWrite(ioPort, HIGH);
+      break;
+    case 2: // Write an output to LOW
+      cancelTimer(ioPort);
+      digitalWrite(ioPort, LOW);
+      break;
+    case 3: // Set a pin to OUTPUT
+      clearFilter(ioPort);
+      pinMode(ioPort, OUTPUT);
+      digitalWrite(ioPort, LOW);
+      setConfigured(ioPort, false);
+      break;
+    case 4: // Set a pin to INPUT
+      pinMode(ioPort, INPUT);
+      setConfigured(ioPort, true);
+      break;
+    case 5: // Set a pin to INPUT_PULLUP
+      pinMode(ioPort, INPUT_PULLUP);
+      setConfigured(ioPort, true);
+      break;
+    case 6: // Read all configured pins at once
+      readConfiguredPins();
+      Serial.write((byte) MASK_BYTES);
+      Serial.write(pinStates, MASK_BYTES);
+      break;
+    case 7: // Enable or disable edge streaming
+      setStreaming(ioPort != 0);
+      break;
+    case 9: // Switch to the framed protocol
+      framed = true;
+      rxCount = 0;
+      txPayload[0] = PROTOCOL_VERSION;
+      sendFrame(0, CMD_HELLO | REPLY_FLAG, txPayload, 1);
+      break;
+  }
+}
+
+// Collect bytes into rxFrame. Returns true once a complete frame with a valid
+// crc has been received.
+bool receiveFrame() {
+  while (Serial.available() > 0) {
+    byte b = Serial.read();
+    if (rxCount == 0 && b != FRAME_SYNC) {
+      continue; // Resynchronize on the next sync byte
+    }
+    rxFrame[rxCount++] = b;
+    if (rxCount == 2 && rxFrame[1] > MAX_PAYLOAD) {
+      rxCount = 0;
+      continue;
+    }
+    if (rxCount >= 2 && rxCount == rxFrame[1] + 5) {
+      rxCount = 0;
+      if (crc8(rxFrame + 1, rxFrame[1] + 3) == rxFrame[rxFrame[1] + 4]) {
+        return true;
+      }
+      sendNak(rxFrame[2], ERROR_CRC);
+    }
+  }
+  return false;
+}
+
+// Framed protocol: the commands match the legacy actions, with the pin as the
+// first payload byte
+void handleFrame() {
+  byte len = rxFrame[1];
+  byte seq = rxFrame[2];
+  byte cmd = rxFrame[3];
+  byte *payload = rxFrame + 4;
+  int pin = payload[0];
+  OutputTimer *timer;
+  unsigned long stamp;
+
+  if ((cmd <= 7 && cmd != 6 && len < 1) ||
+      (cmd == CMD_POLL_INPUT && len < 1) ||
+      (cmd == CMD_PULSE && len < 5) ||
+      (cmd == CMD_PATTERN && len < 9) ||
+      (cmd == CMD_CONFIG_INPUT && len < 4)) {
+    sendNak(seq, ERROR_BAD_LENGTH);
+    return;
+  }
+
+  switch (cmd) {
+    case 0: // Read an input
+      txPayload[0] = pinLevel(pin);
+      sendFrame(seq, cmd | REPLY_FLAG, txPayload, 1);
+      return;
+    case CMD_POLL_INPUT: // Read an input for polling
+      txPayload[0] = pollInput(pin);
+      sendFrame(seq, cmd | REPLY_FLAG, txPayload, 1);
+      return;
+    case 1: // Write an output to HIGH
+      cancelTimer(pin);
+      digitalWrite(pin, HIGH);
+      break;
+    case 2: // Write an output to LOW
+      cancelTimer(pin);
+      digitalWrite(pin, LOW);
+      break;
+    case 3: // Set a pin to OUTPUT
+      clearFilter(pin);
+      pinMode(pin, OUTPUT);
+      digitalWrite(pin, LOW);
+      setConfigured(pin, false);
+      break;
+    case 4: // Set a pin to INPUT
+      pinMode(pin, INPUT);
+      setConfigured(pin, true);
+      break;
+    case 5: // Set a pin to INPUT_PULLUP
+      pinMode(pin, INPUT_PULLUP);
+      setConfigured(pin, true);
+      break;
+    case 6: // Read all configured pins at once
+      readConfiguredPins();
+      sendFrame(seq, cmd | REPLY_FLAG, pinStates, MASK_BYTES);
+      return;
+    case 7: // Enable or disable edge streaming
+      setStreaming(pin != 0);
+      break;
+    case CMD_PULSE: // Set a pin HIGH for a number of milliseconds
+      timer = startTimer(pin);
+      if (timer == NULL) {
+        sendNak(seq, ERROR_NO_TIMER);
+        return;
+      }
+      timer->toggles = false;
+      timer->restoreLevel = LOW;
+      timer->duration = readUnsigned(payload + 1, 4);
+      digitalWrite(pin, HIGH);
+      break;
+    case CMD_PATTERN: // Blink a pin until the duration ends or it is cancelled
+      timer = startTimer(pin);
+      if (timer == NULL) {
+        sendNak(seq, ERROR_NO_TIMER);
+        return;
+      }
+      timer->toggles = true;
+      timer->restoreLevel = digitalRead(pin);
+      timer->level = HIGH;
+      timer->onMs = readUnsigned(payload + 1, 2);
+      timer->offMs = readUnsigned(payload + 3, 2);
+      timer->duration = readUnsigned(payload + 5, 4);
+      digitalWrite(pin, HIGH);
+      break;
+    case CMD_CONFIG_INPUT: // Debounce an input and optionally suppress long presses
+      if (!configureFilter(pin, readUnsigned(payload + 1, 2), payload[3])) {
+        sendNak(seq, ERROR_NO_FILTER);
+        return;
+      }
+      break;
+    case CMD_PING: // Report the device clock
+      stamp = micros();
+      for (int ii = 0; ii < 4; ii++) {
+        txPayload[ii] = (byte) (stamp >> (8 * ii));
+      }
+      sendFrame(seq, cmd | REPLY_FLAG, txPayload, 4);
+      return;
+    case CMD_HELLO:
+      txPayload[0] = PROTOCOL_VERSION;
+      sendFrame(seq, cmd | REPLY_FLAG, txPayload, 1);
+      return;
+    default:
+      sendNak(seq, ERROR_UNKNOWN_COMMAND);
+      return;
+  }
+  // Commands without a return value are acknowledged with an empty reply
+  sendFrame(seq, cmd | REPLY_FLAG, txPayload, 0);
+}
+
 void loop()
 {
-  // All serial communications should be two bytes long
-  // The first byte specifies the port to act on
-  // The second byte specifies the action to take
-  // The actions are:
-  // 0: Read the specified input
-  // 1: Write the specified output to HIGH
-  // 2: Write the specified output to LOW
-  // 3: Set the specified pin to OUTPUT
-  // 4: Set the specified pin to INPUT
-  // 5: Set the specified pin to INPUT_PULLUP
-  // if we get a valid serial message, read the request:
-  if (Serial.available() >= 2) {
-    // get incoming two bytes:
-    Serial.readBytes(ioBytes, 2);
-    //Serial.println("I received: ");
-    //Serial.println(ioBytes[0], DEC);
-    //Serial.println(ioBytes[1], DEC);
-    // Extract the specified port
-    ioPort = (int) ioBytes[0];
-    // Switch case on the specified action
-    switch ((int) ioBytes[1]) {
-      case 0: // Read an input
-        Serial.write(digitalRead(ioPort));
-        break;
-      case 1: // Write an output to HIGH
-        digitalWrite(ioPort, HIGH);       
-        break;
-      case 2: // Write an output to LOW
-        digitalWrite(ioPort, LOW);        
-        break;
-      case 3: // Set a pin to OUTPUT
-        pinMode(ioPort, OUTPUT);
-        digitalWrite(ioPort, LOW);
-        break;
-      case 4: // Set a pin to INPUT
-        pinMode(ioPort, INPUT);
-        break;
-      case 5: // Set a pin to INPUT_PULLUP
-        pinMode(ioPort, INPUT_PULLUP);
-        break;
+  if (framed) {
+    if (receiveFrame()) {
+      handleFrame();
     }
+  } else if (Serial.available() >= 2) {
+    // if we get a valid serial message, read the request:
+    handleLegacy();
+  }
+  serviceFilters();
+  if (streaming) {
+    reportEdges();
   }
+  serviceTimers();
   //delay(10); // Should probably move to a non-delay based spacing.
 }